@@ -28,7 +28,8 @@ def repo_dir(repo, *path, mkdir=False):
             raise Exception("Not a directory %s" % path)
 
     if mkdir:
-        os.makedirs(path)
+        # Another thread or process may create it at the same time (add -j does).
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
@@ -75,7 +76,7 @@ def repo_find(path=".", required=True):
     path = os.path.realpath(path)
 
     if os.path.isdir(os.path.join(path, ".git")):
-        return GitRepository(path)
+        return repo_open(path)
 
     parent = os.path.realpath(os.path.join(path, ".."))
 
@@ -87,6 +88,22 @@ def repo_find(path=".", required=True):
 
     return repo_find(parent, required)
 
+#Repositories already opened, by worktree, along with the mtime of their configuration: a
+#long-running process (see gitServer) only parses a configuration again when it changes.
+_repos = dict()
+
+def repo_open(path):
+    try:
+        mtime = os.stat(os.path.join(path, ".git", "config")).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = _repos.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    repo = GitRepository(path)
+    _repos[path] = (mtime, repo)
+    return repo
+
 class GitRepository (object):
     worktree = None
     gitdir = None 
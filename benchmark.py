@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import gitIndexColumns
+import gitRepo
+import gitSubObject
+import gitUtil
+
+"""
+Benchmarks for the expensive paths of wyag. Each benchmark builds a synthetic repository in a
+temporary directory, times the operation it is about, and removes everything afterwards.
+
+    python benchmark.py checkout --files 20000 --size 4096 --jobs 8
+    python benchmark.py status --files 100000 --runs 5
+    python benchmark.py startup --runs 20
+"""
+
+#Write files blobs of about size bytes each, spread over directories of per_dir files, and
+#return the SHA of the root tree holding them.
+def make_tree(repo, files, size, per_dir=100):
+    root = gitSubObject.GitTree()
+    for d in range(0, files, per_dir):
+        subtree = gitSubObject.GitTree()
+        for i in range(d, min(d + per_dir, files)):
+            line = "line of file {0}\n".format(i).encode()
+            blob = gitSubObject.GitBlob(line * (size // len(line) + 1))
+            sha = gitUtil.object_write(blob, repo)
+            subtree.items.append(gitSubObject.GitTreeLeaf(b"100644", "file{0}.txt".format(i), sha))
+        sha = gitUtil.object_write(subtree, repo)
+        root.items.append(gitSubObject.GitTreeLeaf(b"040000", "dir{0}".format(d // per_dir), sha))
+    return gitUtil.object_write(root, repo)
+
+def timed(label, fn, *args):
+    gitUtil.object_cache.clear()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    print("  {0:<24} {1:8.3f}s".format(label, elapsed))
+    return elapsed
+
+def bench_checkout(args):
+    tmp = tempfile.mkdtemp(prefix="wyag-bench-")
+    try:
+        repo = gitRepo.repo_create(os.path.join(tmp, "repo"))
+        tree = gitUtil.object_read(repo, make_tree(repo, args.files, args.size))
+        print("checkout of {0} files of {1} bytes:".format(args.files, args.size))
+
+        dest = os.path.join(tmp, "serial")
+        os.mkdir(dest)
+        serial = timed("serial", gitUtil.tree_checkout, repo, tree, dest)
+
+        dest = os.path.join(tmp, "parallel")
+        os.mkdir(dest)
+        parallel = timed("parallel ({0} jobs)".format(args.jobs),
+                         gitUtil.tree_checkout_parallel, repo, tree, dest, args.jobs)
+        print("  speedup: {0:.2f}x".format(serial / parallel))
+    finally:
+        shutil.rmtree(tmp)
+
+#Write files small files, and an index describing them (with made-up SHAs: only the stat data
+#matters here). The files are dated an hour back, so that index_write doesn't smudge them.
+def make_index(repo, files, per_dir=1000):
+    entries = list()
+    for d in range(0, files, per_dir):
+        dirname = "dir{0}".format(d // per_dir)
+        os.mkdir(os.path.join(repo.worktree, dirname))
+        for i in range(d, min(d + per_dir, files)):
+            name = "{0}/file{1}.txt".format(dirname, i)
+            full_path = os.path.join(repo.worktree, name)
+            with open(full_path, "w") as f:
+                f.write(name)
+            os.utime(full_path, (time.time() - 3600, time.time() - 3600))
+            st = os.stat(full_path)
+            entries.append(gitSubObject.GitIndexEntry(
+                ctime=(int(st.st_ctime), st.st_ctime_ns % 10**9),
+                mtime=(int(st.st_mtime), st.st_mtime_ns % 10**9),
+                dev=st.st_dev & 0xffffffff, ino=st.st_ino & 0xffffffff,
+                mode_type=0b1000, mode_perms=0o644, uid=st.st_uid, gid=st.st_gid,
+                fsize=st.st_size, sha="{0:040x}".format(i), flag_assume_valid=False,
+                flag_stage=0, name=name))
+    gitUtil.index_write(repo, gitSubObject.GitIndex(entries=entries))
+
+#Commit the index, so that status has nothing staged to report. The blobs don't exist, but
+#only trees are written from the index.
+def make_commit(repo):
+    lock = gitUtil.index_lock(repo)
+    index = gitUtil.index_read(repo)
+    tree = gitUtil.tree_from_index(repo, index)
+    gitUtil.index_write(repo, index, lock)
+    commit = gitUtil.commit_create(repo, tree, None, "Benchmark <benchmark@example.com>",
+                                   datetime.now(), "Benchmark\n")
+    with open(gitRepo.repo_file(repo, "refs", "heads", "master"), "w") as f:
+        f.write(commit + "\n")
+
+#Run wyag status in the worktree runs times, with the columnar index enabled or not, and return
+#the median time and what it printed. Each run is a new process, like a user running status.
+def timed_status(repo, columnar, runs):
+    config = gitRepo.repo_default_config()
+    config.set("core", "columnarIndex", "true" if columnar else "false")
+    with open(gitRepo.repo_file(repo, "config"), "w") as f:
+        config.write(f)
+    env = dict(os.environ, WYAG_SERVER="0")
+    wyag = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wyag.py")
+    times = list()
+    for i in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([ sys.executable, wyag, "status" ], cwd=repo.worktree, env=env,
+                                capture_output=True, text=True, check=True)
+        times.append(time.perf_counter() - start)
+    label = "columnar (NumPy)" if columnar else "pure python"
+    print("  {0:<24} {1:8.3f}s".format(label, statistics.median(times)))
+    return statistics.median(times), result.stdout
+
+#wyag status from start to end, on an index whose files are all committed, with one file in a
+#hundred touched (its stat data changed, but not its size).
+def bench_status(args):
+    tmp = tempfile.mkdtemp(prefix="wyag-bench-")
+    try:
+        repo = gitRepo.repo_create(os.path.join(tmp, "repo"))
+        make_index(repo, args.files)
+        make_commit(repo)
+        for i in range(0, args.files, 100):
+            os.utime(os.path.join(repo.worktree, "dir{0}/file{1}.txt".format(i // 1000, i)), ns=(0, 0))
+        print("status of {0} files, median of {1} runs:".format(args.files, args.runs))
+
+        python, python_out = timed_status(repo, False, args.runs)
+        if not gitIndexColumns.available():
+            print("  (NumPy isn't installed: no columnar index)")
+            return
+        columns, columns_out = timed_status(repo, True, args.runs)
+        print("  speedup: {0:.2f}x".format(python / columns))
+        if python_out != columns_out:
+            raise Exception("The two runs of status disagree")
+    finally:
+        shutil.rmtree(tmp)
+
+#Import time of the entry point, in milliseconds, as python -X importtime reports it: each line
+#of its report gives the self and cumulative time (in microseconds) of a module, nested imports
+#first. Returns the cumulative time of module, and the self time of every module imported.
+def import_time(module):
+    result = subprocess.run([ sys.executable, "-X", "importtime", "-c", "import " + module ],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    total = None
+    modules = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if not own.strip().isdigit():
+            continue # The header line
+        modules[name.strip()] = int(own) / 1000
+        if name.strip() == module:
+            total = int(cumulative) / 1000
+    return total, modules
+
+#The time it takes before wyag starts working: importing libwyag (and gitClient, which wyag.py
+#imports first), measured in fresh interpreters. It fails past args.budget milliseconds, so
+#that a slow import slipping into the entry point gets noticed.
+STARTUP_BUDGET_MS = 100
+
+def bench_startup(args):
+    totals = list()
+    modules = dict()
+    for i in range(args.runs):
+        client, _ = import_time("gitClient")
+        total, own = import_time("libwyag")
+        totals.append(client + total)
+        for name, ms in own.items():
+            modules.setdefault(name, list()).append(ms)
+    median = statistics.median(totals)
+    print("startup over {0} runs:".format(args.runs))
+    print("  {0:<24} {1:8.1f}ms".format("median", median))
+    print("  {0:<24} {1:8.1f}ms".format("best", min(totals)))
+    print("  slowest modules (self time):")
+    slowest = sorted(modules.items(), key=lambda m: -statistics.median(m[1]))[:10]
+    for name, times in slowest:
+        print("    {0:<22} {1:8.1f}ms".format(name, statistics.median(times)))
+    if median > args.budget:
+        raise Exception("Startup takes {0:.1f}ms, over the budget of {1}ms".format(median, args.budget))
+
+BENCHMARKS = { "checkout": bench_checkout,
+               "startup": bench_startup,
+               "status": bench_status }
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Benchmarks for wyag")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--files", type=int, default=10000, help="Number of files")
+    parser.add_argument("--size", type=int, default=4096, help="Size of each file, in bytes")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of workers")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs (startup, status)")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_MS,
+                        help="Startup budget, in milliseconds (startup)")
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import tempfile
+import gitEwah
+
+"""
+A reachability bitmap tells which objects of a pack can be reached from a commit: bit i is set
+when the i-th object of the pack (in pack order, that is by offset) is reachable. With bitmaps
+for a good selection of commits, finding everything reachable from a set of commits means
+walking back only to the nearest bitmapped commits, then OR-ing their bitmaps.
+
+A pack's bitmaps live next to it, in pack-<sha>.bitmap, in git's format (version 1):
+    _A header: "BITM", the version (2 bytes), option flags (2 bytes; we always set FULL_DAG,
+     which means everything reachable from a bitmapped commit is in the pack), the number of
+     bitmapped commits (4 bytes), and the checksum of the pack they describe.
+    _Four EWAH bitmaps (see gitEwah) telling which objects are commits, trees, blobs and tags.
+    _For each bitmapped commit: its position in the pack index (4 bytes), a XOR offset (1 byte),
+     flags (1 byte), and its EWAH bitmap. A non-zero XOR offset n means the bitmap is stored
+     XOR-ed with the one of the commit n entries before. We write plain bitmaps, but read both.
+    _The SHA-1 of everything before it.
+"""
+
+SIGNATURE = b'BITM'
+VERSION = 1
+OPT_FULL_DAG = 0x1
+OPT_HASH_CACHE = 0x4
+TYPES = (b'commit', b'tree', b'blob', b'tag')
+
+# Besides the tips of the refs, we bitmap one commit in this many.
+SPACING = 100
+
+class GitBitmapIndex(object):
+    def __init__(self, pack):
+        self.pack = pack
+        self.path = pack.path + ".bitmap"
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        if data[0:4] != SIGNATURE or int.from_bytes(data[4:6], "big") != VERSION:
+            raise Exception("Unsupported bitmap index {0}".format(self.path))
+        options = int.from_bytes(data[6:8], "big")
+        if not options & OPT_FULL_DAG:
+            raise Exception("Unsupported bitmap index {0}: not a full DAG".format(self.path))
+        count = int.from_bytes(data[8:12], "big")
+        if data[12:32] != pack.pack[-20:]:
+            raise Exception("Bitmap index {0} doesn't match its pack".format(self.path))
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise Exception("Malformed bitmap index {0}: bad checksum".format(self.path))
+
+        pos = 32
+        self.types = dict()
+        for fmt in TYPES:
+            self.types[fmt], _, pos = gitEwah.ewah_decode(data, pos)
+
+        # Binary SHA of each commit -> its entry number. Bitmaps are only decoded when needed.
+        self.data = data
+        self.commits = dict()
+        self.entries = list()
+        for i in range(count):
+            idx_pos = int.from_bytes(data[pos: pos+4], "big")
+            xor_offset = data[pos+4]
+            pos += 6
+            self.commits[pack.sha_at(idx_pos)] = i
+            self.entries.append((pos, xor_offset))
+            # Skip the bitmap: bit count, word count, words, position of the last RLW.
+            words = int.from_bytes(data[pos+4: pos+8], "big")
+            pos += 8 + 8 * words + 4
+        self.decoded = dict()
+
+    #The bitmap of a commit, given its hex SHA, or None if it has none.
+    def get(self, sha):
+        i = self.commits.get(bytes.fromhex(sha))
+        if i is None:
+            return None
+        return self.bitmap_at(i)
+
+    def bitmap_at(self, i):
+        # Follow the XOR chain back to a plain bitmap, then undo the XORs on the way back.
+        chain = list()
+        while i not in self.decoded:
+            pos, xor_offset = self.entries[i]
+            chain.append((i, gitEwah.ewah_decode(self.data, pos)[0]))
+            if not xor_offset:
+                break
+            i -= xor_offset
+        bits = self.decoded.get(i, 0)
+        for i, stored in reversed(chain):
+            bits ^= stored
+            self.decoded[i] = bits
+        return bits
+
+#Bitmap indexes are cached for the whole process, along with the pack they were loaded for.
+_bitmaps = dict()
+
+def bitmap_open(pack):
+    cached = _bitmaps.get(pack.path)
+    if cached and cached[0] is pack:
+        return cached[1]
+    index = GitBitmapIndex(pack) if os.path.exists(pack.path + ".bitmap") else None
+    _bitmaps[pack.path] = (pack, index)
+    return index
+
+"""Writing bitmaps section"""
+
+#types maps each object type to the pack order positions of the objects of that type, and
+#bitmaps is a list of (index position, bits) for the selected commits, where each commit
+#comes after the ones it can reach.
+def bitmap_write(pack, types, bitmaps):
+    out = bytearray(SIGNATURE)
+    out += VERSION.to_bytes(2, "big") + OPT_FULL_DAG.to_bytes(2, "big")
+    out += len(bitmaps).to_bytes(4, "big")
+    out += pack.pack[-20:]
+    for fmt in TYPES:
+        out += gitEwah.ewah_encode(gitEwah.bits_from_positions(types[fmt]), pack.count)
+    for idx_pos, bits in bitmaps:
+        out += idx_pos.to_bytes(4, "big") + b'\x00\x00'
+        out += gitEwah.ewah_encode(bits, pack.count)
+    out += hashlib.sha1(out).digest()
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(pack.path), prefix="tmp_bitmap_")
+    with os.fdopen(fd, "wb") as f:
+        f.write(out)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, pack.path + ".bitmap")
+    _bitmaps.pop(pack.path, None)
+    return pack.path + ".bitmap"
+
+"""End of writing bitmaps section"""
@@ -0,0 +1,132 @@
+import os
+import sys
+
+"""
+The client side of the server (see gitServer). It only needs the standard library, and nothing
+of wyag, so that handing a command over to a running server costs as little as possible: wyag.py
+tries client_main first, and only loads the rest of wyag when no server can run the command.
+Without a server, that must cost nothing either: the modules talking to the server (socket, json
+and base64) are only imported by the functions using them, once a server socket was found.
+"""
+
+SOCKET = "wyag.sock"
+
+# Commands the server runs: those only reading the repository, with no path or environment of the
+# client to take into account (see gitServer). Everything else runs in the calling process.
+SERVED = ("cat-file", "log", "ls-tree", "show-ref", "rev-list", "rev-parse", "ls-files", "tag")
+
+#Whether the server can run the command of argv. tag is served only to list tags, not to create
+#one; cat-file --batch reads stdin, which the server doesn't have.
+def served(argv):
+    if not argv or argv[0] not in SERVED:
+        return False
+    if argv[0] == "tag":
+        return not any(not arg.startswith("-") for arg in argv[1:])
+    return "--batch" not in argv and "--batch-check" not in argv
+
+class GitClient(object):
+    def __init__(self, path):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.reader = self.sock.makefile("rb")
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, op, **args):
+        import json
+        args["op"] = op
+        self.sock.sendall(json.dumps(args).encode("utf8") + b'\n')
+
+    #Read an answer. Raises if the server reports an error.
+    def answer(self):
+        import json
+        line = self.reader.readline()
+        if not line:
+            raise Exception("The server closed the connection")
+        answer = json.loads(line)
+        if not answer["ok"]:
+            raise Exception(answer["error"])
+        return answer
+
+    #Send a request, and return the answer.
+    def request(self, op, **args):
+        self.send(op, **args)
+        return self.answer()
+
+    def read(self, sha):
+        import base64
+        answer = self.request("read", sha=sha)
+        return answer["fmt"].encode("ascii"), base64.b64decode(answer["data"])
+
+    def resolve(self, name, fmt=None):
+        return self.request("resolve", name=name, fmt=fmt)["sha"]
+
+    def refs(self):
+        return self.request("refs")["refs"]
+
+    #Run a command on the server, writing what it prints to the binary streams out and err as it
+    #comes. Returns its exit code.
+    def run(self, argv, out, err):
+        import base64
+        self.send("run", argv=argv)
+        while True:
+            answer = self.answer()
+            if "exit" in answer:
+                return answer["exit"]
+            stream = out if answer["stream"] == "stdout" else err
+            stream.write(base64.b64decode(answer["data"]))
+            stream.flush()
+
+#The socket of the server of the repository holding path, if there is one. Same search as
+#gitRepo.repo_find.
+def socket_find(path="."):
+    path = os.path.realpath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, ".git")):
+            sock = os.path.join(path, ".git", SOCKET)
+            return sock if os.path.exists(sock) else None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+#Run a wyag command through the server of the current repository. Returns its exit code, or
+#None when it has to run here: no server, or a command the server doesn't run (see served). Set
+#WYAG_SERVER=0 to never use the server.
+def client_main(argv):
+    if os.environ.get("WYAG_SERVER") == "0" or not served(argv):
+        return None
+    path = socket_find()
+    if path is None:
+        return None
+    try:
+        client = GitClient(path)
+    except OSError:
+        # A socket left behind by a server that died.
+        return None
+    with client:
+        return client.run(argv, sys.stdout.buffer, sys.stderr.buffer)
+
+def server_stop(path="."):
+    sock = socket_find(path)
+    if sock is None:
+        return False
+    try:
+        with GitClient(sock) as client:
+            client.request("quit")
+    except OSError:
+        return False
+    return True
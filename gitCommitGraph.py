@@ -0,0 +1,255 @@
+import hashlib
+import mmap
+import os
+import gitRepo
+
+"""
+Walking history means reading every commit on the way, just to find its parents: a full inflate
+and parse per commit. The commit-graph file (.git/objects/info/commit-graph) stores, for every
+commit reachable when it was written, what history walks need: its root tree, its parents and
+its commit time, in a memory-mapped table where a commit is looked up like in a pack index.
+
+The format is git's. After an 8-byte header ("CGPH", the version 1, the hash version 1 for
+SHA-1, the number of chunks, and the number of base graphs, always 0 for us), comes a table of
+contents: for each chunk, a 4-byte id and the 8-byte offset where it starts, plus a final entry
+with id 0 giving the end of the last chunk. The chunks are:
+    _OIDF: a fanout table of 256 entries, like the one of pack indexes.
+    _OIDL: the sorted SHAs of the commits. The position of a commit in this table is how the
+     other chunks refer to it.
+    _CDAT: for each commit, its root tree SHA, the positions of its first two parents (0x70000000
+     for none), and 8 bytes holding its generation number (30 bits) and commit time (34 bits).
+     When a commit has more than two parents, the second value is instead 0x80000000 with the
+     position in EDGE of the list of the other parents.
+    _EDGE: lists of parent positions for octopus merges, the last one of each list having its
+     high bit set.
+    _The SHA-1 of everything before it.
+
+The generation number of a commit is 1 for root commits, and 1 more than the biggest one of its
+parents otherwise: a commit can never be an ancestor of a commit with a smaller generation, which
+lets walks stop early.
+"""
+
+SIGNATURE = b'CGPH'
+VERSION = 1
+HASH_VERSION = 1
+
+PARENT_NONE = 0x70000000
+PARENT_EXTRA = 0x80000000
+GENERATION_MAX = 0x3fffffff
+
+CDAT_SIZE = 20 + 4 + 4 + 8
+
+class GitCommitGraph(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        if data[0:4] != SIGNATURE or data[4] != VERSION or data[5] != HASH_VERSION:
+            self.close()
+            raise Exception("Unsupported commit-graph {0}".format(path))
+        if data[7] != 0:
+            self.close()
+            raise Exception("Split commit-graphs are not supported: {0}".format(path))
+
+        # Table of contents: where each chunk starts and ends.
+        self.chunks = dict()
+        count = data[6]
+        for i in range(count):
+            start = 8 + 12 * i
+            chunk_id = data[start: start+4]
+            offset = int.from_bytes(data[start+4: start+12], "big")
+            end = int.from_bytes(data[start+16: start+24], "big")
+            self.chunks[chunk_id] = (offset, end)
+        for chunk_id in (b'OIDF', b'OIDL', b'CDAT'):
+            if chunk_id not in self.chunks:
+                self.close()
+                raise Exception("Malformed commit-graph {0}: no {1} chunk".format(path, chunk_id.decode()))
+
+        oidf = self.chunks[b'OIDF'][0]
+        self.fanout = [ int.from_bytes(data[oidf + 4*i: oidf + 4*i + 4], "big") for i in range(256) ]
+        self.count = self.fanout[255]
+        self.oidl = self.chunks[b'OIDL'][0]
+        self.cdat = self.chunks[b'CDAT'][0]
+        self.edge = self.chunks.get(b'EDGE', (None, None))[0]
+
+    def close(self):
+        self.data.close()
+
+    def sha_at(self, i):
+        start = self.oidl + 20 * i
+        return self.data[start: start + 20]
+
+    #Same lookup as GitPack.position: the fanout table, then a binary search.
+    def position(self, sha):
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.sha_at(mid)
+            if cur == sha:
+                return mid
+            if cur < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def tree_at(self, i):
+        start = self.cdat + CDAT_SIZE * i
+        return self.data[start: start + 20]
+
+    #Positions of the parents of the commit at position i.
+    def parents_at(self, i):
+        start = self.cdat + CDAT_SIZE * i + 20
+        first = int.from_bytes(self.data[start: start+4], "big")
+        second = int.from_bytes(self.data[start+4: start+8], "big")
+        if first == PARENT_NONE:
+            return []
+        if second == PARENT_NONE:
+            return [ first ]
+        if not second & PARENT_EXTRA:
+            return [ first, second ]
+
+        ret = [ first ]
+        pos = self.edge + 4 * (second & ~PARENT_EXTRA)
+        while True:
+            value = int.from_bytes(self.data[pos: pos+4], "big")
+            ret.append(value & ~PARENT_EXTRA)
+            if value & PARENT_EXTRA:
+                return ret
+            pos += 4
+
+    #(generation number, commit time) of the commit at position i.
+    def generation_time_at(self, i):
+        start = self.cdat + CDAT_SIZE * i + 28
+        high = int.from_bytes(self.data[start: start+4], "big")
+        low = int.from_bytes(self.data[start+4: start+8], "big")
+        return high >> 2, ((high & 3) << 32) | low
+
+    #Everything we know about a commit, given its hex SHA: (tree, parents, generation, time),
+    #SHAs in hex. None if the commit isn't in the graph.
+    def lookup(self, sha):
+        i = self.position(bytes.fromhex(sha))
+        if i is None:
+            return None
+        generation, time = self.generation_time_at(i)
+        parents = [ self.sha_at(p).hex() for p in self.parents_at(i) ]
+        return self.tree_at(i).hex(), parents, generation, time
+
+#The graph is cached for the whole process, and opened again when the file changes.
+_graphs = dict()
+
+def commit_graph_path(repo):
+    return gitRepo.repo_path(repo, "objects", "info", "commit-graph")
+
+def commit_graph_open(repo):
+    path = commit_graph_path(repo)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    cached = _graphs.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    if cached and cached[1]:
+        cached[1].close()
+
+    graph = GitCommitGraph(path) if mtime is not None else None
+    _graphs[path] = (mtime, graph)
+    return graph
+
+def commit_graph_lookup(repo, sha):
+    graph = commit_graph_open(repo)
+    if graph is None:
+        return None
+    return graph.lookup(sha)
+
+"""Writing the commit-graph section"""
+
+#commits maps the hex SHA of every commit to (tree, parents, commit time). Every parent must be
+#in commits as well. Returns the path of the new commit-graph.
+def commit_graph_write(repo, commits):
+    # Only writing needs tempfile, which is slow to import (see gitUtil).
+    import tempfile
+    shas = sorted(commits)
+    positions = { sha: i for i, sha in enumerate(shas) }
+
+    # Generation numbers, computed parents first without recursion: history can be much deeper
+    # than Python's stack.
+    generations = dict()
+    for sha in shas:
+        todo = [ sha ]
+        while todo:
+            current = todo[-1]
+            if current in generations:
+                todo.pop()
+                continue
+            parents = commits[current][1]
+            missing = [ p for p in parents if p not in generations ]
+            if missing:
+                for p in missing:
+                    if p not in commits:
+                        raise Exception("Commit {0} is missing from the commit-graph".format(p))
+                todo.extend(missing)
+                continue
+            generations[current] = min(GENERATION_MAX, 1 + max((generations[p] for p in parents), default=0))
+            todo.pop()
+
+    oidf = bytearray()
+    first_bytes = [ int(sha[0:2], 16) for sha in shas ]
+    count = 0
+    for b in range(256):
+        while count < len(shas) and first_bytes[count] <= b:
+            count += 1
+        oidf += count.to_bytes(4, "big")
+
+    oidl = b''.join(bytes.fromhex(sha) for sha in shas)
+
+    cdat = bytearray()
+    edge = bytearray()
+    for sha in shas:
+        tree, parents, time = commits[sha]
+        parents = [ positions[p] for p in parents ]
+        cdat += bytes.fromhex(tree)
+        if not parents:
+            cdat += PARENT_NONE.to_bytes(4, "big") + PARENT_NONE.to_bytes(4, "big")
+        elif len(parents) == 1:
+            cdat += parents[0].to_bytes(4, "big") + PARENT_NONE.to_bytes(4, "big")
+        elif len(parents) == 2:
+            cdat += parents[0].to_bytes(4, "big") + parents[1].to_bytes(4, "big")
+        else:
+            cdat += parents[0].to_bytes(4, "big") + (PARENT_EXTRA | len(edge) // 4).to_bytes(4, "big")
+            for k, p in enumerate(parents[1:]):
+                last = PARENT_EXTRA if k == len(parents) - 2 else 0
+                edge += (p | last).to_bytes(4, "big")
+        time = max(0, min(time, (1 << 34) - 1))
+        cdat += ((generations[sha] << 2) | (time >> 32)).to_bytes(4, "big")
+        cdat += (time & 0xffffffff).to_bytes(4, "big")
+
+    chunks = [ (b'OIDF', bytes(oidf)), (b'OIDL', oidl), (b'CDAT', bytes(cdat)) ]
+    if edge:
+        chunks.append((b'EDGE', bytes(edge)))
+
+    out = bytearray(SIGNATURE + bytes([ VERSION, HASH_VERSION, len(chunks), 0 ]))
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk_id, data in chunks:
+        out += chunk_id + offset.to_bytes(8, "big")
+        offset += len(data)
+    out += b'\x00\x00\x00\x00' + offset.to_bytes(8, "big")
+    for _, data in chunks:
+        out += data
+    out += hashlib.sha1(out).digest()
+
+    path = commit_graph_path(repo)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix="tmp_graph_")
+    with os.fdopen(fd, "wb") as f:
+        f.write(out)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+    return path
+
+"""End of writing the commit-graph section"""
@@ -1,79 +1,166 @@
 import argparse
 
-argparser = argparse.ArgumentParser(description="The content tracker")
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
+"""
+The command line parser. Each command's arguments are added by its own function, and only the
+command being run gets them: building the arguments of every command would take longer than
+most commands take to run. The list of commands is complete, so help still shows them all.
+"""
+
+#Options with an optional value, like git's --abbrev[=n]. Given nargs="?", argparse takes the
+#next argument as the value, even when it's a positional one ("ls-tree --abbrev HEAD"): so the
+#bare option is given an empty value instead ("--abbrev="), which its type turns into the default.
+#Like with git, a value must then be given with "=".
+OPTIONAL_VALUE = ("--abbrev",)
+
+#Short hashes have at least 4 digits, and at most 40.
+ABBREV_DEFAULT = 7
+
+def abbrev_length(value):
+    if not value:
+        return ABBREV_DEFAULT
+    return max(4, min(40, int(value)))
 
 #For init
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
-argsp.add_argument("path",
-                   metavar="directory",
-                   nargs="?",
-                   default=".",
-                   help="Where to create the repository.")
+def args_init(argsp):
+    argsp.add_argument("path",
+                       metavar="directory",
+                       nargs="?",
+                       default=".",
+                       help="Where to create the repository.")
 
 #For cat-file
-argsp = argsubparsers.add_parser("cat-file",
-                                 help="Provide content of repository objects")
-
-argsp.add_argument("type",
-                   metavar="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   help="Specify the type")
-
-argsp.add_argument("object",
-                   metavar="object",
-                   help="The object to display")
+def args_cat_file(argsp):
+    # Not restricted by choices: with -t or -s, the only argument is the object.
+    argsp.add_argument("type",
+                       metavar="type",
+                       nargs="?",
+                       help="Specify the type (blob, commit, tag or tree)")
+
+    argsp.add_argument("object",
+                       metavar="object",
+                       nargs="?",
+                       help="The object to display")
+
+    info = argsp.add_mutually_exclusive_group()
+    info.add_argument("-t",
+                      dest="show_type",
+                      action="store_true",
+                      help="Show the type of the object instead of its contents.")
+    info.add_argument("-s",
+                      dest="show_size",
+                      action="store_true",
+                      help="Show the size of the object instead of its contents.")
+
+    argsp.add_argument("--batch",
+                       action="store_true",
+                       help="Read object names from stdin, and print the type, size and contents of each.")
+
+    argsp.add_argument("--batch-check",
+                       dest="batch_check",
+                       action="store_true",
+                       help="Read object names from stdin, and print the type and size of each.")
+
+    argsp.add_argument("--flush",
+                       action="store_true",
+                       help="In batch mode, flush the output after each object instead of buffering it.")
 
 #For hash-object
-argsp = argsubparsers.add_parser(
-    "hash-object",
-    help="Compute object ID and optionally creates a blob from a file")
-
-argsp.add_argument("-t",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default="blob",
-                   help="Specify the type")
-
-argsp.add_argument("-w",
-                   dest="write",
-                   action="store_true",
-                   help="Actually write the object into the database")
-
-argsp.add_argument("path",
-                   help="Read object from <file>")
+def args_hash_object(argsp):
+    argsp.add_argument("-t",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default="blob",
+                       help="Specify the type")
+
+    argsp.add_argument("-w",
+                       dest="write",
+                       action="store_true",
+                       help="Actually write the object into the database")
+
+    argsp.add_argument("path",
+                       help="Read object from <file>")
 
 #For log: commit history
-argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
-argsp.add_argument("commit",
-                   default="HEAD",
-                   nargs="?",
-                   help="Commit to start at.")
+def args_log(argsp):
+    argsp.add_argument("commit",
+                       default="HEAD",
+                       nargs="?",
+                       help="Commit to start at.")
+    argsp.add_argument("-n", "--max-count",
+                       metavar="n",
+                       dest="max_count",
+                       type=int,
+                       default=None,
+                       help="Show at most n commits.")
+    argsp.add_argument("--since",
+                       metavar="date",
+                       default=None,
+                       help="Only show commits more recent than date (eg 2024-01-31, or \"2 weeks ago\").")
+    argsp.add_argument("--topo-order",
+                       dest="topo_order",
+                       action="store_true",
+                       help="Never show a commit before its children.")
+    argsp.add_argument("--oneline",
+                       action="store_true",
+                       help="One line per commit, instead of a Graphviz graph.")
+    argsp.add_argument("--abbrev",
+                       metavar="n",
+                       nargs="?",
+                       type=abbrev_length,
+                       const=ABBREV_DEFAULT,
+                       default=ABBREV_DEFAULT,
+                       help="Show commits by at least n (default 7, given as --abbrev=n) digits of their hash, more if needed to be unambiguous.")
 
 #For ls-tree command
-
-argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
-argsp.add_argument("-r",
-                   dest="recursive",
-                   action="store_true",
-                   help="Recurse into sub-trees")
-
-argsp.add_argument("tree",
-                   help="A tree-ish object.")
+def args_ls_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    argsp.add_argument("-l", "--long",
+                       dest="long",
+                       action="store_true",
+                       help="Show the size of blobs.")
+
+    argsp.add_argument("--abbrev",
+                       metavar="n",
+                       nargs="?",
+                       type=abbrev_length,
+                       const=ABBREV_DEFAULT,
+                       default=None,
+                       help="Show object names by at least n (default 7, given as --abbrev=n) digits, more if needed to be unambiguous.")
+
+    argsp.add_argument("tree",
+                       help="A tree-ish object.")
 
 #For the git checkout command
-argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
+def args_checkout(argsp):
+    argsp.add_argument("commit",
+                       help="The commit or tree to checkout.")
 
-argsp.add_argument("commit",
-                   help="The commit or tree to checkout.")
+    argsp.add_argument("path",
+                       help="The EMPTY directory to checkout on.")
 
-argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+    argsp.add_argument("-j", "--jobs",
+                       metavar="n",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Number of files written in parallel (default: number of CPUs, 1 means serial).")
 
 #For the show-ref command
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
+def args_show_ref(argsp):
+    argsp.add_argument("-d", "--dereference",
+                       action="store_true",
+                       help="Also show what annotated tags point to, as name^{}.")
+
+#For the pack-refs command
+def args_pack_refs(argsp):
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Pack every ref, not only tags.")
 
 #For the tag command: 
 #git tag                   List all tags
@@ -81,65 +168,179 @@ argsp = argsubparsers.add_parser("show-ref", help="List references.")
 #                          at HEAD (default) or OBJECT
 #git tag -a NAME [OBJECT]  create a new tag *object* NAME, pointing at
 #                          HEAD (default) or OBJECT
-argsp = argsubparsers.add_parser(
-    "tag",
-    help="List and create tags")
-
-argsp.add_argument("-a",
-                   action="store_true",
-                   dest="create_tag_object",
-                   help="Whether to create a tag object")
-
-argsp.add_argument("name",
-                   nargs="?",
-                   help="The new tag's name")
-
-argsp.add_argument("object",
-                   default="HEAD",
-                   nargs="?",
-                   help="The object the new tag will point to")
+def args_tag(argsp):
+    argsp.add_argument("-a",
+                       action="store_true",
+                       dest="create_tag_object",
+                       help="Whether to create a tag object")
+
+    argsp.add_argument("name",
+                       nargs="?",
+                       help="The new tag's name")
+
+    argsp.add_argument("object",
+                       default="HEAD",
+                       nargs="?",
+                       help="The object the new tag will point to")
+
+#For the commit-graph command
+def args_commit_graph(argsp):
+    argsp.add_argument("action",
+                       choices=["write"],
+                       help="write: store every reachable commit in .git/objects/info/commit-graph")
+
+#For the repack command, also available as gc. It writes every reachable object into a
+#single pack and removes the loose copies.
+def args_repack(argsp):
+    argsp.add_argument("--window-memory",
+                       metavar="size",
+                       dest="window_memory",
+                       default=None,
+                       help="Memory budget of the pack writer, eg 64m (default: pack.windowMemory, or 256m)")
+
+    argsp.add_argument("--window",
+                       metavar="n",
+                       dest="window",
+                       type=int,
+                       default=None,
+                       help="How many objects to try as delta bases (default: pack.window, or 10)")
+
+    argsp.add_argument("--depth",
+                       metavar="n",
+                       dest="depth",
+                       type=int,
+                       default=None,
+                       help="Maximum length of delta chains (default: pack.depth, or 50)")
+
+#For rev-list: commits (or objects) reachable from some revisions but not from others.
+def args_rev_list(argsp):
+    argsp.add_argument("--objects",
+                       action="store_true",
+                       help="List every reachable object, not only commits.")
+    argsp.add_argument("--count",
+                       action="store_true",
+                       help="Only print how many there are.")
+    argsp.add_argument("revs",
+                       nargs="+",
+                       metavar="rev",
+                       help="Revisions to start from. ^rev excludes everything reachable from rev.")
 
 #For the clone of git rev-parse
 #For the purpose of further testing the “follow” feature of object_find, 
 #we’ll add an optional wyag-type argument to its interface.
-argsp = argsubparsers.add_parser(
-    "rev-parse",
-    help="Parse revision (or other objects) identifiers")
+def args_rev_parse(argsp):
+    argsp.add_argument("--wyag-type",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default=None,
+                       help="Specify the expected type")
 
-argsp.add_argument("--wyag-type",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default=None,
-                   help="Specify the expected type")
-
-argsp.add_argument("name",
-                   help="The name to parse")
+    argsp.add_argument("name",
+                       help="The name to parse")
 
 #For ls-files command
-argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
-argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+def args_ls_files(argsp):
+    argsp.add_argument("--verbose", action="store_true", help="Show everything.")
 
 #For check-ignore command
-argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
-argsp.add_argument("path", nargs="+", help="Paths to check")
+def args_check_ignore(argsp):
+    argsp.add_argument("path", nargs="+", help="Paths to check")
 
 #For the status command
-argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
+def args_status(argsp):
+    argsp.add_argument("--refresh",
+                       action="store_true",
+                       help="Write back the stat data of files that were touched but not changed.")
+
+#For the update-index command
+def args_update_index(argsp):
+    argsp.add_argument("--refresh",
+                       action="store_true",
+                       help="Record the stat data of files that were touched but not changed.")
+    argsp.add_argument("-q", "--quiet",
+                       action="store_true",
+                       help="Don't list the files that changed.")
+
+#For the fsmonitor command, which runs the filesystem monitor used by status when
+#core.fsmonitor is set.
+def args_fsmonitor(argsp):
+    argsp.add_argument("action",
+                       choices=["run", "stop"],
+                       help="run: watch the worktree (in the foreground), stop: stop the running watcher")
+
+#For the serve command
+def args_serve(argsp):
+    argsp.add_argument("action",
+                       choices=["run", "stop"],
+                       help="run: answer requests on .git/wyag.sock (in the foreground), stop: stop the running server")
 
 #For the rm command
-argsp = argsubparsers.add_parser("rm", help="Remove files from the working tree and the index.")
-argsp.add_argument("path", nargs="+", help="Files to remove")
+def args_rm(argsp):
+    argsp.add_argument("path", nargs="+", help="Files to remove")
 
 #For the add command
-argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
-argsp.add_argument("path", nargs="+", help="Files to add")
+def args_add(argsp):
+    argsp.add_argument("path", nargs="+", help="Files to add")
+    argsp.add_argument("-j", "--jobs",
+                       metavar="n",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Number of files hashed in parallel (default: number of CPUs, or 1 for a few small files; 1 means serial).")
 
 #For the commit command
-argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
-
-argsp.add_argument("-m",
-                   metavar="message",
-                   dest="message",
-                   help="Message to associate with this commit.")
-
+def args_commit(argsp):
+    argsp.add_argument("-m",
+                       metavar="message",
+                       dest="message",
+                       help="Message to associate with this commit.")
+
+#Every command: (name, aliases, help, and the function adding its arguments).
+COMMANDS = [ ("init", [], "Initialize a new, empty repository.", args_init),
+             ("cat-file", [], "Provide content of repository objects", args_cat_file),
+             ("hash-object", [], "Compute object ID and optionally creates a blob from a file", args_hash_object),
+             ("log", [], "Display history of a given commit.", args_log),
+             ("ls-tree", [], "Pretty-print a tree object.", args_ls_tree),
+             ("checkout", [], "Checkout a commit inside of a directory.", args_checkout),
+             ("show-ref", [], "List references.", args_show_ref),
+             ("pack-refs", [], "Move loose refs into packed-refs.", args_pack_refs),
+             ("tag", [], "List and create tags", args_tag),
+             ("commit-graph", [], "Write the commit-graph file.", args_commit_graph),
+             ("repack", ["gc"], "Pack reachable objects and prune the packed loose objects.", args_repack),
+             ("rev-list", [], "List commits reachable from revisions, most recent first.", args_rev_list),
+             ("rev-parse", [], "Parse revision (or other objects) identifiers", args_rev_parse),
+             ("ls-files", [], "List all the stage files", args_ls_files),
+             ("check-ignore", [], "Check path(s) against ignore rules.", args_check_ignore),
+             ("status", [], "Show the working tree status.", args_status),
+             ("update-index", [], "Refresh the stat data of the index.", args_update_index),
+             ("fsmonitor", [], "Run or stop the filesystem monitor.", args_fsmonitor),
+             ("serve", [], "Run or stop the repository server.", args_serve),
+             ("rm", [], "Remove files from the working tree and the index.", args_rm),
+             ("add", [], "Add files contents to the index.", args_add),
+             ("commit", [], "Record changes to the repository.", args_commit) ]
+
+#Build the parser for argv: every command is known, but only the one in argv gets its
+#arguments.
+def argparser_build(argv):
+    argparser = argparse.ArgumentParser(description="The content tracker")
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True
+
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+    for name, aliases, help, add_arguments in COMMANDS:
+        argsp = argsubparsers.add_parser(name, aliases=aliases, help=help)
+        if command == name or command in aliases:
+            add_arguments(argsp)
+    return argparser
+
+#Parse argv (see argparser_build). Options of OPTIONAL_VALUE given without a value are rewritten
+#first; arguments after "--" are left alone.
+def args_parse(argv):
+    rewritten = list()
+    for i, arg in enumerate(argv):
+        if arg == "--":
+            rewritten.extend(argv[i:])
+            break
+        rewritten.append(arg + "=" if arg in OPTIONAL_VALUE else arg)
+    return argparser_build(rewritten).parse_args(rewritten)
@@ -0,0 +1,160 @@
+"""
+A delta describes an object (the target) as a list of instructions applied on another object
+(the source, or base). This is how packs stay small: most versions of a file are tiny edits of
+another version, so storing the instructions is much cheaper than storing the whole file.
+
+The format is git's:
+    _The size of the source, then the size of the target, both as little-endian base-128 varints.
+    _A series of instructions:
+        *Copy: the first byte has its high bit set. Its 4 low bits tell which of the (up to) 4
+         following bytes hold the offset in the source, and the 3 next bits which of the (up to)
+         3 following bytes hold the size to copy. A size of 0 means 0x10000.
+        *Insert: the first byte is the number of literal bytes (1 to 127) that follow it.
+"""
+
+# Size of the blocks of the source we index to find matches.
+BLOCK = 16
+# Largest copy we emit in one instruction.
+MAX_COPY = 0x10000
+# Largest insert we can emit in one instruction.
+MAX_INSERT = 0x7f
+
+def varint_encode(n):
+    ret = bytearray()
+    while True:
+        c = n & 0x7f
+        n >>= 7
+        if n:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return bytes(ret)
+
+def varint_decode(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        n |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, n
+
+#The index maps every BLOCK-aligned block of the source to its (first) offset. Building it
+#is the expensive part of creating a delta, so the pack writer computes it once per base.
+def delta_index(source):
+    index = dict()
+    for i in range(0, len(source) - BLOCK + 1, BLOCK):
+        index.setdefault(source[i:i+BLOCK], i)
+    return index
+
+#How many bytes match between source[s:] and target[t:]. We compare big slices first,
+#and only go byte by byte at the very end.
+def match_length(source, s, target, t):
+    length = 0
+    step = 4096
+    while step:
+        while s + length + step <= len(source) and t + length + step <= len(target) \
+              and source[s+length: s+length+step] == target[t+length: t+length+step]:
+            length += step
+        step //= 8
+    while s + length < len(source) and t + length < len(target) and source[s+length] == target[t+length]:
+        length += 1
+    return length
+
+def delta_create(source, target, index=None):
+    if index is None:
+        index = delta_index(source)
+
+    out = bytearray(varint_encode(len(source)) + varint_encode(len(target)))
+    insert = bytearray()
+    i = 0
+    n = len(target)
+
+    while i < n:
+        start = index.get(target[i:i+BLOCK]) if i + BLOCK <= n else None
+        if start is None:
+            insert.append(target[i])
+            i += 1
+            if len(insert) == MAX_INSERT:
+                delta_insert(out, insert)
+            continue
+
+        length = match_length(source, start, target, i)
+        # The match may also extend backwards, over bytes we were about to insert.
+        while insert and start > 0 and source[start-1] == insert[-1]:
+            insert.pop()
+            start -= 1
+            i -= 1
+            length += 1
+
+        delta_insert(out, insert)
+        delta_copy(out, start, length)
+        i += length
+
+    delta_insert(out, insert)
+    return bytes(out)
+
+def delta_insert(out, insert):
+    if insert:
+        out.append(len(insert))
+        out += insert
+        insert.clear()
+
+def delta_copy(out, offset, size):
+    while size:
+        n = min(size, MAX_COPY)
+        op = 0x80
+        args = bytearray()
+        for k in range(4):
+            b = (offset >> (8 * k)) & 0xff
+            if b:
+                op |= 1 << k
+                args.append(b)
+        for k in range(3):
+            b = (n >> (8 * k)) & 0xff
+            if b:
+                op |= 0x10 << k
+                args.append(b)
+        out.append(op)
+        out += args
+        offset += n
+        size -= n
+
+def delta_apply(source, delta):
+    pos, src_size = varint_decode(delta, 0)
+    pos, trg_size = varint_decode(delta, pos)
+    if src_size != len(source):
+        raise Exception("Malformed delta: base is {0} bytes, expected {1}".format(len(source), src_size))
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = 0
+            for k in range(4):
+                if op & (1 << k):
+                    offset |= delta[pos] << (8 * k)
+                    pos += 1
+            size = 0
+            for k in range(3):
+                if op & (0x10 << k):
+                    size |= delta[pos] << (8 * k)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            if offset + size > src_size:
+                raise Exception("Malformed delta: copy out of the base")
+            out += source[offset: offset+size]
+        elif op:
+            out += delta[pos: pos+op]
+            pos += op
+        else:
+            raise Exception("Malformed delta: unexpected opcode 0")
+
+    if len(out) != trg_size:
+        raise Exception("Malformed delta: result is {0} bytes, expected {1}".format(len(out), trg_size))
+    return bytes(out)
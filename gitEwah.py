@@ -0,0 +1,96 @@
+"""
+EWAH is the compressed bitmap format git uses in the index (FSMN extension) and in reachability
+bitmaps. A bitmap is a list of 64-bit words; long runs of words that are all zeros or all ones
+are replaced by a single "running length word" (RLW), which is followed by the literal words
+that come after the run:
+    _bit 0 of the RLW is the bit the run is made of,
+    _bits 1 to 32 are the length of the run, in words,
+    _bits 33 to 63 are the number of literal words following the RLW.
+
+Serialized, a bitmap is (all big-endian): the number of bits (4 bytes), the number of words
+(4 bytes), the words themselves (8 bytes each), and the position of the last RLW (4 bytes).
+
+In memory, we simply use Python integers as bitsets: bit i of the bitmap is bit i of the
+integer, which gives us fast OR, AND and NOT for free.
+"""
+
+WORD = 64
+FULL = (1 << WORD) - 1
+MAX_RUN = (1 << 32) - 1
+MAX_LITERALS = (1 << 31) - 1
+
+def ewah_encode(bits, bit_size):
+    nwords = (bit_size + WORD - 1) // WORD
+    raw = bits.to_bytes(nwords * 8, "little")
+    words = [ int.from_bytes(raw[8*i: 8*i + 8], "little") for i in range(nwords) ]
+
+    buffer = list()
+    rlw = 0
+    i = 0
+    while i < nwords or not buffer:
+        run_bit = 0
+        run = 0
+        if i < nwords and words[i] in (0, FULL):
+            run_bit = 1 if words[i] == FULL else 0
+            while i < nwords and words[i] == (FULL if run_bit else 0) and run < MAX_RUN:
+                run += 1
+                i += 1
+        literals = list()
+        while i < nwords and words[i] not in (0, FULL) and len(literals) < MAX_LITERALS:
+            literals.append(words[i])
+            i += 1
+        rlw = len(buffer)
+        buffer.append(run_bit | (run << 1) | (len(literals) << 33))
+        buffer.extend(literals)
+
+    out = bytearray()
+    out += bit_size.to_bytes(4, "big")
+    out += len(buffer).to_bytes(4, "big")
+    for w in buffer:
+        out += w.to_bytes(8, "big")
+    out += rlw.to_bytes(4, "big")
+    return bytes(out)
+
+#Decode the bitmap serialized at data[pos:], and return (bits, bit_size, position after it).
+def ewah_decode(data, pos=0):
+    bit_size = int.from_bytes(data[pos: pos+4], "big")
+    nwords = int.from_bytes(data[pos+4: pos+8], "big")
+    pos += 8
+
+    # The words of the bitmap, little-endian, so that we can turn them into an integer at once.
+    raw = bytearray()
+    end = pos + 8 * nwords
+    while pos < end:
+        rlw = int.from_bytes(data[pos: pos+8], "big")
+        pos += 8
+        run = (rlw >> 1) & 0xffffffff
+        literals = rlw >> 33
+        raw += (b'\xff' if rlw & 1 else b'\x00') * (8 * run)
+        for k in range(literals):
+            raw += data[pos: pos+8][::-1]
+            pos += 8
+
+    # Skip the position of the last RLW.
+    pos += 4
+    # Runs of ones may go past the last bit.
+    bits = int.from_bytes(raw, "little") & ((1 << bit_size) - 1)
+    return bits, bit_size, pos
+
+#Positions of the bits set in a bitset, in increasing order.
+def bits_positions(bits):
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    ret = list()
+    for i, b in enumerate(raw):
+        while b:
+            low = b & -b
+            ret.append(8 * i + low.bit_length() - 1)
+            b ^= low
+    return ret
+
+def bits_from_positions(positions):
+    raw = bytearray()
+    for p in positions:
+        if p >> 3 >= len(raw):
+            raw.extend(bytes((p >> 3) + 1 - len(raw)))
+        raw[p >> 3] |= 1 << (p & 7)
+    return int.from_bytes(raw, "little")
@@ -0,0 +1,312 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
+import socket
+import struct
+import time
+import gitRepo
+
+"""
+status has to stat every file of the index to know whether it changed, which gets slow on huge
+worktrees. A filesystem monitor is a long-running process that watches the worktree and
+remembers which paths changed. status then asks it "what changed since token X?", and only looks
+at these paths.
+
+The watcher uses Linux's inotify, and answers queries on a Unix socket in the git directory.
+A query is a token followed by a newline; the answer is the new token, then the changed paths,
+each terminated by a NUL byte. Directories end with a slash, and a single "/" instead of the
+paths means "I don't know, look at everything": this is the answer to an empty token, a token
+from another run of the watcher, or a token older than the history it still keeps.
+
+To be sure it has seen every event that happened before a query, the watcher creates a cookie
+file in the git directory and waits for inotify to report it before answering. If the cookie
+doesn't show up in time, some events may not have been read yet, and the answer is "/".
+
+A directory the watcher couldn't watch (there is a per-user limit on watches, and directories
+we can't read can't be watched either) is a hole in the history: nothing that happens in it is
+seen. The watcher keeps a list of these directories and answers "/" as long as it isn't empty,
+trying again to watch them at each query. Once they are all watched, it starts a new history,
+since the changes made in them before are lost.
+"""
+
+SOCKET = "fsmonitor.sock"
+COOKIE_PREFIX = "fsmonitor-cookie-"
+
+# Past this many distinct changed paths, the watcher forgets its history.
+MAX_CHANGES = 1000000
+# How long we wait for a cookie, in seconds.
+SYNC_TIMEOUT = 5
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+             | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT = struct.Struct("iIII")
+
+class GitFsmonitor(object):
+    def __init__(self, repo):
+        self.repo = repo
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if not self.libc or not hasattr(self.libc, "inotify_init1"):
+            raise Exception("The filesystem monitor needs inotify (Linux)")
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        # Watch descriptor -> directory, relative to the worktree ("" is the root).
+        self.watches = dict()
+        # Changed path -> sequence number of its last change.
+        self.changes = dict()
+        self.seq = 0
+        self.cookie = 0
+        self.seen_cookies = set()
+        # Directories we failed to watch: relative path (None for the git directory) -> full path.
+        self.unwatched = dict()
+        self.reset()
+
+        self.watch(self.repo.gitdir, None)
+        self.watch_tree("")
+
+    #Start a new history: every token given out before is now too old.
+    def reset(self):
+        self.epoch = "{0}.{1}".format(os.getpid(), time.time_ns())
+        self.changes.clear()
+        self.first_seq = self.seq
+
+    def token(self):
+        return "{0}:{1}".format(self.epoch, self.seq)
+
+    def watch(self, path, rel):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = rel
+        else:
+            self.unwatchable(path, rel, ctypes.get_errno())
+
+    #A directory that disappeared before we got to it is fine: its parent saw it go. Any other
+    #failure leaves a directory whose changes we won't see.
+    def unwatchable(self, path, rel, error):
+        if error in (errno.ENOENT, errno.ENOTDIR):
+            return
+        self.unwatched[rel] = path
+        self.reset()
+
+    #Try again to watch the directories we couldn't. Returns whether every directory is watched.
+    def watch_missing(self):
+        if not self.unwatched:
+            return True
+        missing = self.unwatched
+        self.unwatched = dict()
+        for rel, path in missing.items():
+            if rel is None:
+                self.watch(path, None)
+            else:
+                # Directories may have been created in it while it wasn't watched.
+                self.watch_tree(rel)
+        if self.unwatched:
+            return False
+        # Changes made while they weren't watched are lost: tokens given until now are too old.
+        self.reset()
+        return True
+
+    def watch_tree(self, rel):
+        todo = [ rel ]
+        while todo:
+            rel = todo.pop()
+            full = os.path.join(self.repo.worktree, rel)
+            self.watch(full, rel)
+            try:
+                entries = list(os.scandir(full))
+            except OSError as e:
+                self.unwatchable(full, rel, e.errno)
+                continue
+            for f in entries:
+                if rel == "" and f.name == ".git":
+                    continue
+                if f.is_dir(follow_symlinks=False):
+                    todo.append(os.path.join(rel, f.name))
+
+    def changed(self, path):
+        self.seq += 1
+        self.changes[path] = self.seq
+        if len(self.changes) > MAX_CHANGES:
+            self.reset()
+
+    #Read and record every pending inotify event.
+    def read_events(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = EVENT.unpack_from(buf, pos)
+                name = os.fsdecode(buf[pos + EVENT.size: pos + EVENT.size + length].rstrip(b'\x00'))
+                pos += EVENT.size + length
+                self.event(wd, mask, name)
+
+    def event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # We lost events: we can't vouch for anything anymore.
+            self.reset()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        rel = self.watches.get(wd, "")
+        if rel is None:
+            # The git directory, where we only care about our own cookies.
+            if name.startswith(COOKIE_PREFIX):
+                self.seen_cookies.add(name)
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if rel == "":
+                # The worktree itself went away.
+                self.reset()
+            else:
+                self.changed(rel + "/")
+            return
+        path = os.path.join(rel, name)
+        if mask & IN_ISDIR:
+            self.changed(path + "/")
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+        else:
+            self.changed(path)
+
+    #Make sure every event that happened before now has been read. Returns False if we gave up
+    #waiting for them.
+    def sync(self):
+        self.cookie += 1
+        name = "{0}{1}-{2}".format(COOKIE_PREFIX, os.getpid(), self.cookie)
+        path = os.path.join(self.repo.gitdir, name)
+        with open(path, "w"):
+            pass
+        deadline = time.monotonic() + SYNC_TIMEOUT
+        try:
+            while name not in self.seen_cookies and time.monotonic() < deadline:
+                self.read_events()
+                if name not in self.seen_cookies:
+                    time.sleep(0.001)
+            return name in self.seen_cookies
+        finally:
+            self.seen_cookies.discard(name)
+            os.unlink(path)
+
+    def query(self, token):
+        if not self.watch_missing() or not self.sync():
+            return self.token(), None
+        epoch, _, seq = token.partition(":")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) < self.first_seq:
+            return self.token(), None
+        seq = int(seq)
+        return self.token(), sorted(p for p, s in self.changes.items() if s > seq)
+
+    def serve(self):
+        path = gitRepo.repo_path(self.repo, SOCKET)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.fd, selectors.EVENT_READ, "inotify")
+        sel.register(server, selectors.EVENT_READ, "server")
+        try:
+            while True:
+                for key, _ in sel.select():
+                    if key.data == "inotify":
+                        self.read_events()
+                    elif not self.answer(server.accept()[0]):
+                        return
+        finally:
+            sel.close()
+            server.close()
+            os.unlink(path)
+            os.close(self.fd)
+
+    #Answer one client. Returns False when asked to quit.
+    def answer(self, conn):
+        with conn:
+            request = b''
+            while not request.endswith(b'\n'):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return True
+                request += chunk
+            token = request[:-1].decode("utf8")
+            if token == "quit":
+                conn.sendall(b'bye\x00')
+                return False
+            new_token, paths = self.query(token)
+            out = new_token.encode("utf8") + b'\x00'
+            if paths is None:
+                out += b'/\x00'
+            else:
+                out += b''.join(os.fsencode(p) + b'\x00' for p in paths)
+            conn.sendall(out)
+        return True
+
+"""Client section"""
+
+def fsmonitor_request(repo, message):
+    path = gitRepo.repo_path(repo, SOCKET)
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            s.sendall(message.encode("utf8") + b'\n')
+            out = list()
+            while True:
+                chunk = s.recv(64 * 1024)
+                if not chunk:
+                    break
+                out.append(chunk)
+    except OSError:
+        # No watcher behind the socket.
+        return None
+    return b''.join(out).split(b'\x00')[:-1]
+
+#Ask the watcher what changed since token. Returns (new token, changed files, changed
+#directories), or (new token, None, None) if we have to look at everything, or None if no
+#watcher is running.
+def fsmonitor_query(repo, token):
+    answer = fsmonitor_request(repo, token or "")
+    if not answer:
+        return None
+    new_token = answer[0].decode("utf8")
+    paths = [ os.fsdecode(p) for p in answer[1:] ]
+    if paths == ["/"]:
+        return new_token, None, None
+    files = set(p for p in paths if not p.endswith("/"))
+    dirs = set(p[:-1] for p in paths if p.endswith("/"))
+    return new_token, files, dirs
+
+def fsmonitor_stop(repo):
+    return fsmonitor_request(repo, "quit") is not None
+
+"""End of client section"""
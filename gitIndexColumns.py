@@ -0,0 +1,125 @@
+import os
+
+"""
+A columnar view of the index, for commands that look at the stat data of every entry. Instead of
+one GitIndexEntry object per entry, each fixed-width field of the entries (ctime, mtime, device,
+inode, mode, size, SHA...) is a column of a NumPy structured array, and names are a separate list.
+Comparing the whole index to the worktree is then a handful of operations on whole columns,
+rather than a Python loop building nanosecond integers for each entry.
+
+The columns are gathered straight from the memory-mapped index file (see gitIndexFile), while
+index_read has it open: the offset table tells where each entry starts. Entries have variable
+sizes, but their 62-byte headers are all windows of the file, so a strided view of the file as
+"every 62-byte window, starting at each byte" costs nothing, and picking the rows of that view
+at the offsets of the entries copies their headers into the array in one operation.
+
+Stat data still has to be read one file at a time. What the columns save is everything around
+it: the comparisons are done on whole columns, and only the entries that may have changed are
+looked at one by one afterwards.
+
+NumPy is optional: without it, available() is False and callers keep the pure Python path. It
+takes longer to import than most commands take to run, so it is only imported by available().
+"""
+
+# Below this many entries, importing NumPy and building the columns costs more than it saves
+# (see "benchmark.py status").
+COLUMNS_MIN = 30000
+
+numpy = None
+ENTRY_DTYPE = None
+STAT_DTYPE = None
+# Whether importing NumPy worked, once we tried.
+_loaded = None
+
+def available():
+    global numpy, ENTRY_DTYPE, STAT_DTYPE, _loaded
+    if _loaded is not None:
+        return _loaded
+    try:
+        import numpy
+    except ImportError:
+        _loaded = False
+        return False
+
+    # Same layout as gitIndexFile.ENTRY. Fields are big-endian, like in the file.
+    ENTRY_DTYPE = numpy.dtype([ ("ctime_s", ">u4"), ("ctime_ns", ">u4"),
+                                ("mtime_s", ">u4"), ("mtime_ns", ">u4"),
+                                ("dev", ">u4"), ("ino", ">u4"),
+                                ("unused", ">u2"), ("mode", ">u2"),
+                                ("uid", ">u4"), ("gid", ">u4"), ("size", ">u4"),
+                                ("sha", "S20"), ("flags", ">u2") ])
+
+    STAT_DTYPE = numpy.dtype([ ("present", "?"),
+                               ("ctime", "i8"), ("mtime", "i8"), ("size", "u8") ])
+    _loaded = True
+    return True
+
+class GitIndexColumns(object):
+    #Build the columns from an open gitIndexFile.GitIndexFile. names are the names of its
+    #entries, in order, which index_read already decoded.
+    def __init__(self, f, names):
+        if not available():
+            raise Exception("The columnar index needs NumPy")
+        f.scan()
+        self.names = names
+        offsets = numpy.asarray(f.offsets, dtype=numpy.intp)
+        size = ENTRY_DTYPE.itemsize
+        raw = numpy.frombuffer(f.view, dtype=numpy.uint8)
+        try:
+            windows = numpy.lib.stride_tricks.as_strided(raw, shape=(len(raw) - size + 1, size),
+                                                         strides=(1, 1), writeable=False)
+            rows = windows[offsets]
+        finally:
+            # The mapping can't be closed while an array still points into it.
+            raw = windows = None
+        self.entries = rows.view(ENTRY_DTYPE).reshape(len(names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def sha(self, i):
+        return self.entries["sha"][i].hex()
+
+    #Stat every file of the index, in the same order as the entries. Files that don't exist
+    #anymore have present set to False. Names are looked up from a descriptor of the worktree,
+    #which spares building every full path.
+    def stat(self, worktree):
+        rows = list()
+        stat = os.stat
+        missing = (False, 0, 0, 0)
+        if stat in os.supports_dir_fd:
+            fd = os.open(worktree, os.O_RDONLY)
+            paths = self.names
+        else:
+            fd = None
+            paths = [ os.path.join(worktree, name) for name in self.names ]
+        try:
+            for path in paths:
+                try:
+                    st = stat(path, dir_fd=fd)
+                except OSError:
+                    rows.append(missing)
+                    continue
+                rows.append((True, st.st_ctime_ns, st.st_mtime_ns, st.st_size))
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return numpy.array(rows, dtype=STAT_DTYPE)
+
+    #Positions of the entries that have to be looked at one by one: those whose file is missing,
+    #whose ctime, mtime or size differ from the index, and the racy ones, whose mtime isn't
+    #before index_mtime, the mtime of the index file in nanoseconds (see index_entry_racy). The
+    #same tests as status_index_worktree, done at once on every entry.
+    def dirty(self, stats, index_mtime=None):
+        e = self.entries
+        ctime = e["ctime_s"].astype(numpy.int64) * 10**9 + e["ctime_ns"]
+        mtime = e["mtime_s"].astype(numpy.int64) * 10**9 + e["mtime_ns"]
+        mask = (~stats["present"] | (stats["ctime"] != ctime) | (stats["mtime"] != mtime)
+                | ((stats["size"] & 0xffffffff) != e["size"]))
+        if index_mtime is not None:
+            mask |= mtime >= index_mtime
+        return numpy.flatnonzero(mask)
+
+    #Positions of the entries that may differ from the worktree, as a list.
+    def flagged(self, worktree, index_mtime=None):
+        return self.dirty(self.stat(worktree), index_mtime).tolist()
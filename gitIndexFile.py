@@ -0,0 +1,295 @@
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import gitSubObject
+
+"""
+A read-only view of an index file, mapped in memory and decoded lazily: opening it only reads
+the header, names are decoded when they're compared, and entries are only built when asked for.
+This is what commands that only look at a few entries use; index_read builds a whole GitIndex
+out of it when the index is going to be modified.
+
+The file holds a 12-byte header (the "DIRC" signature, the version and the number of entries),
+the entries, the extensions, and the SHA-1 of everything before it. Each entry is a fixed
+62-byte header followed by its name. We read versions 2 to 4 of the format:
+    _Version 3 adds extended flags: entries with the "extended" bit set have two more bytes of
+     flags after the first two, for skip-worktree and intent-to-add.
+    _Version 4 prefix-compresses names: instead of the full name, an entry holds the number of
+     bytes to drop from the end of the previous name (as a varint, in the same encoding as
+     OFS_DELTA offsets in packs), then the rest of the name, NUL-terminated. Since paths sorted
+     in a row share long prefixes, this makes deep trees much smaller. Entries aren't padded.
+
+Entries have a variable size, so finding the n-th one means walking the ones before it. The
+first random access does that walk once, only reading the two bytes of flags (and, in version 4,
+the names) of each entry, and keeps the offsets of the entries in a table.
+
+On big indexes, even that walk takes a while, so index_write saves the table in the file, in
+git's own format: an IEOT extension ("index entry offset table", a version then an (offset,
+number of entries) pair per block of entries) with blocks of a single entry, and an EOIE
+extension ("end of index entries") at the very end, which tells where the extensions start,
+and holds the SHA-1 of their headers. Git uses the same extensions to load blocks of entries
+in parallel. Version 4 can't use them: names in a block depend on the ones before it.
+"""
+
+VERSIONS = (2, 3, 4)
+
+HEADER = struct.Struct(">4sII")
+#ctime (seconds, nanoseconds), mtime (seconds, nanoseconds), device, inode, 16 unused bits,
+#mode, uid, gid, size, SHA-1 and flags.
+ENTRY = struct.Struct(">IIIIIIHHIII20sH")
+FLAGS = struct.Struct(">H")
+
+FLAG_ASSUME_VALID = 0x8000
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE = 0x3000
+NAME_MASK = 0x0fff
+EXTENDED_SKIP_WORKTREE = 0x4000
+EXTENDED_INTENT_TO_ADD = 0x2000
+EXTENDED_KNOWN = EXTENDED_SKIP_WORKTREE | EXTENDED_INTENT_TO_ADD
+
+# Indexes with fewer entries than this are quick enough to walk: they don't get an offset table.
+OFFSETS_MIN = 10000
+IEOT_VERSION = 1
+EOIE_SIZE = 4 + 20
+
+class GitIndexFile(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Files changed in the same instant the index was written are racy (see index_read).
+            self.mtime = os.fstat(f.fileno()).st_mtime_ns
+        self.view = memoryview(self.data)
+
+        signature, self.version, self.count = HEADER.unpack_from(self.view, 0)
+        if signature != b"DIRC": # Stands for "DirCache"
+            self.close()
+            raise Exception("Not an index file: {0}".format(path))
+        if self.version not in VERSIONS:
+            self.close()
+            raise Exception("Unsupported index file version {0}".format(self.version))
+
+        # Offset of each entry, and (version 4 only) their names. Built on first use.
+        self.offsets = None
+        self.names_v4 = None
+        # Offset of the first extension, right after the last entry.
+        self.end = None
+
+    def close(self):
+        self.view.release()
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    #Walk the entries once, to find where each of them starts.
+    def scan(self):
+        if self.offsets is not None:
+            return
+        if self.version < 4 and self.read_offsets():
+            return
+        offsets = array.array("Q")
+        data = self.data
+        flags_at = FLAGS.unpack_from
+        pos = HEADER.size
+
+        if self.version == 4:
+            names = list()
+            previous = b''
+            for i in range(self.count):
+                offsets.append(pos)
+                flags, = flags_at(data, pos + 60)
+                pos += 64 if flags & FLAG_EXTENDED else 62
+                c = data[pos]
+                pos += 1
+                strip = c & 0x7f
+                while c & 0x80:
+                    c = data[pos]
+                    pos += 1
+                    strip = ((strip + 1) << 7) | (c & 0x7f)
+                if strip > len(previous):
+                    raise Exception("Malformed index: name prefix longer than the previous name")
+                nul = data.find(b'\x00', pos)
+                previous = previous[:len(previous) - strip] + data[pos:nul]
+                names.append(previous)
+                pos = nul + 1
+            self.names_v4 = names
+        else:
+            for i in range(self.count):
+                offsets.append(pos)
+                flags, = flags_at(data, pos + 60)
+                header = 64 if flags & FLAG_EXTENDED else 62
+                length = flags & NAME_MASK
+                if length == NAME_MASK:
+                    # Names of 0xFFF bytes or more: look for the final NUL.
+                    length = data.find(b'\x00', pos + header + NAME_MASK) - pos - header
+                # At least one NUL, padded to a multiple of 8 bytes.
+                pos += (header + length + 8) & ~7
+
+        self.offsets = offsets
+        self.end = pos
+
+    #Load the offset table saved in the file, if there's one we can use.
+    def read_offsets(self):
+        data = self.data
+        eoie = len(data) - 20 - 8 - EOIE_SIZE
+        if eoie < HEADER.size or data[eoie: eoie+8] != b"EOIE" + EOIE_SIZE.to_bytes(4, "big"):
+            return False
+
+        # Walk the headers of the extensions up to EOIE, and check them against its hash.
+        start = int.from_bytes(data[eoie+8: eoie+12], "big")
+        pos = start
+        hash = hashlib.sha1()
+        table = None
+        while pos < eoie:
+            header = data[pos: pos+8]
+            size = int.from_bytes(header[4:8], "big")
+            hash.update(header)
+            if header[0:4] == b"IEOT":
+                table = data[pos+8: pos+8+size]
+            pos += 8 + size
+        if pos != eoie or hash.digest() != data[eoie+12: eoie+32] or table is None:
+            return False
+
+        # We only use tables with one entry per block.
+        if int.from_bytes(table[0:4], "big") != IEOT_VERSION or len(table) != 4 + 8 * self.count:
+            return False
+        pairs = array.array("I")
+        pairs.frombytes(table[4:])
+        if sys.byteorder == "little":
+            pairs.byteswap()
+        if pairs[1::2].count(1) != self.count:
+            return False
+
+        self.offsets = pairs[0::2]
+        self.end = start
+        return True
+
+    def name_bytes(self, i):
+        self.scan()
+        if self.names_v4 is not None:
+            return self.names_v4[i]
+        pos = self.offsets[i]
+        flags, = FLAGS.unpack_from(self.data, pos + 60)
+        start = pos + (64 if flags & FLAG_EXTENDED else 62)
+        length = flags & NAME_MASK
+        if length == NAME_MASK:
+            return self.data[start: self.data.find(b'\x00', start + NAME_MASK)]
+        return self.data[start: start + length]
+
+    def name(self, i):
+        return self.name_bytes(i).decode("utf8")
+
+    def names(self):
+        for i in range(self.count):
+            yield self.name(i)
+
+    def key(self, i):
+        self.scan()
+        flags, = FLAGS.unpack_from(self.data, self.offsets[i] + 60)
+        return (self.name_bytes(i), flags & FLAG_STAGE)
+
+    #Same as GitIndex.position: a binary search over the names of the entries.
+    def position(self, name):
+        key = (name.encode("utf8"), -1)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def get(self, name):
+        pos = self.position(name)
+        if pos < self.count and self.name(pos) == name:
+            return self[pos]
+        return None
+
+    def __contains__(self, name):
+        pos = self.position(name)
+        return pos < self.count and self.name(pos) == name
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        self.scan()
+        pos = self.offsets[i]
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, unused, mode,
+         uid, gid, fsize, sha, flags) = ENTRY.unpack_from(self.view, pos)
+        if unused != 0:
+            raise Exception("Malformed index entry at offset {0}".format(pos))
+
+        # The object type, either b1000 (regular), b1010 (symlink), b1110 (gitlink),
+        # and its permissions.
+        mode_type = mode >> 12
+        if mode_type not in (0b1000, 0b1010, 0b1110):
+            raise Exception("Malformed index: unknown mode {0:o}".format(mode))
+        mode_perms = mode & 0b0000000111111111
+
+        flag_skip_worktree = flag_intent_to_add = False
+        if flags & FLAG_EXTENDED:
+            if self.version < 3:
+                raise Exception("Extended flags in a version {0} index".format(self.version))
+            extended, = FLAGS.unpack_from(self.view, pos + 62)
+            if extended & ~EXTENDED_KNOWN:
+                raise Exception("Unknown extended flags in index: 0x{:04X}".format(extended))
+            flag_skip_worktree = (extended & EXTENDED_SKIP_WORKTREE) != 0
+            flag_intent_to_add = (extended & EXTENDED_INTENT_TO_ADD) != 0
+
+        return gitSubObject.GitIndexEntry(ctime=(ctime_s, ctime_ns),
+                                          mtime=(mtime_s, mtime_ns),
+                                          dev=dev,
+                                          ino=ino,
+                                          mode_type=mode_type,
+                                          mode_perms=mode_perms,
+                                          uid=uid,
+                                          gid=gid,
+                                          fsize=fsize,
+                                          sha=sha.hex(),
+                                          flag_assume_valid=(flags & FLAG_ASSUME_VALID) != 0,
+                                          flag_stage=flags & FLAG_STAGE,
+                                          flag_skip_worktree=flag_skip_worktree,
+                                          flag_intent_to_add=flag_intent_to_add,
+                                          name=self.name(i))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    #The (signature, data) of each extension. Each one is a 4-byte signature, a 4-byte size and
+    #the data. Indexes written by older versions of wyag have neither extensions nor SHA-1.
+    def extensions(self):
+        self.scan()
+        pos = self.end
+        end = len(self.data) - 20
+        while pos < end:
+            signature = self.data[pos: pos+4]
+            size = int.from_bytes(self.data[pos+4: pos+8], "big")
+            yield signature, self.data[pos+8: pos+8+size]
+            pos += 8 + size
+
+#The data of the IEOT extension for offsets, one block per entry.
+def offsets_table_encode(offsets):
+    pairs = array.array("I", [1]) * (2 * len(offsets))
+    pairs[0::2] = array.array("I", offsets)
+    if sys.byteorder == "little":
+        pairs.byteswap()
+    return IEOT_VERSION.to_bytes(4, "big") + pairs.tobytes()
+
+#The data of the EOIE extension: where the extensions start, and the SHA-1 of their headers.
+def eoie_encode(start, extensions):
+    hash = hashlib.sha1()
+    for signature, data in extensions:
+        hash.update(signature + len(data).to_bytes(4, "big"))
+    return start.to_bytes(4, "big") + hash.digest()
@@ -0,0 +1,129 @@
+import bisect
+import os
+import time
+import gitRepo
+import gitPack
+
+"""
+Short hashes name an object by the first hex digits of its SHA, as long as no other object
+starts with them. Resolving one, or finding how many digits are needed to name an object without
+ambiguity, is a question about the neighbours of a SHA among every object of the repository: the
+loose ones, in .git/objects/xx/, and those of each pack.
+
+The OID index answers both with a binary search in a single sorted list of binary SHAs, merging
+every source. The list is split in 256 buckets by the first byte of the SHA, which is also how
+loose objects are stored (one directory per first byte) and how pack indexes are organised (their
+fanout table): a short hash has at least 4 digits, so its matches and its neighbours all share
+its first byte, and a bucket is only built when it's first asked for.
+
+Each bucket keeps its packed SHAs and its loose SHAs apart, along with what they were read from:
+the list of packs, and the mtime of the loose directory, which changes whenever an object is
+added to it. When a new loose object appears, only its directory is listed again, and merged with
+the packed SHAs already there. Like for the untracked cache (see gitUtil.worktree_untracked), an
+object added in the same instant the directory was listed would leave its mtime unchanged, so a
+listing taken less than LOOSE_RACY_NS after the directory changed is never trusted: the index
+lives as long as the process, which for the server (see gitServer) is a long time.
+"""
+
+LOOSE_RACY_NS = 2 * 10**9
+
+class GitOidIndex(object):
+    def __init__(self, repo):
+        self.repo = repo
+        # First byte -> (pack names, packed SHAs, (loose mtime, listing time), loose SHAs,
+        # merged SHAs).
+        self.buckets = dict()
+
+    #The sorted binary SHAs of every object whose SHA starts with the byte first.
+    def bucket(self, first):
+        packs = gitPack.pack_list(self.repo)
+        names = tuple(p.name for p in packs)
+        xx = "{0:02x}".format(first)
+        path = gitRepo.repo_path(self.repo, "objects", xx)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        cached = self.buckets.get(first)
+        loose_valid = cached and cached[2][0] == mtime and cached[2][1] - (mtime or 0) > LOOSE_RACY_NS
+        if cached and cached[0] == names and loose_valid:
+            return cached[4]
+
+        if cached and cached[0] == names:
+            packed = cached[1]
+        else:
+            packed = set()
+            for pack in packs:
+                packed.update(pack.shas_starting_with(first))
+            packed = sorted(packed)
+
+        if loose_valid:
+            loose = cached[3]
+            listed_at = cached[2][1]
+        else:
+            listed_at = time.time_ns()
+            loose = list()
+            for f in os.listdir(path) if mtime is not None else ():
+                # Skip what isn't an object, like temporary files.
+                if len(f) == 38:
+                    try:
+                        loose.append(bytes.fromhex(xx + f))
+                    except ValueError:
+                        pass
+            loose.sort()
+
+        if not loose:
+            merged = packed
+        elif not packed:
+            merged = loose
+        else:
+            # Two sorted runs, which sorted() merges in linear time. An object can be both
+            # loose and packed, and must be listed once.
+            merged = sorted(packed + loose)
+            merged = [ sha for i, sha in enumerate(merged) if i == 0 or merged[i - 1] != sha ]
+        self.buckets[first] = (names, packed, (mtime, listed_at), loose, merged)
+        return merged
+
+    #The hex SHAs of every object starting with the (lowercase, at least 2 digits) hex prefix.
+    def matches(self, prefix):
+        shas = self.bucket(int(prefix[0:2], 16))
+        lower = bytes.fromhex(prefix + "0" * (len(prefix) % 2))
+        ret = list()
+        for i in range(bisect.bisect_left(shas, lower), len(shas)):
+            sha = shas[i].hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+        return ret
+
+    #The length of the shortest prefix of the hex SHA, at least min_length digits long, that no
+    #other object starts with. Only the objects right before and after it in sorted order can
+    #share more digits with it than any other.
+    def abbrev_length(self, sha, min_length):
+        sha = bytes.fromhex(sha)
+        shas = self.bucket(sha[0])
+        i = bisect.bisect_left(shas, sha)
+        common = 0
+        for j in (i - 1, i + 1 if i < len(shas) and shas[i] == sha else i):
+            if 0 <= j < len(shas):
+                common = max(common, common_digits(sha, shas[j]))
+        return min(40, max(min_length, common + 1))
+
+    def abbrev(self, sha, min_length):
+        return sha[0:self.abbrev_length(sha, min_length)]
+
+#The number of leading hex digits two different binary SHAs have in common.
+def common_digits(a, b):
+    diff = int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+    return (160 - diff.bit_length()) // 4
+
+#Indexes are cached for the whole process, by repository.
+_indexes = dict()
+
+def oid_index(repo):
+    index = _indexes.get(repo.gitdir)
+    if index is None:
+        index = GitOidIndex(repo)
+        _indexes[repo.gitdir] = index
+    return index
@@ -0,0 +1,571 @@
+import hashlib
+import mmap
+import os
+import time
+import zlib
+import gitRepo
+import gitCache
+import gitDelta
+
+"""
+Instead of storing every object in its own file under .git/objects/xx/yyyy (a "loose" object),
+git can store many objects in a single packfile. A pack lives in .git/objects/pack/ as two files:
+    _pack-<sha>.pack: a 12-byte header ("PACK", version, object count), followed by the objects,
+     each one being a small variable-length header (type and size) and the zlib-compressed data.
+    _pack-<sha>.idx: the index of the pack, which tells at which offset of the .pack each object is.
+
+We only support the version 2 of the index format, which is what every modern git writes:
+    _A 4-byte magic number \\377tOc and a 4-byte version number (2).
+    _A fanout table of 256 entries: entry N is the number of objects whose first SHA byte is <= N.
+    _The sorted table of all the 20-byte SHAs.
+    _A table of 4-byte CRC32 of the packed data of each object.
+    _A table of 4-byte offsets. If the most significant bit is set, the remaining 31 bits are an
+     index in the next table, which holds 8-byte offsets for packs bigger than 2GB.
+    _The SHA of the pack, and the SHA of the index itself.
+
+Both files are memory-mapped, so looking an object up never reads more than a handful of pages.
+
+Inside a pack, an object can also be stored as a delta against another object (see gitDelta),
+either an OFS_DELTA, whose base is at some offset before it in the same pack, or a REF_DELTA,
+whose base is given by its SHA.
+"""
+
+# Object types, as stored in the 3 bits of a pack entry header.
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = { OBJ_COMMIT: b'commit',
+               OBJ_TREE: b'tree',
+               OBJ_BLOB: b'blob',
+               OBJ_TAG: b'tag' }
+TYPE_CODES = { v: k for k, v in TYPE_NAMES.items() }
+
+IDX_MAGIC = b'\xfftOc'
+
+# How many compressed bytes we hand to zlib at a time when inflating an entry.
+INFLATE_CHUNK = 64 * 1024
+
+class GitPack(object):
+    def __init__(self, path):
+        # path is the pack name without extension, eg .git/objects/pack/pack-1234
+        self.path = path
+        self.name = os.path.basename(path)
+
+        with open(path + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + ".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != IDX_MAGIC or int.from_bytes(self.idx[4:8], "big") != 2:
+            raise Exception("Unsupported pack index {0}".format(path + ".idx"))
+        if self.pack[0:4] != b'PACK':
+            raise Exception("Malformed pack {0}: bad signature".format(path + ".pack"))
+        version = int.from_bytes(self.pack[4:8], "big")
+        if version not in (2, 3):
+            raise Exception("Unsupported pack version {0} in {1}".format(version, path + ".pack"))
+
+        self.fanout = [ int.from_bytes(self.idx[8 + 4*i: 12 + 4*i], "big") for i in range(256) ]
+        self.count = self.fanout[255]
+
+        # Start of each table of the index file.
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+        # Pack order, built on first use (see pack_order).
+        self.order = None
+        self.rank = None
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+    def sha_at(self, i):
+        start = self.sha_table + 20 * i
+        return self.idx[start: start + 20]
+
+    def offset_at(self, i):
+        start = self.offset_table + 4 * i
+        offset = int.from_bytes(self.idx[start: start + 4], "big")
+        if offset & 0x80000000:
+            start = self.large_offset_table + 8 * (offset & 0x7fffffff)
+            offset = int.from_bytes(self.idx[start: start + 8], "big")
+        return offset
+
+    #The fanout table gives us the range of positions where SHAs beginning with a
+    #given byte live, then we binary search inside this (small) range.
+    def position(self, sha):
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.sha_at(mid)
+            if cur == sha:
+                return mid
+            if cur < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def find_offset(self, sha):
+        pos = self.position(sha)
+        if pos is None:
+            return None
+        return self.offset_at(pos)
+
+    #The binary SHAs of every object in this pack whose SHA starts with the byte first, sorted.
+    def shas_starting_with(self, first):
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        table = self.idx[self.sha_table + 20 * lo: self.sha_table + 20 * hi]
+        return [ table[i: i + 20] for i in range(0, len(table), 20) ]
+
+    #Every entry begins with a variable-length header. The first byte holds a continuation
+    #bit, the 3-bit type and the 4 low bits of the size; each following byte holds a
+    #continuation bit and 7 more bits of the size.
+    def entry_header(self, offset):
+        c = self.pack[offset]
+        offset += 1
+        type = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        while c & 0x80:
+            c = self.pack[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, offset
+
+    #The type of the object at offset. For a deltified object, this is the type of the
+    #whole object at the end of its delta chain: only headers are read, nothing is inflated.
+    def type_at(self, offset):
+        while True:
+            type, _, data_offset = self.entry_header(offset)
+            if type in TYPE_NAMES:
+                return TYPE_NAMES[type]
+            if type not in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+                raise Exception("Unknown type {0} in pack {1}".format(type, self.name))
+            offset, _ = self.delta_base(type, offset, data_offset)
+
+    #(fmt, size) of the object at offset, without inflating it. A delta starts with the sizes of
+    #its base and of its result (as varints, see gitDelta), so only its first bytes are inflated.
+    def header_at(self, offset):
+        type, size, data_offset = self.entry_header(offset)
+        if type in TYPE_NAMES:
+            return TYPE_NAMES[type], size
+        fmt = self.type_at(offset)
+        _, data_offset = self.delta_base(type, offset, data_offset)
+
+        d = zlib.decompressobj()
+        head = b''
+        while len(head) < 20 and not d.eof:
+            chunk = self.pack[data_offset: data_offset + 64]
+            if not chunk:
+                raise Exception("Malformed pack {0}: truncated entry".format(self.name))
+            head += d.decompress(chunk)
+            data_offset += 64
+        pos, _ = gitDelta.varint_decode(head, 0)
+        _, size = gitDelta.varint_decode(head, pos)
+        return fmt, size
+
+    #The index lists objects by SHA, but some tables (like bitmaps) number them in pack order,
+    #that is by offset. Returns order, the index positions in pack order, and rank, the pack
+    #order position of each index position.
+    def pack_order(self):
+        if self.order is None:
+            offsets = [ self.offset_at(i) for i in range(self.count) ]
+            self.order = sorted(range(self.count), key=offsets.__getitem__)
+            self.rank = [ 0 ] * self.count
+            for r, i in enumerate(self.order):
+                self.rank[i] = r
+        return self.order, self.rank
+
+    #Inflate the zlib stream starting at offset, straight from the mapped pack.
+    def inflate(self, offset, size):
+        d = zlib.decompressobj()
+        view = memoryview(self.pack)
+        out = list()
+        try:
+            while not d.eof:
+                chunk = view[offset: offset + INFLATE_CHUNK]
+                if not chunk:
+                    raise Exception("Malformed pack {0}: truncated entry".format(self.name))
+                out.append(d.decompress(chunk))
+                offset += INFLATE_CHUNK
+        finally:
+            view.release()
+        data = b''.join(out)
+        if len(data) != size:
+            raise Exception("Malformed pack {0}: bad length".format(self.name))
+        return data
+
+    #Return (fmt, size, chunks) for the object at offset, chunks being an iterator over the
+    #inflated data. Whole objects are inflated as they are consumed; a deltified one has to be
+    #rebuilt in memory first, and is then handed out as a single chunk.
+    def read_stream(self, offset):
+        type, size, data_offset = self.entry_header(offset)
+        if type in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+            fmt, data = self.read_at(offset)
+            return fmt, len(data), iter([data])
+        if type not in TYPE_NAMES:
+            raise Exception("Unknown type {0} in pack {1}".format(type, self.name))
+
+        def chunks():
+            view = memoryview(self.pack)
+            pos = data_offset
+            try:
+                def next_input():
+                    nonlocal pos
+                    chunk = view[pos: pos + INFLATE_CHUNK]
+                    pos += len(chunk)
+                    return chunk
+                yield from inflate_stream(next_input)
+            finally:
+                view.release()
+        return TYPE_NAMES[type], size, stream_checked(chunks(), size, self.name)
+
+    #A deltified entry is followed by the location of its base: for an OFS_DELTA, its distance
+    #back from the entry, encoded big-endian 7 bits at a time (with an extra +1 on each
+    #continuation); for a REF_DELTA, the 20-byte SHA of the base.
+    def delta_base(self, type, offset, data_offset):
+        if type == OBJ_REF_DELTA:
+            base = self.find_offset(self.pack[data_offset: data_offset + 20])
+            if base is None:
+                raise Exception("Malformed pack {0}: missing delta base".format(self.name))
+            return base, data_offset + 20
+
+        c = self.pack[data_offset]
+        data_offset += 1
+        distance = c & 0x7f
+        while c & 0x80:
+            c = self.pack[data_offset]
+            data_offset += 1
+            distance = ((distance + 1) << 7) | (c & 0x7f)
+        return offset - distance, data_offset
+
+    #Return the (fmt, data) pair of the object stored at offset.
+    #Delta chains are followed iteratively down to a whole object (or to an object we still have
+    #in the delta base cache), then the deltas are applied back up, caching each intermediate
+    #result since it is likely to be the base of other objects too.
+    def read_at(self, offset):
+        chain = list()
+        while True:
+            cached = delta_base_cache.get((self.path, offset))
+            if cached is not None:
+                fmt, data = cached
+                break
+            type, size, data_offset = self.entry_header(offset)
+            if type in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+                base, data_offset = self.delta_base(type, offset, data_offset)
+                chain.append((offset, data_offset, size))
+                offset = base
+            elif type in TYPE_NAMES:
+                fmt, data = TYPE_NAMES[type], self.inflate(data_offset, size)
+                if chain:
+                    delta_base_cache.put((self.path, offset), (fmt, data), len(data))
+                break
+            else:
+                raise Exception("Unknown type {0} in pack {1}".format(type, self.name))
+
+        for i, (offset, data_offset, size) in enumerate(reversed(chain)):
+            data = gitDelta.delta_apply(data, self.inflate(data_offset, size))
+            if i < len(chain) - 1:
+                delta_base_cache.put((self.path, offset), (fmt, data), len(data))
+        return fmt, data
+
+#Objects we rebuilt from a delta chain, keyed by (pack, offset), so that reading many objects
+#deltified against the same bases doesn't re-inflate the whole chain each time.
+DELTA_BASE_CACHE_LIMIT = 96 * 1024 * 1024
+delta_base_cache = gitCache.GitLRUCache(DELTA_BASE_CACHE_LIMIT)
+
+#Inflate a zlib stream piece by piece. next_input returns the next compressed chunk (empty at
+#the end of the input); we yield inflated chunks of at most INFLATE_CHUNK bytes, so that even a
+#stream that compresses extremely well never has to fit in memory.
+def inflate_stream(next_input):
+    d = zlib.decompressobj()
+    while not d.eof:
+        data = d.unconsumed_tail or next_input()
+        out = d.decompress(data, INFLATE_CHUNK)
+        if not data and not out:
+            raise Exception("Malformed object: truncated zlib stream")
+        if out:
+            yield out
+
+#Pass chunks through, checking at the end that they add up to the size announced in the header.
+def stream_checked(chunks, size, name):
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > size:
+            break
+        yield chunk
+    if total != size:
+        raise Exception("Malformed object {0}: bad length".format(name))
+
+#Packs are cached for the whole process, keyed by their directory. The cache is refreshed
+#when the directory's mtime changes, which happens whenever a pack is added or removed. A pack
+#added in the same instant the directory was listed would leave its mtime unchanged, so like
+#gitOidIndex does for loose objects, a listing taken less than PACK_DIR_RACY_NS after the
+#directory changed is done again on the next call. Packs already open are kept, so that's only
+#a listdir.
+PACK_DIR_RACY_NS = 2 * 10**9
+
+_packs = dict()
+
+def pack_list(repo):
+    path = gitRepo.repo_dir(repo, "objects", "pack")
+    if not path:
+        return []
+
+    mtime = os.stat(path).st_mtime_ns
+    cached = _packs.get(path)
+    if cached and cached[0] == mtime and cached[1] - mtime > PACK_DIR_RACY_NS:
+        return cached[2]
+
+    listed_at = time.time_ns()
+    old = dict()
+    if cached:
+        old = { p.name: p for p in cached[2] }
+
+    packs = list()
+    for f in sorted(os.listdir(path)):
+        if not f.endswith(".idx"):
+            continue
+        name = f[:-4]
+        if not os.path.exists(os.path.join(path, name + ".pack")):
+            continue
+        if name in old:
+            packs.append(old.pop(name))
+        else:
+            packs.append(GitPack(os.path.join(path, name)))
+
+    for p in old.values():
+        p.close()
+
+    _packs[path] = (mtime, listed_at, packs)
+    return packs
+
+#Look for the object in every pack of the repository and return its (fmt, data), or None.
+def pack_read(repo, sha):
+    sha = bytes.fromhex(sha)
+    for pack in pack_list(repo):
+        offset = pack.find_offset(sha)
+        if offset is not None:
+            return pack.read_at(offset)
+    return None
+
+#Like pack_read, but returns (fmt, size, chunks). See GitPack.read_stream.
+def pack_read_stream(repo, sha):
+    sha = bytes.fromhex(sha)
+    for pack in pack_list(repo):
+        offset = pack.find_offset(sha)
+        if offset is not None:
+            return pack.read_stream(offset)
+    return None
+
+#Like pack_read, but only returns (fmt, size). See GitPack.header_at.
+def pack_read_header(repo, sha):
+    sha = bytes.fromhex(sha)
+    for pack in pack_list(repo):
+        offset = pack.find_offset(sha)
+        if offset is not None:
+            return pack.header_at(offset)
+    return None
+
+def pack_contains(repo, sha):
+    sha = bytes.fromhex(sha)
+    for pack in pack_list(repo):
+        if pack.position(sha) is not None:
+            return True
+    return False
+
+"""Writing packs section"""
+
+#The reverse of entry_header.
+def entry_header_encode(type, size):
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return bytes(ret)
+
+#Write a pack holding every object of the list, and its index, into .git/objects/pack.
+#objects is a list of (sha, path) pairs, where path is the name the object was reached by
+#(or None), and read is a function returning the (fmt, data) pair of a SHA.
+#
+#To keep memory bounded, objects are loaded in batches whose total size is at most
+#window_memory bytes, deltified against each other and written out, then dropped before the
+#next batch is loaded. A single object bigger than the budget is simply written on its own.
+#
+#Returns the name of the new pack.
+def pack_write(repo, objects, read, window_memory, window=10, depth=50):
+    # Only writing needs tempfile, which is slow to import (see gitUtil).
+    import tempfile
+    path = gitRepo.repo_dir(repo, "objects", "pack", mkdir=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_pack_", dir=path)
+    checksum = hashlib.sha1()
+    # (binary sha, offset, crc32) for every object, to build the index.
+    entries = list()
+
+    with os.fdopen(fd, "wb") as f:
+        def write(data):
+            checksum.update(data)
+            f.write(data)
+            return len(data)
+
+        offset = write(b'PACK' + (2).to_bytes(4, "big") + len(objects).to_bytes(4, "big"))
+
+        batch = list()
+        batch_size = 0
+        for sha, name in objects:
+            fmt, data = read(sha)
+            if batch and batch_size + len(data) > window_memory:
+                offset = pack_write_batch(batch, write, offset, entries, window, depth)
+                batch = list()
+                batch_size = 0
+            batch.append((sha, name, fmt, data))
+            batch_size += len(data)
+        offset = pack_write_batch(batch, write, offset, entries, window, depth)
+
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+
+    name = "pack-" + pack_sha.hex()
+    base = os.path.join(path, name)
+    if os.path.exists(base + ".pack"):
+        # We already have this very pack.
+        os.unlink(tmp_path)
+    else:
+        os.replace(tmp_path, base + ".pack")
+    idx_write(base + ".idx", entries, pack_sha)
+    return name
+
+#git's hash of the name an object was reached by. It mostly depends on the last characters,
+#so that files with the same name (or the same extension) in different directories end up
+#next to each other once sorted.
+def name_hash(name):
+    hash = 0
+    if name:
+        for c in name.encode("utf8"):
+            if c in b" \t\n\r\f\v":
+                continue
+            hash = ((hash >> 2) + (c << 24)) & 0xffffffff
+    return hash
+
+#This is the distance to an OFS_DELTA base, as read by GitPack.delta_base.
+def delta_offset_encode(distance):
+    ret = bytearray([distance & 0x7f])
+    distance >>= 7
+    while distance:
+        distance -= 1
+        ret.insert(0, 0x80 | (distance & 0x7f))
+        distance >>= 7
+    return bytes(ret)
+
+#To find good delta bases, we sort objects by type, name hash and decreasing size, so that
+#versions of the same file are neighbours, with the bigger ones first (deltas removing data
+#are smaller than deltas adding it). Then we slide a window over the sorted list, and try to
+#deltify each object against the ones in the window, keeping the smallest delta.
+#
+#Bases are always written before the objects deltified against them, so we can use
+#OFS_DELTA. Chains are capped at depth deltas, since every link costs an inflate and a
+#delta application at read time.
+def pack_write_batch(batch, write, offset, entries, window, depth):
+    batch.sort(key=lambda o: (TYPE_CODES[o[2]], name_hash(o[1]), -len(o[3])))
+
+    # (fmt, data, delta index, offset, depth) of the last written objects.
+    recent = list()
+    for sha, name, fmt, data in batch:
+        best = None
+        # A delta must at least save half of the object to be worth it.
+        limit = len(data) // 2 - 20
+        for base in recent:
+            base_fmt, base_data, base_index, base_offset, base_depth = base
+            if base_fmt != fmt or base_depth >= depth:
+                continue
+            # We'd have to insert at least that many bytes.
+            if len(data) - len(base_data) >= limit:
+                continue
+            if base_index is None:
+                base_index = gitDelta.delta_index(base_data)
+                base[2] = base_index
+            delta = gitDelta.delta_create(base_data, data, base_index)
+            if len(delta) < limit:
+                best = (delta, base)
+                limit = len(delta)
+
+        if best:
+            delta, base = best
+            entry = entry_header_encode(OBJ_OFS_DELTA, len(delta)) \
+                    + delta_offset_encode(offset - base[3]) + zlib.compress(delta)
+            obj_depth = base[4] + 1
+        else:
+            entry = entry_header_encode(TYPE_CODES[fmt], len(data)) + zlib.compress(data)
+            obj_depth = 0
+
+        entries.append((bytes.fromhex(sha), offset, zlib.crc32(entry)))
+        if window:
+            recent.append([fmt, data, None, offset, obj_depth])
+            if len(recent) > window:
+                recent.pop(0)
+        offset += write(entry)
+    return offset
+
+def idx_write(path, entries, pack_sha):
+    entries = sorted(entries)
+    checksum = hashlib.sha1()
+    out = bytearray()
+
+    out += IDX_MAGIC + (2).to_bytes(4, "big")
+    fanout = [0] * 256
+    for sha, _, _ in entries:
+        fanout[sha[0]] += 1
+    total = 0
+    for count in fanout:
+        total += count
+        out += total.to_bytes(4, "big")
+
+    for sha, _, _ in entries:
+        out += sha
+    for _, _, crc in entries:
+        out += crc.to_bytes(4, "big")
+
+    large = list()
+    for _, offset, _ in entries:
+        if offset < 0x80000000:
+            out += offset.to_bytes(4, "big")
+        else:
+            out += (0x80000000 | len(large)).to_bytes(4, "big")
+            large.append(offset)
+    for offset in large:
+        out += offset.to_bytes(8, "big")
+
+    out += pack_sha
+    checksum.update(out)
+    out += checksum.digest()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+    os.replace(tmp_path, path)
+
+#Close the mapped packs of a repository, so they can be deleted.
+def pack_close_all(repo):
+    path = gitRepo.repo_dir(repo, "objects", "pack")
+    cached = _packs.pop(path, None)
+    if cached:
+        for p in cached[2]:
+            p.close()
+
+"""End of writing packs section"""
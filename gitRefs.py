@@ -0,0 +1,133 @@
+import bisect
+import os
+import gitRepo
+
+"""
+With a file per ref, listing refs means walking the whole .git/refs directory, and reading a ref
+means opening its file. That's fine for a few branches, not for a repository with a hundred
+thousand tags. Git can instead keep refs in a single file, .git/packed-refs, with a line per ref:
+the SHA it points to and its name. The file starts with a header telling which traits it has:
+    _sorted: refs are sorted by name;
+    _peeled, fully-peeled: each annotated tag is followed by a line with "^" and the SHA of the
+     object it finally points to, once every tag is followed (what "tag^{}" means). Refs without
+     such a line don't point to tags, so nobody needs to read their object to know.
+
+A ref can be both in packed-refs and loose (when it was updated after it was packed): the loose
+one is the current one. pack-refs moves loose refs into packed-refs.
+
+packed-refs is parsed once per process (and again when it changes), into a sorted list of names,
+so finding a ref is a binary search, and listing the refs under a prefix such as refs/tags/ is
+a binary search followed by a slice.
+"""
+
+HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
+
+class GitPackedRefs(object):
+    def __init__(self, path=None):
+        # Sorted names, and the SHAs they point to.
+        self.names = list()
+        self.shas = list()
+        # Name -> the object an annotated tag finally points to.
+        self.peeled = dict()
+        # Whether every annotated tag has its peeled line.
+        self.fully_peeled = True
+        if path is not None:
+            self.read(path)
+
+    def read(self, path):
+        refs = list()
+        traits = set()
+        with open(path, "r", encoding="utf8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith("# pack-refs with:"):
+                    traits = set(line[len("# pack-refs with:"):].split())
+                elif line.startswith("^"):
+                    if not refs:
+                        raise Exception("Malformed packed-refs: peeled line without a ref")
+                    self.peeled[refs[-1][0]] = line[1:]
+                elif line and not line.startswith("#"):
+                    sha, _, name = line.partition(" ")
+                    if len(sha) != 40 or not name:
+                        raise Exception("Malformed packed-refs line: {0}".format(line))
+                    refs.append((name, sha))
+
+        if "sorted" not in traits:
+            refs.sort()
+        self.fully_peeled = "fully-peeled" in traits
+        self.names = [ name for name, _ in refs ]
+        self.shas = [ sha for _, sha in refs ]
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return self.shas[i]
+        return None
+
+    #(name, sha) of every ref whose name starts with prefix, sorted by name.
+    def prefix(self, prefix):
+        if not prefix:
+            return list(zip(self.names, self.shas))
+        # Names starting with prefix sort before prefix with its last character incremented.
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return list(zip(self.names[start:end], self.shas[start:end]))
+
+#packed-refs is cached for the whole process, and read again when the file changes. It is
+#replaced by renaming a new file over it, so its inode changes even when its mtime doesn't.
+_packed = dict()
+
+def packed_refs_path(repo):
+    return gitRepo.repo_path(repo, "packed-refs")
+
+def packed_refs_read(repo):
+    path = packed_refs_path(repo)
+    try:
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        key = None
+    cached = _packed.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    refs = GitPackedRefs(path if key is not None else None)
+    _packed[path] = (key, refs)
+    return refs
+
+"""Writing packed-refs section"""
+
+#Like the index, packed-refs is written through a lock file: packed-refs.lock is created (and
+#fails if it exists), written, then renamed over packed-refs.
+def packed_refs_lock(repo):
+    path = packed_refs_path(repo) + ".lock"
+    try:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        raise Exception("Unable to create {0}: another wyag process seems to be running. "
+                        "If not, remove this file.".format(path))
+
+def packed_refs_unlock(repo, lock):
+    os.close(lock)
+    os.unlink(packed_refs_path(repo) + ".lock")
+
+#refs is a list of (name, sha, peeled), sorted by name, peeled being None for refs that don't
+#point to annotated tags. Releases the lock.
+def packed_refs_write(repo, lock, refs):
+    out = [ HEADER ]
+    for name, sha, peeled in refs:
+        out.append("{0} {1}\n".format(sha, name))
+        if peeled is not None:
+            out.append("^{0}\n".format(peeled))
+    path = packed_refs_path(repo)
+    try:
+        with os.fdopen(lock, "w", encoding="utf8") as f:
+            f.write("".join(out))
+    except:
+        os.unlink(path + ".lock")
+        raise
+    os.replace(path + ".lock", path)
+
+"""End of writing packed-refs section"""
@@ -0,0 +1,208 @@
+import asyncio
+import base64
+import concurrent.futures
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+import gitRepo
+import gitUtil
+import gitClient
+
+"""
+Each run of wyag starts from nothing: the interpreter, the argument parser, finding and parsing
+the repository configuration, and then empty caches, so the packs, the commit-graph and the
+objects it reads are opened and inflated again every time. The server is a long-running process
+that keeps all of that warm, and answers requests on a Unix socket in the git directory
+(.git/wyag.sock). It handles any number of clients at once with asyncio.
+
+The protocol is JSON lines: each request is a JSON object on a line, with an "op" naming the
+operation, and gets a JSON object on a line as answer, with "ok" telling whether it worked (and
+"error" saying what went wrong when it didn't). Binary data is base64-encoded. Operations are:
+    _read (sha): the "fmt" and "data" of an object.
+    _resolve (name, and optionally fmt): the "sha" a name points to.
+    _refs: every ref, and HEAD, as "refs", a dict from their full name to their SHA.
+    _run (argv): run a read-only wyag command (see gitClient.served). What it prints comes as it
+     goes, in answers with the "stream" it was printed to ("stdout" or "stderr") and its "data";
+     the last answer has its "exit" code.
+    _quit: stop the server.
+
+Only commands reading the repository are served. The others write the index, the refs or the
+worktree, and depend on who runs them: the paths they are given are relative to the client's
+directory, and commit takes its author from the client's ~/.gitconfig, status its ignore rules
+from the client's ~/.config/git/ignore. The server has its own directory and environment, so
+those always run in the client.
+
+The work of every request is done in one worker thread, one request at a time, in the order they
+come: the caches it fills aren't made to be shared between threads. The event loop stays free
+meanwhile, to accept clients and read their requests, and to send the output of commands as
+they print it. Answers come in order: the output of a command is handed to the loop before its
+exit code.
+"""
+
+#Output of a command sent to the client in chunks of this size, or less at the end.
+CHUNK = 64 * 1024
+
+class GitServer(object):
+    #run is the function running a wyag command from its arguments (libwyag.main).
+    def __init__(self, repo, run):
+        self.repo = repo
+        self.run = run
+        self.stopping = None
+        self.loop = None
+        self.executor = None
+        self.stdout = None
+        self.stderr = None
+
+    def serve(self):
+        # Commands find the repository from the current directory.
+        os.chdir(self.repo.worktree)
+        self.stdout = sys.stdout = GitServerStream(sys.stdout)
+        self.stderr = sys.stderr = GitServerStream(sys.stderr)
+        try:
+            asyncio.run(self.main())
+        finally:
+            sys.stdout, sys.stderr = self.stdout.stream, self.stderr.stream
+
+    async def main(self):
+        path = gitRepo.repo_path(self.repo, gitClient.SOCKET)
+        # The socket only shows up once it listens, so clients finding it can connect.
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        tmp = "{0}.{1}".format(path, os.getpid())
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        sock.bind(tmp)
+        sock.listen()
+        os.replace(tmp, path)
+        self.loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_unix_server(self.client, sock=sock)
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            os.unlink(path)
+            self.executor.shutdown(cancel_futures=True)
+
+    async def client(self, reader, writer):
+        try:
+            while not self.stopping.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    answer = await self.loop.run_in_executor(self.executor, self.answer, request, writer)
+                except Exception as e:
+                    request = None
+                    answer = { "ok": False, "error": str(e) }
+                await self.send(writer, answer)
+                if request and request.get("op") == "quit":
+                    self.stopping.set()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def write(self, writer, answer):
+        # Nothing to send to a client that is gone.
+        if not writer.is_closing():
+            writer.write(json.dumps(answer).encode("utf8") + b'\n')
+
+    async def send(self, writer, answer):
+        self.write(writer, answer)
+        await writer.drain()
+
+    #Answer a request, in the worker thread. writer is the client's, for the output of commands.
+    def answer(self, request, writer):
+        repo = self.repo
+        match request.get("op"):
+            case "read":
+                raw = gitUtil.object_read_raw(repo, request["sha"])
+                if raw is None:
+                    raise Exception("No such object {0}".format(request["sha"]))
+                return { "ok": True, "fmt": raw[0].decode("ascii"), "data": encode(raw[1]) }
+            case "resolve":
+                fmt = request.get("fmt")
+                sha = gitUtil.object_find(repo, request["name"], fmt.encode("ascii") if fmt else None)
+                return { "ok": True, "sha": sha }
+            case "refs":
+                refs = { "HEAD": gitUtil.ref_resolve(repo, "HEAD") }
+                refs.update(gitUtil.ref_list(repo))
+                return { "ok": True, "refs": refs }
+            case "run":
+                return self.run_command(request["argv"], writer)
+            case "quit":
+                return { "ok": True }
+            case op:
+                raise Exception("Unknown operation {0}".format(op))
+
+    #Run a command in this process, sending what it prints to the client as it goes, and
+    #returning how it exits.
+    def run_command(self, argv, writer):
+        if not gitClient.served(argv):
+            raise Exception("Not served, run it without the server: {0}".format(" ".join(argv)))
+        out = self.output(writer, "stdout")
+        err = self.output(writer, "stderr")
+        self.stdout.local.output = out
+        self.stderr.local.output = err
+        code = 0
+        try:
+            self.run(argv)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            self.stdout.local.output = self.stderr.local.output = None
+            out.close()
+            err.close()
+        return { "ok": True, "exit": code }
+
+    #A text stream for a command to print to, sending what it gets to the client in chunks.
+    def output(self, writer, name):
+        chunks = GitServerChunks(self, writer, name)
+        return io.TextIOWrapper(io.BufferedWriter(chunks, CHUNK), encoding="utf8")
+
+#sys.stdout and sys.stderr while serving: what a command prints goes to the output of the request
+#its thread runs, set in local.output, and anything else to the real stream. Installed once, so
+#requests don't have to swap the streams of the whole process.
+class GitServerStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, "output", None) or self.stream, name)
+
+#The end of the output of a command: every write is sent to the client as answers of at most
+#CHUNK bytes. Written to from the worker thread, which hands them to the event loop without
+#waiting for the client to read them: one client reading slowly (through a pager) mustn't hold
+#the others up.
+class GitServerChunks(io.RawIOBase):
+    def __init__(self, server, writer, name):
+        self.server = server
+        self.writer = writer
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        for start in range(0, len(data), CHUNK):
+            answer = { "ok": True, "stream": self.name, "data": encode(data[start:start + CHUNK]) }
+            self.server.loop.call_soon_threadsafe(self.server.write, self.writer, answer)
+        return len(data)
+
+def encode(data):
+    return base64.b64encode(data).decode("ascii")
@@ -1,3 +1,4 @@
+import bisect
 import gitUtil
 
 class GitObject (object):
@@ -64,7 +65,8 @@ class GitIndexEntry(object):
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, fsmonitor_valid=False,
+                 flag_skip_worktree=False, flag_intent_to_add=False):
         # The last time a file's metadata changed.  This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
@@ -90,13 +92,49 @@ class GitIndexEntry(object):
         self.sha = sha
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
+        # Extended flags (index version 3 and later): the file isn't checked out
+        # (sparse checkout), and the file was added with "add -N".
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
         # Name of the object (full path this time!)
         self.name = name
+        # Whether the filesystem monitor vouches that the file hasn't changed since it
+        # was last found identical to this entry.
+        self.fsmonitor_valid = fsmonitor_valid
+
+#The cache tree remembers, for each directory of the index, the SHA of the tree object built
+#from it the last time, and how many index entries that tree covers (recursively). As long as
+#no entry under a directory changed, commit can reuse its tree as is. A node whose entry_count
+#is -1 is invalid, and has to be rebuilt.
+class GitCacheTree(object):
+    def __init__(self, entry_count=-1, sha=None):
+        self.entry_count = entry_count
+        self.sha = sha
+        # Subdirectory name -> GitCacheTree
+        self.subtrees = dict()
+
+    def valid(self):
+        return self.entry_count >= 0
+
+    def invalidate(self):
+        self.entry_count = -1
+        self.sha = None
+
+#Git requires index entries to be sorted by name (compared as raw bytes), then by stage.
+def index_entry_key(entry):
+    return (entry.name.encode("utf8"), int(entry.flag_stage or 0))
 
 #Now on the detail of file index, it's made of three part:
 #   _An header with the format version number and the number of entries the index holds.
 #   _A series of entries, sorted, each representing a file; padded to multiple of 8 bytes.
-#   _A series of optional extension which I'll ignore for the sake of simplicity.
+#   _A series of optional extensions. We understand TREE (the cache tree, stored in cache_tree)
+#    and FSMN (the filesystem monitor token, stored in fsmonitor_token); other optional
+#    extensions are dropped.
+#   _The SHA-1 of everything above.
+#
+#In memory, entries are kept in that order, along with the sorted list of their keys, so we can
+#find a path with a binary search, and insert or remove it without re-sorting everything.
+#Entries must only be changed through add, remove and replace.
 class GitIndex(object):
     version = None
     entries = []
@@ -105,7 +143,72 @@ class GitIndex(object):
             entries = list()
 
         self.version = version
-        self.entries = entries
+        self.fsmonitor_token = None
+        self.cache_tree = None
+        # When the index file was last written, in nanoseconds (None if it wasn't read from disk).
+        self.mtime = None
+        # The stat data of the entries as read, in columns (see gitUtil.index_columns), or None.
+        self.columns = None
+        # Entries read from disk are already sorted, which makes this sort linear.
+        self.entries = sorted(entries, key=index_entry_key)
+        self.keys = [ index_entry_key(e) for e in self.entries ]
+
+    #Position of the first entry for name (whatever its stage), or of where it would be inserted.
+    def position(self, name):
+        return bisect.bisect_left(self.keys, (name.encode("utf8"), -1))
+
+    def get(self, name):
+        pos = self.position(name)
+        if pos < len(self.entries) and self.entries[pos].name == name:
+            return self.entries[pos]
+        return None
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    #Insert entry at its place. An existing entry with the same name and stage is replaced.
+    def add(self, entry):
+        key = index_entry_key(entry)
+        pos = bisect.bisect_left(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            self.entries[pos] = entry
+        else:
+            self.keys.insert(pos, key)
+            self.entries.insert(pos, entry)
+        self.invalidate(entry.name)
+
+    #Remove every entry (every stage) for name, and return them.
+    def remove(self, name):
+        start = self.position(name)
+        end = start
+        while end < len(self.entries) and self.entries[end].name == name:
+            end += 1
+        removed = self.entries[start:end]
+        del self.entries[start:end]
+        del self.keys[start:end]
+        if removed:
+            self.invalidate(name)
+        return removed
+
+    #Replace the existing entry with the same name and stage.
+    def replace(self, entry):
+        key = index_entry_key(entry)
+        pos = bisect.bisect_left(self.keys, key)
+        if pos == len(self.keys) or self.keys[pos] != key:
+            raise Exception("Not in the index: {0}".format(entry.name))
+        self.entries[pos] = entry
+        self.invalidate(entry.name)
+
+    #Invalidate the cache tree of every directory holding name, up to the root. The columns
+    #don't describe the entries anymore either.
+    def invalidate(self, name):
+        self.columns = None
+        node = self.cache_tree
+        for part in name.split("/")[:-1] + [ None ]:
+            if node is None:
+                return
+            node.invalidate()
+            node = node.subtrees.get(part) if part is not None else None
 
 #GitIgnore is a class that hold a list of absolute rule, a dict (hashmap) of relative rules.
 #The key to this hashmap are dictionaries, relative to the root of a work tree.
@@ -2,21 +2,85 @@ import gitRepo
 import os
 import zlib
 import hashlib
+import io
 import sys
 import collections
+import heapq
+import itertools
 import gitSubObject
+import gitPack
+import gitRefs
+import gitOidIndex
+import gitCache
 import re
-import configparser
-from math import ceil
-from datetime import datetime
-from fnmatch import fnmatch
-
+import time
+from stat import S_ISREG
+
+#Thread pools (concurrent.futures) and the filesystem monitor client (which loads ctypes) take
+#longer to import than short commands take to run: the functions using them import them. So
+#do those of modules only a few commands need: tempfile (for writing objects), json (for the
+#untracked cache), the reachability bitmaps and EWAH bitmaps, and the columnar index, which
+#itself loads NumPy only when an index is big enough to need it. The same goes for the index
+#file (gitIndexFile), the commit-graph (gitCommitGraph, which only history walks and typed
+#lookups use), dates, ignore patterns (fnmatch) and the global configuration (configparser).
+#What stays here is what nearly every command needs: reading objects (gitPack, and the object
+#cache of gitCache), and resolving names (gitRefs, gitOidIndex).
 
 """Reading and Writing GitObject section"""
+
+#Sizes in git's configuration files may have a k, m or g suffix.
+def config_size(value):
+    value = value.strip().lower()
+    units = { "k": 1024, "m": 1024**2, "g": 1024**3 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+#Objects are immutable (their name is the hash of their content), so once parsed, an object
+#can be kept around and handed back to whoever asks for the same SHA again. Commands like
+#status or log read the same trees and commits over and over, and inflating them is most
+#of their work. The cache is bounded by the total size of the objects it holds, and its size
+#is set by the WYAG_OBJECT_CACHE environment variable (eg 64m; 0 disables it).
+#Callers must not modify the objects they get from object_read.
+OBJECT_CACHE_LIMIT = "32m"
+object_cache = gitCache.GitLRUCache(config_size(os.environ.get("WYAG_OBJECT_CACHE", OBJECT_CACHE_LIMIT)))
+
 def object_read(repo, inputObj):
+    cached = object_cache.get(inputObj) if object_cache.max_bytes else None
+    if cached is not None:
+        return cached
+
+    raw = object_read_raw(repo, inputObj)
+
+    if raw is None:
+        return None
+
+    fmt, data = raw
+    match fmt:
+        case b'commit' : c = gitSubObject.GitCommit
+        case b'tree'   : c = gitSubObject.GitTree
+        case b'tag'    : c = gitSubObject.GitTag
+        case b'blob'   : c = gitSubObject.GitBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), inputObj))
+
+    obj = c(data)
+    if object_cache.max_bytes:
+        object_cache.put(inputObj, obj, len(data))
+    return obj
+
+#An object can either be stored in a pack, or loose in its own file. Packs are looked up
+#first, and loose objects are consulted as a fallback. Returns a (fmt, data) pair.
+def object_read_raw(repo, inputObj):
+    packed = gitPack.pack_read(repo, inputObj)
+    if packed is not None:
+        return packed
+    return object_read_loose(repo, inputObj)
+
+def object_read_loose(repo, inputObj):
     path = gitRepo.repo_file(repo, "objects", inputObj[0:2], inputObj[2:])
 
-    if not os.path.isfile(path):
+    if not path or not os.path.isfile(path):
         return None
 
     with open (path, "rb") as f:
@@ -29,16 +93,77 @@ def object_read(repo, inputObj):
         if size != len(raw)-y-1:
             raise Exception("Malformed object {0}: bad length".format(inputObj))
 
-        match fmt:
-            case b'commit' : c = gitSubObject.GitCommit
-            case b'tree'   : c = gitSubObject.GitTree
-            case b'tag'    : c = gitSubObject.GitTag
-            case b'blob'   : c = gitSubObject.GitBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), inputObj))
-
-        return c(raw[y+1:])
+        return fmt, raw[y+1:]
     
+#object_read inflates a whole object in memory, which a big blob may not fit in. This function
+#only parses the header of the object, and returns (fmt, size, chunks), chunks being an
+#iterator that inflates the data as it is consumed. The size announced in the header is
+#checked once the last chunk has been read.
+def object_read_stream(repo, inputObj):
+    packed = gitPack.pack_read_stream(repo, inputObj)
+    if packed is not None:
+        return packed
+
+    path = gitRepo.repo_file(repo, "objects", inputObj[0:2], inputObj[2:])
+    if not path or not os.path.isfile(path):
+        return None
+
+    f = open(path, "rb")
+    try:
+        inflated = gitPack.inflate_stream(lambda: f.read(gitPack.INFLATE_CHUNK))
+        head = b''
+        while not b'\x00' in head:
+            chunk = next(inflated, None)
+            if chunk is None:
+                raise Exception("Malformed object {0}: no header".format(inputObj))
+            head += chunk
+    except:
+        f.close()
+        raise
+
+    x = head.find(b' ')
+    fmt = head[0:x]
+    y = head.find(b'\x00', x)
+    size = int(head[x:y].decode("ascii"))
+
+    def chunks():
+        try:
+            if len(head) > y + 1:
+                yield head[y+1:]
+            yield from inflated
+        finally:
+            f.close()
+    return fmt, size, gitPack.stream_checked(chunks(), size, inputObj)
+
+#The (fmt, size) of an object, from its header alone, or None if there's no such object. Many
+#questions only need these: which type an object is, how big a blob is. For a packed object,
+#they come from the entry header (see GitPack.header_at). For a loose one, only the first bytes
+#are inflated: zlib is asked for no more than OBJECT_HEADER_MAX bytes at a time, which is more
+#than the longest header ("commit " and a 20-digit size), however big the object.
+OBJECT_HEADER_MAX = 64
+
+def object_info(repo, inputObj):
+    packed = gitPack.pack_read_header(repo, inputObj)
+    if packed is not None:
+        return packed
+
+    path = gitRepo.repo_file(repo, "objects", inputObj[0:2], inputObj[2:])
+    if not path or not os.path.isfile(path):
+        return None
+
+    with open(path, "rb") as f:
+        d = zlib.decompressobj()
+        head = b''
+        while not b'\x00' in head:
+            chunk = d.unconsumed_tail or f.read(256)
+            if not chunk or d.eof or len(head) > OBJECT_HEADER_MAX:
+                raise Exception("Malformed object {0}: no header".format(inputObj))
+            head += d.decompress(chunk, OBJECT_HEADER_MAX)
+
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    return head[0:x], int(head[x:y].decode("ascii"))
+
 def object_write(obj, repo=None):
     data = obj.serialize()
     result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
@@ -54,32 +179,26 @@ def object_write(obj, repo=None):
 #More presice, the name resolution function will work like below:
 #   _If name is HEAD, it will just resolve .git/HEAD;
 #   _If name is a full hash, this hash is returned unmodified.
-#   _If name looks like a short hash, it will collect objects whose full hash begin with this short hash.
+#   _If name looks like a short hash, it will collect objects whose full hash begin with this short hash,
+#    loose or packed, from the OID index (see gitOidIndex).
 #   _At last, it will resolve tags and branches matching name.
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
 def object_resolve(repo, name):
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
     # Empty string?  Abort.
     if not name.strip():
         return None
     # Head is nonambiguous
     if name == "HEAD":
-        return [ ref_resolve(repo, "HEAD") ]
+        head = ref_resolve(repo, "HEAD")
+        return [ head ] if head else []
     # If it's a hex string, try for a hash.
-    if hashRE.match(name):
+    if HASH_RE.match(name):
         # This may be a hash, either small or full.  4 seems to be the
         # minimal length for git to consider something a short hash.
         # This limit is documented in man git-rev-parse
-        name = name.lower()
-        prefix = name[0:2]
-        path = gitRepo.repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
+        candidates.extend(gitOidIndex.oid_index(repo).matches(name.lower()))
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag: # Did we find a tag?
@@ -103,25 +222,83 @@ def object_find(repo, name, fmt=None, follow=True):
     sha = sha[0]
     if not fmt:
         return sha
+    import gitCommitGraph
     while True: 
-        obj = object_read(repo, sha)
-        if obj.fmt == fmt:
+        # Commits of the commit-graph are known without reading them.
+        info = gitCommitGraph.commit_graph_lookup(repo, sha)
+        if info is not None:
+            if fmt == b'commit':
+                return sha
+            if fmt == b'tree' and follow:
+                sha = info[0]
+                continue
+        # Only the header is needed to check the type: objects are only read when we have to
+        # follow them.
+        info = object_info(repo, sha)
+        if info is None:
+            raise Exception("No such object {0}.".format(sha))
+        if info[0] == fmt:
             return sha
         if not follow:
             return None
-        if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
-        elif obj.fmt == b'commit' and fmt == b'tree':
-                sha = obj.kvlm[b'tree'].decode("ascii")
+        if info[0] == b'tag':
+            sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+        elif info[0] == b'commit' and fmt == b'tree':
+            sha = object_read(repo, sha).kvlm[b'tree'].decode("ascii")
         else:
-              return None
+            return None
 
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    _, _, chunks = object_read_stream(repo, object_find(repo, obj, fmt=fmt))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
+
+#cat-file -t and -s: the type or the size of an object, which only need its header.
+def cat_file_info(repo, obj, size=False):
+    sha = object_find(repo, obj)
+    info = object_info(repo, sha)
+    if info is None:
+        raise Exception("No such object {0}.".format(sha))
+    print(info[1] if size else info[0].decode("ascii"))
+
+#cat-file --batch and --batch-check: read object names from input, one per line, and answer
+#each with "<sha> <type> <size>" (followed by the contents and a newline with contents set),
+#or "<name> missing". A single process answers any number of requests, so tools reading many
+#objects pay for the interpreter and the repository setup only once. Output is binary and
+#buffered; with flush set, it's flushed after each answer, for callers waiting on them.
+def cat_file_batch(repo, input, output, contents=True, flush=False):
+    for line in input:
+        name = line.rstrip(b'\r\n').decode("utf8")
+        try:
+            sha = object_find(repo, name)
+        except Exception:
+            sha = None
+
+        if sha is None:
+            found = None
+        elif contents:
+            found = object_read_stream(repo, sha)
+        else:
+            found = object_info(repo, sha)
+
+        if found is None:
+            output.write("{0} missing\n".format(name).encode("utf8"))
+        else:
+            output.write(b'%s %s %d\n' % (sha.encode("ascii"), found[0], found[1]))
+            if contents:
+                for chunk in found[2]:
+                    output.write(chunk)
+                output.write(b'\n')
+        if flush:
+            output.flush()
+    output.flush()
 
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
+    # Blobs need no parsing, so we never have to hold them in memory.
+    if fmt == b'blob' and S_ISREG(os.fstat(fd.fileno()).st_mode):
+        return object_hash_stream(fd, fmt, repo)
+
     data = fd.read()
 
     match fmt:
@@ -133,6 +310,60 @@ def object_hash(fd, fmt, repo=None):
 
     return object_write(obj, repo)
 
+#Hashing a big file with object_write needs several copies of it in memory: the data, the
+#header + data, and its compressed version. Instead, we get the size (which goes in the
+#header) from the filesystem, then feed fixed-size chunks to both the hash and the compressor,
+#writing the compressed output to a temporary file. Once we know the SHA, we can rename this
+#file to its final place. Memory use stays the same whatever the size of the file.
+STREAM_CHUNK = 1024 * 1024
+
+def object_hash_stream(fd, fmt, repo=None):
+    import tempfile
+    size = os.fstat(fd.fileno()).st_size
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    sha = hashlib.sha1(header)
+
+    out = None
+    if repo:
+        objects = gitRepo.repo_dir(repo, "objects", mkdir=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=objects)
+        out = os.fdopen(tmp_fd, "wb")
+        compressor = zlib.compressobj()
+        out.write(compressor.compress(header))
+
+    try:
+        read = 0
+        while True:
+            chunk = fd.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            read += len(chunk)
+            sha.update(chunk)
+            if out:
+                out.write(compressor.compress(chunk))
+
+        if read != size:
+            raise Exception("{0} changed while being hashed".format(fd.name))
+
+        outputObj = sha.hexdigest()
+        if out:
+            out.write(compressor.flush())
+            out.close()
+            # Like git, we make objects read-only.
+            os.chmod(tmp_path, 0o444)
+            path = gitRepo.repo_file(repo, "objects", outputObj[0:2], outputObj[2:], mkdir=True)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+    except:
+        if out:
+            out.close()
+            os.unlink(tmp_path)
+        raise
+
+    return outputObj
+
 """End of Reading and Writing GitObject section"""
 
 """Reading commit history: log section """
@@ -209,38 +440,154 @@ def kvlm_serialize(keyMess):
 
     return ans
 
-#Using Graphviz for representing log
-def log_graphviz(repo, inputObj, seen):
-
-    if inputObj in seen:
-        return
-    seen.add(inputObj)
-
-    commit = object_read(repo, inputObj)
-    short_hash = inputObj[0:8]
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
-
+#To show history, we walk it backwards from a commit. The walker keeps the commits it has seen
+#but not shown yet in a priority queue ordered by commit date: it shows the most recent one,
+#then queues its parents, and so on. It never recurses, so history can be as long as it wants,
+#and it's a generator: commits are shown as soon as they are popped, and stopping after n
+#commits (log -n) only reads the commits around the first n.
+#   _since stops the walk at commits older than that timestamp: their parents aren't queued.
+#   _topo_order never shows a commit before all of its children that are shown. This needs to
+#    know all of them first, so the whole history is walked (cheaply, with a commit-graph)
+#    before the first commit comes out.
+#The dates and parents come from the commit-graph when there is one, so the walk itself doesn't
+#have to read commits.
+def rev_walk(repo, starts, since=None, topo_order=False, exclude=None):
+    if topo_order:
+        walk = rev_walk_topo(repo, starts, since, exclude)
+    else:
+        walk = rev_walk_date(repo, starts, since, exclude)
+    for sha, _ in walk:
+        yield sha
+
+#Yield (sha, parents) for every commit, most recent first. Commits in exclude (a set) are
+#neither shown nor walked through.
+def rev_walk_date(repo, starts, since=None, exclude=None):
+    queue = list()
+    seen = set(exclude or ())
+    counter = itertools.count()
+
+    def push(sha):
+        if sha in seen:
+            return
+        seen.add(sha)
+        parents, time = commit_walk_info(repo, sha)
+        # The counter breaks ties between commits of the same date: first queued, first shown.
+        heapq.heappush(queue, (-time, next(counter), sha, parents))
+
+    for sha in starts:
+        push(sha)
+    while queue:
+        time, _, sha, parents = heapq.heappop(queue)
+        if since is not None and -time < since:
+            continue
+        yield sha, parents
+        for p in parents:
+            push(p)
+
+#Same as git: count for each commit how many of its children will be shown, then show commits
+#whose children have all been shown, last ready first. Tips are the commits with no children.
+def rev_walk_topo(repo, starts, since=None, exclude=None):
+    commits = list(rev_walk_date(repo, starts, since, exclude))
+    parents = dict(commits)
+    children = collections.Counter(p for _, ps in commits for p in ps if p in parents)
+
+    stack = [ sha for sha, _ in commits if children[sha] == 0 ]
+    stack.reverse()
+    while stack:
+        sha = stack.pop()
+        yield sha, parents[sha]
+        for p in parents[sha]:
+            if p not in parents:
+                continue
+            children[p] -= 1
+            if children[p] == 0:
+                stack.append(p)
+
+#(parents, commit time) of a commit, from the commit-graph if it knows the commit.
+def commit_walk_info(repo, sha):
+    import gitCommitGraph
+    info = gitCommitGraph.commit_graph_lookup(repo, sha)
+    if info is not None:
+        return info[1], info[3]
+    commit = object_read(repo, sha)
+    if commit is None or commit.fmt != b'commit':
+        raise Exception("Not a commit: {0}".format(sha))
+    return commit_parents(repo, sha, commit), commit_time(commit)
+
+#The first line of the message of a commit.
+def commit_subject(repo, sha):
+    message = object_read(repo, sha).kvlm[None].decode("utf8").strip()
     if "\n" in message: # Keep only the first line
         message = message[:message.index("\n")]
-
-    print("  c_{0} [label=\"{1}: {2}\"]".format(inputObj, inputObj[0:7], message))
-    assert commit.fmt==b'commit'
-
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the initial commit.
-        return
-
-    parents = commit.kvlm[b'parent']
-
+    return message
+
+#The formatters print the commits of a walk as they come, by their short SHA: abbrev digits, or
+#more when needed to tell the commit apart from every other object (see gitOidIndex). The first
+#one is a plain text line per commit: its short SHA and the first line of its message.
+ABBREV_DEFAULT = 7
+
+def log_oneline(repo, commits, abbrev=ABBREV_DEFAULT):
+    index = gitOidIndex.oid_index(repo)
+    for sha in commits:
+        print("{0} {1}".format(index.abbrev(sha, abbrev), commit_subject(repo, sha)))
+
+#The second one uses Graphviz for representing log: a node per commit, and an edge to each of
+#its parents.
+def log_graphviz(repo, commits, abbrev=ABBREV_DEFAULT):
+    index = gitOidIndex.oid_index(repo)
+    print("digraph wyaglog{")
+    print("  node[shape=rect]")
+    for sha in commits:
+        message = commit_subject(repo, sha)
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
+
+        print("  c_{0} [label=\"{1}: {2}\"]".format(sha, index.abbrev(sha, abbrev), message))
+        for p in commit_parents(repo, sha):
+            print ("  c_{0} -> c_{1};".format(sha, p))
+    print("}")
+
+#Dates given to log --since: a unix timestamp, an ISO 8601 date ("2024-01-31", or with a time),
+#or a relative date such as "2 weeks ago".
+DATE_UNITS = { "second": 1, "minute": 60, "hour": 3600, "day": 86400,
+               "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400 }
+
+def date_parse(text):
+    from datetime import datetime
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    m = re.fullmatch(r"(\d+)[ .]*(second|minute|hour|day|week|month|year)s?([ .]*ago)?", text)
+    if m:
+        return int(time.time()) - int(m.group(1)) * DATE_UNITS[m.group(2)]
+    try:
+        return int(datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        raise Exception("Invalid date: {0}".format(text))
+
+#The parents of a commit, as hex SHAs. They come from the commit-graph when it knows the
+#commit, from the commit object (read unless given) otherwise.
+def commit_parents(repo, sha, commit=None):
+    import gitCommitGraph
+    info = gitCommitGraph.commit_graph_lookup(repo, sha)
+    if info is not None:
+        return info[1]
+    if commit is None:
+        commit = object_read(repo, sha)
+    parents = commit.kvlm.get(b'parent', [])
     if type(parents) != list:
         parents = [ parents ]
-
-    for p in parents:
-        p = p.decode("ascii")
-        print ("  c_{0} -> c_{1};".format(inputObj, p))
-        log_graphviz(repo, p, seen)
+    return [ p.decode("ascii") for p in parents ]
+
+#The commit time is the timestamp in the committer line: "name <email> timestamp timezone".
+def commit_time(commit):
+    committer = commit.kvlm.get(b'committer') or commit.kvlm.get(b'author')
+    if type(committer) == list:
+        committer = committer[0]
+    try:
+        return int(committer.split(b' ')[-2])
+    except (AttributeError, IndexError, ValueError):
+        return 0
 
 """End of Reading commit history: log section """
 
@@ -282,6 +629,16 @@ def tree_leaf_sort_key(leaf):
     else:
         return leaf.path + "/"
     
+#The type of the object a leaf points to, from its mode. Trees store modes as octal ASCII
+#(normalized to six characters), the upper bits of which give the type.
+def tree_leaf_type(leaf):
+    match int(leaf.mode, 8) & 0o170000:
+        case 0o040000: return b'tree'
+        case 0o100000: return b'blob' # A regular file.
+        case 0o120000: return b'blob' # A symlink. Blob contents is link target.
+        case 0o160000: return b'commit' # A submodule
+        case _: raise Exception("Weird tree leaf mode {}".format(leaf.mode))
+
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
     ans = b''
@@ -294,43 +651,90 @@ def tree_serialize(obj):
         ans += sha.to_bytes(20, byteorder="big")
     return ans
 
-def ls_tree(repo, ref, recursive=None, prefix=""):
+#With abbrev set, object names are shortened to abbrev digits, or more when needed to keep them
+#unambiguous. With long set, the size of each blob is shown too, like git's ls-tree -l: it comes
+#from object_info, so blobs are never read.
+def ls_tree(repo, ref, recursive=None, prefix="", abbrev=None, long=False):
     sha = object_find(repo, ref, fmt=b"tree")
     obj = object_read(repo, sha)
     for item in obj.items:
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
-        else:
-            type = item.mode[0:2]
-
-        match type: # Determine the type.
-            case b'04': type = "tree"
-            case b'10': type = "blob" # A regular file.
-            case b'12': type = "blob" # A symlink. Blob contents is link target.
-            case b'16': type = "commit" # A submodule
-            case _: raise Exception("Weird tree leaf mode {}".format(item.mode))
+        # The type comes from the mode, which git writes without its leading 0 for trees.
+        type = tree_leaf_type(item).decode("ascii")
 
         if not (recursive and type=='tree'): # This is a leaf
-            print("{0} {1} {2}\t{3}".format(
-                "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
+            name = gitOidIndex.oid_index(repo).abbrev(item.sha, abbrev) if abbrev else item.sha
+            if long:
+                # Trees and submodules have no size to show.
+                size = object_info(repo, item.sha)[1] if type == "blob" else "-"
+                name = "{0} {1:>7}".format(name, size)
+            print("{0:06o} {1} {2}\t{3}".format(
+                int(item.mode, 8),
                 # Git's ls-tree displays the type
                 # of the object pointed to.  We can do that too :)
                 type,
-                item.sha,
+                name,
                 os.path.join(prefix, item.path)))
         else: # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
-    
+            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path), abbrev, long)
+
+#Blobs are written chunk by chunk as they are inflated, so a big file doesn't have to fit in memory.
 def tree_checkout(repo, tree, path):
     for item in tree.items:
-        obj = object_read(repo, item.sha)
+        fmt, _, chunks = object_read_stream(repo, item.sha)
         dest = os.path.join(path, item.path)
-        if obj.fmt == b'tree':
+        if fmt == b'tree':
+            chunks.close()
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
+            tree_checkout(repo, object_read(repo, item.sha), dest)
+        elif fmt == b'blob':
             with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+                for chunk in chunks:
+                    f.write(chunk)
+
+#Checking out a big tree one file at a time leaves the machine waiting on I/O most of the time.
+#The parallel checkout first walks the trees to create every directory, which is cheap and
+#needs to happen before anything gets written in them, then hands the blobs to a pool of
+#threads that inflate and write them (zlib and file writes release the GIL). Failures are
+#collected, and reported in the order of the walk, whatever order the threads ran in.
+def tree_checkout_parallel(repo, tree, path, jobs):
+    blobs = list()
+    todo = [ (tree, path) ]
+    while todo:
+        tree, path = todo.pop()
+        for item in tree.items:
+            dest = os.path.join(path, item.path)
+            type = tree_leaf_type(item)
+            if type == b'tree':
+                os.mkdir(dest)
+                todo.append((object_read(repo, item.sha), dest))
+            elif type == b'blob':
+                blobs.append((item.sha, dest))
+
+    # Make sure the packs are opened before the threads start looking objects up.
+    gitPack.pack_list(repo)
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [ pool.submit(blob_checkout, repo, sha, dest) for sha, dest in blobs ]
+
+    failures = list()
+    for (sha, dest), future in zip(blobs, futures):
+        if future.exception():
+            failures.append("{0}: {1}".format(dest, future.exception()))
+    if failures:
+        raise Exception("Checkout failed for {0} files:\n - {1}".format(len(failures), "\n - ".join(failures)))
+
+def blob_checkout(repo, sha, dest):
+    stream = object_read_stream(repo, sha)
+    if stream is None:
+        raise Exception("Missing object {0}".format(sha))
+    fmt, _, chunks = stream
+    if fmt != b'blob':
+        chunks.close()
+        raise Exception("Object {0} is a {1}, not a blob".format(sha, fmt.decode("ascii")))
+    with open(dest, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
 
 """End of reading commit data section"""
 
@@ -342,43 +746,78 @@ def tree_checkout(repo, tree, path):
 #We call: reference on the form ref: path/to/other/ref and indirect ref.
 #         reference with SHA1-objectID a direct ref. 
 
-#This function is a simple recursive solver that will take a ref name 
-#as well as its indirect reference in the form of path/to/other/ref
-#and return a SHA-1 identifier
+#Refs can also be packed all together in .git/packed-refs (see gitRefs). A loose ref, in its own
+#file, wins over the same ref in packed-refs. ref_read returns what a ref holds (a SHA, or
+#"ref: path/to/other/ref"), or None if there's no such ref.
+def ref_read(repo, ref):
+    path = gitRepo.repo_path(repo, *ref.split("/"))
+    if os.path.isfile(path):
+        with open(path, 'r') as fp:
+            return fp.read().rstrip("\n")
+    if ref.startswith("refs/"):
+        return gitRefs.packed_refs_read(repo).get(ref)
+    return None
+
+#This function is a simple solver that will take a ref name (HEAD, or a full name such as
+#refs/heads/master), follow indirect references, and return a SHA-1 identifier.
+REF_DEPTH_MAX = 5
+
 def ref_resolve(repo, ref):
-    path = gitRepo.repo_file(repo, ref)
-    if not os.path.isfile(path):
+    for i in range(REF_DEPTH_MAX):
+        data = ref_read(repo, ref)
+        if data is None or not data.startswith("ref: "):
+            return data
+        ref = data[5:]
+    raise Exception("Too many levels of indirect refs: {0}".format(ref))
+
+#(name, contents) of the loose refs whose name starts with prefix, in no particular order.
+def ref_list_loose(repo, prefix="refs/"):
+    top = gitRepo.repo_path(repo, *prefix.rstrip("/").split("/"))
+    for root, dirs, files in os.walk(top):
+        rel = os.path.relpath(root, repo.gitdir).replace(os.sep, "/")
+        for f in files:
+            if f.endswith(".lock"):
+                continue
+            name = rel + "/" + f
+            if name.startswith(prefix):
+                yield name, ref_read(repo, name)
+
+#This function list all references whose name starts with prefix (which ends with a slash), as
+#(name, sha) pairs sorted by name like actual Git. Packed refs come sorted from the cache, and
+#loose refs, usually few, are merged in.
+def ref_list(repo, prefix="refs/"):
+    refs = dict(gitRefs.packed_refs_read(repo).prefix(prefix))
+    for name, data in ref_list_loose(repo, prefix):
+        sha = ref_resolve(repo, name) if data.startswith("ref: ") else data
+        if sha:
+            refs[name] = sha
+    # Mostly sorted already: this sort is close to linear.
+    return sorted(refs.items())
+
+#The object a ref finally points to once every tag is followed, or None if it doesn't point to
+#an annotated tag. Packed refs know it already: no object has to be read for them.
+def ref_peel(repo, name, sha):
+    packed = gitRefs.packed_refs_read(repo)
+    if packed.fully_peeled and packed.get(name) == sha:
+        return packed.peeled.get(name)
+    obj = object_read(repo, sha)
+    if obj is None or obj.fmt != b'tag':
         return None
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
-
-#This function list all references in a repository sorted similar to actual Git
-def ref_list(repo, path=None):
-    if not path:
-        path = gitRepo.repo_dir(repo, "refs")
-    ret = collections.OrderedDict()
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
-
-    return ret
+    while obj is not None and obj.fmt == b'tag':
+        sha = obj.kvlm[b'object'].decode("ascii")
+        obj = object_read(repo, sha)
+    return sha
 
-def show_ref(repo, refs, with_hash=True, prefix=""):
-    for k, v in refs.items():
-        if type(v) == str:
-            print ("{0}{1}{2}".format(
-                v + " " if with_hash else "",
-                prefix + "/" if prefix else "",
-                k))
-        else:
-            show_ref(repo, v, with_hash=with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
+#Print refs, a list of (name, sha), the way show-ref does, without strip at the start of names.
+#With dereference, annotated tags get a second line, with the object they point to.
+def show_ref(repo, refs, with_hash=True, strip="", dereference=False):
+    for name, sha in refs:
+        short = name[len(strip):] if name.startswith(strip) else name
+        print ("{0}{1}".format(sha + " " if with_hash else "", short))
+        if dereference:
+            peeled = ref_peel(repo, name, sha)
+            if peeled:
+                print ("{0}{1}^{{}}".format(peeled + " " if with_hash else "", short))
 
 #The most simple use of refs is tags. A tag is just a user-defined name for an object, often a commit.
 #One of the common use of tag is for identifying software releasing.
@@ -392,22 +831,55 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
 def tag_create(repo, name, ref, create_tag_object = False):
     sha = object_find(repo, ref)
     if create_tag_object:
-        tag = gitSubObject.GitTag(repo)
+        tag = gitSubObject.GitTag()
         tag.kvlm = collections.OrderedDict()
         tag.kvlm[b'object'] = sha.encode()
-        tag.kvlm[b'type'] = b'commit'
+        tag.kvlm[b'type'] = object_read(repo, sha).fmt
         tag.kvlm[b'tag'] = name.encode()
-        tag.kvlm[b'tagger'] = b'Wyag <tandinh0907@gmail.com>'
+        tag.kvlm[b'tagger'] = 'Wyag <tandinh0907@gmail.com> {0} +0000'.format(int(time.time())).encode()
         tag.kvlm[None] = b"A tag generated by wyag"
-        tag_sha = object_write(tag)
+        tag_sha = object_write(tag, repo)
         ref_create(repo, "tags/" + name, tag_sha)
     else:
         ref_create(repo, "tags/" + name, sha)
 
+#Refs are always created loose: they win over packed-refs until the next pack-refs.
 def ref_create(repo, ref_name, sha):
-    with open(gitRepo.repo_file(repo, "refs/" + ref_name), 'w') as fp:
+    with open(gitRepo.repo_file(repo, "refs", *ref_name.split("/"), mkdir=True), 'w') as fp:
         fp.write(sha + "\n")
 
+#pack-refs moves loose refs into packed-refs: the tags (every ref with all, branches being
+#updated often, git leaves them loose by default), along with what's already packed. Annotated
+#tags get their peeled line. The loose files are then deleted, unless they changed meanwhile.
+#Returns the number of refs moved.
+def pack_refs(repo, all=False):
+    lock = gitRefs.packed_refs_lock(repo)
+    try:
+        refs = dict(gitRefs.packed_refs_read(repo).prefix("refs/"))
+        moved = list()
+        for name, data in ref_list_loose(repo):
+            if data.startswith("ref: ") or not (all or name.startswith("refs/tags/")):
+                continue
+            refs[name] = data
+            moved.append((name, data))
+        entries = [ (name, sha, ref_peel(repo, name, sha)) for name, sha in sorted(refs.items()) ]
+    except:
+        gitRefs.packed_refs_unlock(repo, lock)
+        raise
+    gitRefs.packed_refs_write(repo, lock, entries)
+
+    for name, sha in moved:
+        if ref_read(repo, name) != sha:
+            continue
+        path = gitRepo.repo_path(repo, *name.split("/"))
+        os.unlink(path)
+        # Remove the directories left empty, but keep refs/heads and refs/tags.
+        parent = os.path.dirname(path)
+        while len(os.path.relpath(parent, repo.gitdir).split(os.sep)) > 2 and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    return len(moved)
+
 #Now, what is a branch? Simply, a branch is a reference to a commit. 
 #Some could even say that a branch is a kind of a name for a commit.
 #Tags are refs that live in .git/refs/tags, branches are refs that live in .git/refs/heads.
@@ -444,116 +916,121 @@ def ref_create(repo, ref_name, sha):
 
 #This parser function is for reading index files into object by reading the 12-bytes header,
 #then parse entries in the order they appear; An entry appear with a fixed-length data,
-#follow by a variable-length name.
-
-def index_read(repo):
+#follow by a variable-length name. The decoding itself is done by gitIndexFile, which maps the
+#file in memory: commands that only need a few entries use it directly, through index_open.
+def index_open(repo):
+    import gitIndexFile
     index_file = gitRepo.repo_file(repo, "index")
 
     # New repositories have no index!
     if not os.path.exists(index_file):
+        return None
+    return gitIndexFile.GitIndexFile(index_file)
+
+#We also remember when the index file was written. Stat data only tells a file is unchanged
+#if it was recorded after the last change of the file: a file written in the same instant as
+#the index (timestamps have a limited resolution), then changed again without changing its size
+#or its mtime, would look clean. So entries whose mtime isn't strictly before the index's own
+#mtime are "racy", and their content must be checked (see index_entry_racy).
+#With columns, the stat data is also gathered in columns while the file is open, for status to
+#compare it to the worktree all at once (see index_columns).
+def index_read(repo, columns=False):
+    f = index_open(repo)
+    if f is None:
         return gitSubObject.GitIndex()
 
-    with open(index_file, 'rb') as f:
-        raw = f.read()
-
-    header = raw[:12]
-    signature = header[:4]
-    assert signature == b"DIRC" # Stands for "DirCache"
-    version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
-    count = int.from_bytes(header[8:12], "big")
-
-    entries = list()
-
-    content = raw[12:]
-    idx = 0
-    for i in range(0, count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-        mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        # SHA (object ID).  We'll store it as a lowercase hex string
-        # for consistency.
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-        # Parse flags
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage =  flags & 0b0011000000000000
-        # Length of the name.  This is stored on 12 bits, some max
-        # value is 0xFFF, 4095.  Since names can occasionally go
-        # beyond that length, git treats 0xFFF as meaning at least
-        # 0xFFF, and looks for the final 0x00 to find the end of the
-        # name --- at a small, and probably very rare, performance
-        # cost.
-        name_length = flags & 0b0000111111111111
-
-        # We've read 62 bytes so far.
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
+    with f:
+        index = gitSubObject.GitIndex(version=f.version, entries=list(f))
+        index.mtime = f.mtime
+        index_read_extensions(index, f)
+        if columns:
+            index.columns = index_columns(repo, f, index)
+    return index
+
+#With NumPy installed, the stat data of big indexes can be compared to the worktree column by
+#column (see gitIndexColumns). Returns None when it wouldn't pay off: for small indexes, which
+#don't make up for the import of NumPy, or when core.columnarIndex is set to false.
+def index_columns(repo, f, index):
+    import gitIndexColumns
+    if len(index.entries) < gitIndexColumns.COLUMNS_MIN:
+        return None
+    if not repo.config.getboolean("core", "columnarIndex", fallback=True):
+        return None
+    if not gitIndexColumns.available():
+        return None
+    return gitIndexColumns.GitIndexColumns(f, [ e.name for e in index.entries ])
+
+#After the entries come the extensions, and finally the SHA-1 of the whole file.
+def index_read_extensions(index, f):
+    for signature, data in f.extensions():
+        if signature == b"TREE":
+            index.cache_tree = index_cache_tree_read(data)
+        elif signature == b"FSMN":
+            index_fsmonitor_read(index, data)
+        elif not (b"A" <= signature[0:1] <= b"Z"):
+            # Extensions whose signature doesn't begin with an uppercase letter are mandatory.
+            raise Exception("Unsupported index extension {0}".format(signature))
+
+#The TREE extension holds the cache tree. Each node is written as its path component, a NUL
+#byte, the number of entries it covers (-1 if invalid) and its number of subtrees in ASCII
+#decimal, separated by a space and ended by a newline, then its SHA if it is valid. Nodes come in
+#pre-order: each node is followed by its subtrees, the root comes first with an empty name.
+def index_cache_tree_read(data):
+    root = None
+    # Stack of (node, number of subtrees still to read).
+    stack = list()
+    pos = 0
+    while pos < len(data):
+        nul = data.index(b'\x00', pos)
+        name = data[pos:nul].decode("utf8")
+        lf = data.index(b'\n', nul)
+        entry_count, subtree_count = (int(x) for x in data[nul+1:lf].split(b' '))
+        pos = lf + 1
+        node = gitSubObject.GitCacheTree(entry_count)
+        if entry_count >= 0:
+            node.sha = data[pos:pos+20].hex()
+            pos += 20
+
+        if root is None:
+            root = node
         else:
-            print("Notice: Name is 0x{:X} bytes long.".format(name_length))
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
-
-        # Just parse the name as utf8.
-        name = raw_name.decode("utf8")
-
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
-
-        # And we add this entry to our list.
-        entries.append(gitSubObject.GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-
-    return gitSubObject.GitIndex(version=version, entries=entries)
+            while stack[-1][1] == 0:
+                stack.pop()
+            parent, left = stack.pop()
+            parent.subtrees[name] = node
+            stack.append((parent, left - 1))
+        stack.append((node, subtree_count))
+    return root
+
+def index_cache_tree_write(node, name=""):
+    out = [ "{0}\x00{1} {2}\n".format(name, node.entry_count, len(node.subtrees)).encode("utf8") ]
+    if node.valid():
+        out.append(bytes.fromhex(node.sha))
+    for sub_name in sorted(node.subtrees):
+        out.append(index_cache_tree_write(node.subtrees[sub_name], sub_name))
+    return b''.join(out)
+
+#The FSMN extension holds the token of the last query to the filesystem monitor, and an EWAH
+#bitmap of the entries that weren't known to be clean at that time. Bit positions are entry
+#positions, so this must be read once the entries are sorted.
+def index_fsmonitor_read(index, data):
+    import gitEwah
+    version = int.from_bytes(data[0:4], "big")
+    if version != 2:
+        # Version 1 holds a timestamp for a hook we don't support: just drop it.
+        return
+    nul = data.find(b'\x00', 4)
+    index.fsmonitor_token = data[4:nul].decode("ascii")
+    dirty, _, _ = gitEwah.ewah_decode(data, nul + 5)
+    for i, entry in enumerate(index.entries):
+        entry.fsmonitor_valid = not (dirty >> i) & 1
+
+def index_fsmonitor_write(index):
+    import gitEwah
+    dirty = gitEwah.bits_from_positions(i for i, e in enumerate(index.entries) if not e.fsmonitor_valid)
+    bitmap = gitEwah.ewah_encode(dirty, len(index.entries))
+    return (2).to_bytes(4, "big") + index.fsmonitor_token.encode("ascii") + b'\x00' \
+           + len(bitmap).to_bytes(4, "big") + bitmap
 
 #To run the check-ignore command, we need a header to read rules in ignores files.
 #The syntax of those rule are quite simple: each line in an ignore file is an exclusive pattern,
@@ -584,7 +1061,8 @@ def gitignore_parse(lines):
     return ret
 
 #This function collects all gitignore rules in a repository, and return a GitIgnore object.
-def gitignore_read(repo):
+#Commands that already read the index (like status) pass it, so that it isn't opened again.
+def gitignore_read(repo, index=None):
     ret = gitSubObject.GitIgnore(absolute = list(), scoped = dict())
     
     # Read local configuration in .git/info/exclude
@@ -604,15 +1082,26 @@ def gitignore_read(repo):
         with open(global_file, "r") as f:
             ret.absolute.append(gitignore_parse(f.readlines()))
 
-    # .gitignore files in the index
-    index = index_read(repo)
-
-    for entry in index.entries:
-        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
-            dir_name = os.path.dirname(entry.name)
-            contents = object_read(repo, entry.sha)
-            lines = contents.blobdata.decode("utf8").splitlines()
-            ret.scoped[dir_name] = gitignore_parse(lines)
+    if index is not None:
+        for entry in index.entries:
+            if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
+                contents = object_read(repo, entry.sha)
+                lines = contents.blobdata.decode("utf8").splitlines()
+                ret.scoped[os.path.dirname(entry.name)] = gitignore_parse(lines)
+        return ret
+
+    # .gitignore files in the index. We only need a few entries, so we don't decode the others.
+    index = index_open(repo)
+    if index is None:
+        return ret
+
+    with index:
+        for i, name in enumerate(index.names()):
+            if name == ".gitignore" or name.endswith("/.gitignore"):
+                dir_name = os.path.dirname(name)
+                contents = object_read(repo, index[i].sha)
+                lines = contents.blobdata.decode("utf8").splitlines()
+                ret.scoped[dir_name] = gitignore_parse(lines)
     return ret
 
 #Now, we need a check_ignore function that matches a path, relative to the root of the tree,
@@ -634,6 +1123,7 @@ def check_ignore(rules, path):
 #The first support function will match a path against a set of rules, and return the result
 #of the last matching rule.
 def check_ignore1(rules, path):
+    from fnmatch import fnmatch
     result = None
     for (pattern, value) in rules:
         if fnmatch(path, pattern):
@@ -652,6 +1142,7 @@ def check_ignore_scoped(rules, path):
                 return result
         if parent == "":
             break
+        parent = os.path.dirname(parent)
     return None
 
 #The third support function will match a path against the list of absolute rules.
@@ -698,7 +1189,7 @@ def tree_to_dict(repo, ref, prefix = ""):
 
     for leaf in tree.items:
         full_path = os.path.join(prefix, leaf.path)
-        is_subtree = leaf.mode.startswith(b'04')
+        is_subtree = tree_leaf_type(leaf) == b'tree'
 
         #Depend on the type, we either store the path (if it's a blob, so a regular file).
         #or recurse (if it's another tree, so a subdir)
@@ -713,7 +1204,8 @@ def tree_to_dict(repo, ref, prefix = ""):
 def status_head_index(repo, index):
     print("Changes to be committed:")
 
-    head = tree_to_dict(repo, "HEAD")
+    #Before the first commit, HEAD points to a branch that doesn't exist yet.
+    head = tree_to_dict(repo, "HEAD") if ref_resolve(repo, "HEAD") else dict()
     for entry in index.entries:
         if entry.name in head:
             if head[entry.name] != entry.sha:
@@ -727,23 +1219,61 @@ def status_head_index(repo, index):
 
 #This function takes in a repo and an index file to find the differences between 
 #the work tree and the input index file.
-def status_index_worktree(repo, index):
-    print("Changes not stage for commit:")
-    ignore = gitignore_read(repo)
-    gitdir_prefix = repo.gitdir + os.path.sep
-    all_files = list()
+#Files whose stat data changed are hashed again to know if they really changed. With refresh
+#(status --refresh, or status.refresh in the configuration), the stat data of those that didn't
+#is written back to the index, like update-index --refresh does.
+#Writing needs lock, the index lock taken before the index was read; it's released either way.
+def status_index_worktree(repo, index, refresh=False, lock=None):
+    try:
+        token, refreshed = status_index_worktree_entries(repo, index, refresh)
+    except:
+        if lock is not None:
+            index_unlock(repo, lock)
+        raise
+
+    #Remember which entries we found clean, and from when. This is only an optimization: if
+    #someone else is writing the index, we let them.
+    if token:
+        index.fsmonitor_token = token
+    if lock is not None:
+        if token or refreshed:
+            index_write(repo, index, lock)
+        else:
+            index_unlock(repo, lock)
+
+    print()
+    print("Untracked files:")
     
-    #We begin by walking the filesystem
-    for root, _, files in os.walk(repo.worktree, True):
-        if root == repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+    for f in worktree_untracked(repo, index, gitignore_read(repo, index)):
+        print(" ", f)
 
-    #We now traverse the index, and compare real files with cached versions.
-    for entry in index.entries:
+#Print the modified and deleted files. Returns the new filesystem monitor token (or None), and
+#the number of entries whose stat data was refreshed.
+def status_index_worktree_entries(repo, index, refresh):
+    print("Changes not stage for commit:")
+    token, changed = status_fsmonitor(repo, index)
+    entries = index.entries
+    #Without the filesystem monitor, big indexes read with their columns have their stat data
+    #compared all at once: only the entries that may have changed are looked at below, the
+    #others are clean.
+    if not changed and index.columns is not None:
+        if token:
+            for entry in entries:
+                entry.fsmonitor_valid = True
+        entries = [ entries[i] for i in index.columns.flagged(repo.worktree, index.mtime) ]
+    refreshed = 0
+
+    #We traverse the index, and compare real files with cached versions.
+    for entry in entries:
+        #Files outside of the sparse checkout aren't in the worktree on purpose.
+        if entry.flag_skip_worktree:
+            continue
+        #Entries the filesystem monitor vouches for are skipped without even a stat.
+        if changed and entry.fsmonitor_valid and not fsmonitor_changed(entry.name, *changed):
+            continue
+        #Racy entries can't be trusted on their stat data alone.
+        racy = index_entry_racy(index, entry)
+        entry.fsmonitor_valid = False
         full_path = os.path.join(repo.worktree, entry.name)
         #That file name is in the index
         if not os.path.exists(full_path):
@@ -751,42 +1281,272 @@ def status_index_worktree(repo, index):
         else:
             stat = os.stat(full_path)
             #compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
+            if racy or not index_entry_stat_matches(entry, stat):
                 # If different, deep compare.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    # If the hashes are the same, the files are actually the same.
-                    same = entry.sha == new_sha
-                    if not same:
-                        print("  modified:", entry.name)
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+                # If the hashes are the same, the files are actually the same.
+                same = entry.sha == blob_hash_file(full_path)
+                if not same:
+                    print("  modified:", entry.name)
+                else:
+                    entry.fsmonitor_valid = True
+                    if refresh:
+                        index_entry_stat_update(entry, stat)
+                        refreshed += 1
+            else:
+                entry.fsmonitor_valid = True
+    return token, refreshed
+
+#With core.fsmonitor set, we ask the filesystem monitor (see gitFsmonitor) what changed since
+#the token stored in the index. Returns the new token, and the (files, directories) that
+#changed, or None if every entry has to be checked: when there's no watcher running, or when
+#our token is too old for it.
+def status_fsmonitor(repo, index):
+    if not repo.config.getboolean("core", "fsmonitor", fallback=False):
+        return None, None
+    import gitFsmonitor
+    answer = gitFsmonitor.fsmonitor_query(repo, index.fsmonitor_token)
+    if answer is None:
+        return None, None
+    token, files, dirs = answer
+    if files is None:
+        return token, None
+    return token, (files, dirs)
+
+def fsmonitor_changed(name, files, dirs):
+    if name in files:
+        return True
+    parent = os.path.dirname(name)
+    while dirs and parent:
+        if parent in dirs:
+            return True
+        parent = os.path.dirname(parent)
+    return False
 
-    print()
-    print("Untracked files:")
-    
-    for f in all_files:
-        if not check_ignore(ignore, f):
-            print(" ", f)
+#Finding untracked files means listing the whole worktree, and running every file that isn't
+#in the index through the ignore rules. Most of the time, almost nothing changed since the
+#last status, so we keep the result around in .git/untracked-cache, in the spirit of git's
+#UNTR index extension. For each directory, it records:
+#   _its mtime: creating, deleting or renaming an entry of a directory changes its mtime, so
+#    while it's the same, the listing of the directory is still valid and we don't redo it.
+#   _the files and subdirectories it holds.
+#   _whether each of its files not in the index is ignored. This is only valid for a given set
+#    of ignore rules, so we store a fingerprint of the rules, and forget every result when the
+#    .gitignore blobs or info/exclude change.
+#Like for the index, a directory changed in the same instant we listed it would keep its mtime,
+#so we don't trust listings taken less than UNTRACKED_CACHE_RACY_NS after the directory changed.
+#The cache can be disabled by setting core.untrackedCache to false.
+UNTRACKED_CACHE_RACY_NS = 2 * 10**9
+
+def worktree_untracked(repo, index, ignore):
+    use_cache = repo.config.getboolean("core", "untrackedCache", fallback=True)
+    cache = untracked_cache_read(repo) if use_cache else dict()
+    fingerprint = gitignore_fingerprint(ignore)
+    changed = cache.get("ignore") != fingerprint
+    old_dirs = cache.get("dirs", dict())
+    if changed:
+        for entry in old_dirs.values():
+            entry["ignored"] = dict()
+
+    tracked = set(e.name for e in index.entries)
+    dirs = dict()
+    result = list()
+    todo = [ "" ]
+    while todo:
+        rel = todo.pop()
+        full = os.path.join(repo.worktree, rel)
+        mtime = os.stat(full).st_mtime_ns
+        entry = old_dirs.get(rel)
+        if not (entry and entry["mtime"] == mtime and entry["listed_at"] - mtime > UNTRACKED_CACHE_RACY_NS):
+            entry = { "mtime": mtime, "listed_at": time.time_ns(), "files": list(), "dirs": list(), "ignored": dict() }
+            for f in sorted(os.scandir(full), key=lambda f: f.name):
+                if rel == "" and f.name == ".git":
+                    continue
+                if f.is_dir(follow_symlinks=False):
+                    entry["dirs"].append(f.name)
+                else:
+                    entry["files"].append(f.name)
+            changed = True
+        dirs[rel] = entry
+
+        for f in entry["files"]:
+            path = os.path.join(rel, f)
+            if path in tracked:
+                continue
+            ignored = entry["ignored"].get(f)
+            if ignored is None:
+                ignored = check_ignore(ignore, path)
+                entry["ignored"][f] = ignored
+                changed = True
+            if not ignored:
+                result.append(path)
+
+        for d in reversed(entry["dirs"]):
+            todo.append(os.path.join(rel, d))
+
+    if use_cache and (changed or len(dirs) != len(old_dirs)):
+        untracked_cache_write(repo, { "ignore": fingerprint, "dirs": dirs })
+    return result
+
+def untracked_cache_read(repo):
+    import json
+    path = gitRepo.repo_file(repo, "untracked-cache")
+    if not os.path.exists(path):
+        return dict()
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        # A corrupt cache is just an empty one.
+        return dict()
+
+def untracked_cache_write(repo, cache):
+    import json
+    path = gitRepo.repo_file(repo, "untracked-cache")
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(path + ".tmp", path)
+
+#Two sets of rules with the same fingerprint ignore the same files.
+def gitignore_fingerprint(rules):
+    return hashlib.sha1(repr((rules.absolute, sorted(rules.scoped.items()))).encode("utf8")).hexdigest()
 
 #Now about the commit command
 
+#Compare an entry to the stat data of its file: its times (any change to the file, even of its
+#metadata, changes its ctime) and its size. The size also catches entries smudged by index_write.
+def index_entry_stat_matches(entry, stat):
+    ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
+    mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+    return (stat.st_ctime_ns == ctime_ns and stat.st_mtime_ns == mtime_ns
+            and stat.st_size & 0xffffffff == entry.fsize)
+
+def index_entry_racy(index, entry):
+    return index.mtime is not None and entry.mtime[0] * 10**9 + entry.mtime[1] >= index.mtime
+
+#Record the stat data of a file in its entry. The index only has 32 bits for each field.
+#This doesn't change the entry's key or SHA, so it's fine on entries already in the index.
+def index_entry_stat_update(entry, stat):
+    entry.ctime = (int(stat.st_ctime) & 0xffffffff, stat.st_ctime_ns % 10**9)
+    entry.mtime = (int(stat.st_mtime) & 0xffffffff, stat.st_mtime_ns % 10**9)
+    entry.dev = stat.st_dev & 0xffffffff
+    entry.ino = stat.st_ino & 0xffffffff
+    entry.uid = stat.st_uid & 0xffffffff
+    entry.gid = stat.st_gid & 0xffffffff
+    entry.fsize = stat.st_size & 0xffffffff
+
+#Refreshing the index is checking every entry against its file, and recording the new stat
+#data of the files whose stat data changed but whose content didn't (they were only touched,
+#or copied back and forth), so that we don't have to hash them again the next time.
+#Returns the number of refreshed entries, and the names of the files that really changed.
+def index_refresh(repo, index):
+    refreshed = 0
+    changed = list()
+    for entry in index.entries:
+        if entry.flag_skip_worktree:
+            continue
+        full_path = os.path.join(repo.worktree, entry.name)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            changed.append(entry.name)
+            continue
+        if index_entry_stat_matches(entry, stat) and not index_entry_racy(index, entry):
+            continue
+        if blob_hash_file(full_path) != entry.sha:
+            changed.append(entry.name)
+            continue
+        index_entry_stat_update(entry, stat)
+        refreshed += 1
+    return refreshed, changed
+
+def blob_hash_file(path):
+    with open(path, "rb") as fd:
+        return object_hash(fd, b"blob", None)
+
+#This is the update-index --refresh command. The whole read-refresh-write runs under the index
+#lock, so that an add running at the same time can't be lost.
+def update_index_refresh(repo, quiet=False):
+    lock = index_lock(repo)
+    try:
+        index = index_read(repo)
+        refreshed, changed = index_refresh(repo, index)
+    except:
+        index_unlock(repo, lock)
+        raise
+    if refreshed:
+        index_write(repo, index, lock)
+    else:
+        index_unlock(repo, lock)
+    if not quiet:
+        for name in changed:
+            print("{0}: needs update".format(name))
+    return changed
+
+#Every write of the index goes through index.lock: it is created exclusively (so two writers
+#can't run at once), the new index is written into it, and it's then renamed over the index,
+#which is atomic: readers see either the old index or the new one, never half of it.
+def index_lock(repo):
+    lock = index_try_lock(repo)
+    if lock is None:
+        raise Exception("Unable to create {0}: another wyag process seems to be running. "
+                        "If not, remove this file.".format(gitRepo.repo_path(repo, "index.lock")))
+    return lock
+
+#Same as index_lock, but returns None when the lock is already held.
+def index_try_lock(repo):
+    try:
+        return os.open(gitRepo.repo_path(repo, "index.lock"), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return None
+
+def index_unlock(repo, lock):
+    os.close(lock)
+    os.unlink(gitRepo.repo_path(repo, "index.lock"))
+
 #We'll start writing the index file by, roughly, just serializing everything back to binary.
-def index_write(repo, index):
-    with open(gitRepo.repo_file(repo, "index"), "wb") as f:
+#The version written is the one set by index.version in the repository's configuration, or the
+#one the index was read with. Like git, we write version 3 only when some entry actually has
+#extended flags, and version 2 otherwise.
+#The index is written through index.lock: pass lock if it's already held.
+#
+#Racy entries (see index_read) are only safe while the index keeps the mtime it was written
+#with: once the index is written again at a later time, their stat data would be trusted, and
+#a change made in the same instant the stat data was taken would never be seen. So like git,
+#we "smudge" the entries whose mtime isn't before the second the index is written, by setting
+#their size to 0: their stat data doesn't match their file anymore (index_entry_stat_matches
+#compares sizes), and their content is checked until their stat data is recorded again, later.
+#An empty file still matches, but its content can't change without changing its size.
+def index_write(repo, index, lock=None):
+    import gitIndexFile
+    now = int(time.time())
+    for e in index.entries:
+        if e.mtime[0] >= now & 0xffffffff:
+            e.fsize = 0
+
+    version = repo.config.getint("index", "version", fallback=index.version)
+    if version not in gitIndexFile.VERSIONS:
+        raise Exception("Unsupported index.version {0}".format(version))
+    extended = any(e.flag_skip_worktree or e.flag_intent_to_add for e in index.entries)
+    if version < 4:
+        version = 3 if extended else 2
+    index.version = version
+
+    # The index is built in memory first, since it ends with the SHA-1 of its own content.
+    with io.BytesIO() as f:
         # HEADER
         # Write the magic bytes.
         f.write(b"DIRC")
         # Write version number.
-        f.write(index.version.to_bytes(4, "big"))
+        f.write(version.to_bytes(4, "big"))
         # Write the number of entries.
         f.write(len(index.entries).to_bytes(4, "big"))
 
         # ENTRIES
         idx = 0
+        previous_name = b''
+        offsets = list()
         for e in index.entries:
+            offsets.append(12 + idx)
             f.write(e.ctime[0].to_bytes(4, "big"))
             f.write(e.ctime[1].to_bytes(4, "big"))
             f.write(e.mtime[0].to_bytes(4, "big"))
@@ -809,14 +1569,34 @@ def index_write(repo, index):
             else:
                 name_length = bytes_len
 
+            flag_extended = 0x1 << 14 if e.flag_skip_worktree or e.flag_intent_to_add else 0
+
             # We merge back three pieces of data (two flags and the
             # length of the name) on the same two bytes.
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+            f.write((flag_assume_valid | flag_extended | e.flag_stage | name_length).to_bytes(2, "big"))
+            idx += 62
+            if flag_extended:
+                flag_skip_worktree = 0x1 << 14 if e.flag_skip_worktree else 0
+                flag_intent_to_add = 0x1 << 13 if e.flag_intent_to_add else 0
+                f.write((flag_skip_worktree | flag_intent_to_add).to_bytes(2, "big"))
+                idx += 2
+
+            if version == 4:
+                # Only write what differs from the previous name.
+                common = 0
+                limit = min(len(previous_name), bytes_len)
+                while common < limit and previous_name[common] == name_bytes[common]:
+                    common += 1
+                f.write(gitPack.delta_offset_encode(len(previous_name) - common))
+                f.write(name_bytes[common:])
+                f.write(b'\x00')
+                previous_name = name_bytes
+                continue
 
             # Write back the name, and a final 0x00.
             f.write(name_bytes)
             f.write((0).to_bytes(1, "big"))
-            idx += 62 + len(name_bytes) + 1
+            idx += len(name_bytes) + 1
 
             # Add padding if necessary.
             if idx % 8 != 0:
@@ -824,14 +1604,54 @@ def index_write(repo, index):
                 f.write((0).to_bytes(pad, "big"))
                 idx += pad
 
+        # EXTENSIONS
+        extensions = list()
+        if index.cache_tree is not None:
+            extensions.append((b"TREE", index_cache_tree_write(index.cache_tree)))
+        if index.fsmonitor_token:
+            extensions.append((b"FSMN", index_fsmonitor_write(index)))
+        # Big indexes also get the table of the offsets of their entries, so that
+        # gitIndexFile doesn't have to walk them all.
+        if version < 4 and len(offsets) >= gitIndexFile.OFFSETS_MIN:
+            extensions.append((b"IEOT", gitIndexFile.offsets_table_encode(offsets)))
+            extensions.append((b"EOIE", gitIndexFile.eoie_encode(f.tell(), extensions)))
+
+        for signature, data in extensions:
+            f.write(signature + len(data).to_bytes(4, "big") + data)
+
+        content = f.getvalue()
+
+    if lock is None:
+        lock = index_lock(repo)
+    try:
+        with os.fdopen(lock, "wb") as f:
+            f.write(content)
+            f.write(hashlib.sha1(content).digest())
+        os.replace(gitRepo.repo_path(repo, "index.lock"), gitRepo.repo_path(repo, "index"))
+    except:
+        if os.path.exists(gitRepo.repo_path(repo, "index.lock")):
+            os.unlink(gitRepo.repo_path(repo, "index.lock"))
+        raise
+
 #The rm function takes a repository and a list of paths, reads that repo index,
 #and remove entries in the index that match this list. The optional argument control
 #whether the function should actually delete the files, and whether it should abort
 #if some paths aren't on the index (both arguments are for the use of 'add' command,
 #they are not exposed in this 'rm' command).
 def rm(repo, paths, delete=True, skip_missing=False):
-    #Find and read the index
-    index = index_read(repo)
+    #Find and read the index, under its lock
+    lock = index_lock(repo)
+    try:
+        index = index_read(repo)
+        index_remove(repo, index, paths, delete, skip_missing)
+    except:
+        index_unlock(repo, lock)
+        raise
+    index_write(repo, index, lock)
+
+#This does the actual work of 'rm' on an index in memory, so that 'add' can use it on the index
+#it has already read. Every path is found with a binary search in the sorted index.
+def index_remove(repo, index, paths, delete=True, skip_missing=False):
     worktree = repo.worktree + os.sep
 
     #Make path absolute
@@ -843,42 +1663,39 @@ def rm(repo, paths, delete=True, skip_missing=False):
         else:
             raise Exception("Cannot remove path outside of worktree: {}".format(paths))
 
-    kept_entries = list()
     remove = list()
+    missing = list()
 
-    for e in index.entries:
-        full_path = os.path.join(repo.worktree, e.name)
-        if full_path in abspaths:
-            remove.append(full_path)
-            abspaths.remove(full_path)
+    for abspath in abspaths:
+        if index.remove(os.path.relpath(abspath, repo.worktree)):
+            remove.append(abspath)
         else:
-            kept_entries.append(e) #Preserve entry
+            missing.append(abspath)
 
-    if len(abspaths) > 0 and not skip_missing:
-        raise Exception("Cannot remove paths not in the index: {}".format(abspaths))
+    if len(missing) > 0 and not skip_missing:
+        raise Exception("Cannot remove paths not in the index: {}".format(missing))
     
     if delete:
         for path in remove:
             os.unlink(path)
 
-    index.entries = kept_entries
-    index_write(repo, index)
-
 #The 'add' command consist of 4 step:
 #   _Begin by removing existing index entry, if there's one, without removing the file itself (this is 
 #    why the 'rm' function has those optional arguments).
 #   _Then hash the file into a glob oject
 #   _Create its entry
 #   _Finally write the modified index back
-def add(repo, paths, delete=True, skip_missing=False):
-
-    # First remove all paths from the index, if they exist.
-    rm (repo, paths, delete=False, skip_missing=True)
-
+#The index is read once, modified in memory, and written once.
+#Files are hashed by jobs threads. With jobs None, that's one per CPU when there are at least
+#ADD_PARALLEL_MIN bytes to hash, and a single one otherwise: below that, starting the pool (and
+#importing concurrent.futures, which takes about as long as compressing a megabyte) costs more
+#than it saves.
+ADD_PARALLEL_MIN = 4 * 1024 * 1024
+
+def add(repo, paths, delete=True, skip_missing=False, jobs=1):
     worktree = repo.worktree + os.sep
 
     # Convert the paths to pairs: (absolute, relative_to_worktree).
-    # Also delete them from the index if they're present.
     clean_paths = list()
     for path in paths:
         abspath = os.path.abspath(path)
@@ -886,34 +1703,49 @@ def add(repo, paths, delete=True, skip_missing=False):
             raise Exception("Not a file, or outside the worktree: {}".format(paths))
         relpath = os.path.relpath(abspath, repo.worktree)
         clean_paths.append((abspath,  relpath))
+    if jobs is None:
+        size = sum(os.path.getsize(abspath) for (abspath, _) in clean_paths)
+        jobs = (os.cpu_count() or 1) if size >= ADD_PARALLEL_MIN else 1
+    jobs = min(jobs, len(clean_paths))
+
+    # Find and read the index (under its lock), then remove all paths from it, if they exist.
+    lock = index_lock(repo)
+    try:
+        index = index_read(repo)
+        index_remove(repo, index, paths, delete=False, skip_missing=True)
+
+        # Hashing and compressing is the slow part, and both hashlib and zlib release the GIL on
+        # big buffers, so with jobs > 1 we do it in a pool of threads. The results come back in
+        # the order of the paths, so the index ends up exactly as with the serial path.
+        if jobs > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                hashed = list(pool.map(lambda p: blob_hash_stat(repo, p[0]), clean_paths))
+        else:
+            hashed = [ blob_hash_stat(repo, abspath) for (abspath, _) in clean_paths ]
+    except:
+        index_unlock(repo, lock)
+        raise
 
-    # Find and read the index. It was modified by rm. (This isn't optimal but
-    # is okish for educational purpose).
-    index = index_read(repo)
-
-    for (abspath, relpath) in clean_paths:
-        with open(abspath, "rb") as fd:
-            sha = object_hash(fd, b"blob", repo)
-
-        stat = os.stat(abspath)
-
-        ctime_s = int(stat.st_ctime)
-        ctime_ns = stat.st_ctime_ns % 10**9
-        mtime_s = int(stat.st_mtime)
-        mtime_ns = stat.st_mtime_ns % 10**9
-
-        entry = gitSubObject.GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                            mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                            fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                            flag_stage=False, name=relpath)
-        index.entries.append(entry)
+    for (abspath, relpath), (sha, stat) in zip(clean_paths, hashed):
+        entry = gitSubObject.GitIndexEntry(mode_type=0b1000, mode_perms=0o644, sha=sha,
+                            flag_assume_valid=False, flag_stage=False, name=relpath)
+        index_entry_stat_update(entry, stat)
+        index.add(entry)
 
     # Write the index back
-    index_write(repo, index)
+    index_write(repo, index, lock)
+
+#Write a file as a blob, and return its SHA along with its stat data.
+def blob_hash_stat(repo, abspath):
+    with open(abspath, "rb") as fd:
+        sha = object_hash(fd, b"blob", repo)
+    return sha, os.stat(abspath)
 
 #First, we need to read git's config to get the name of the user, 
 #which we'll use as the author and committer. 
 def gitconfig_read():
+    import configparser
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
     configfiles = [
         os.path.expanduser(os.path.join(xdg_config_home, "git/config")),
@@ -930,72 +1762,59 @@ def gitconfig_user_get(config):
             return "{} <{}>".format(config["user"]["name"], config["user"]["email"])
     return None
 
-#In order to build a tree from the index file, we're going to:
-#   _Build a dictionary (hashmap) of directories. Keys are full paths from worktree root,
-#    value are list of 'GitIndexEntry' files in the directory. At this point, our dictionary
-#    only contains files: directories are only its key
-#   _Traverse this list, going bottom-up, that is, from the deepest directory up to root (deep
-#    doesn't really matter: we just want to see each directory before its parent. To do that, 
-#    we just sort them by full path length, from longest to shortest - parents are obviously always shorter).
-#   _At each directory, we build a tree with its contain.
-#   _Write the new tree to the repository.
-#   _Add this tree to this directory's parent. 
-#   _Iterate over the next directory.
+#In order to build a tree from the index file, we're going to walk the (sorted) index once.
+#Since entries are sorted by full path, all the entries under a given directory are next to each
+#other, so a directory is just a run of consecutive entries sharing its path as a prefix:
+#   _Files directly in the directory become leaves of its tree.
+#   _The first entry under a subdirectory starts a recursive call, which builds and writes the
+#    subdirectory's tree, and tells us where its run of entries ends.
+#   _Once the run is over, we write the tree of the directory itself.
+#
+#This is where the cache tree (the TREE extension of the index) pays off: it knows the SHA of
+#the tree built last time for each directory, and how many entries it covers. When the node of
+#a subdirectory is still valid (nothing under it was added or removed since), we reuse its SHA
+#and jump over its entries at once, without reading them. After a commit that touched one file,
+#only the trees on the path to that file have to be built again.
 def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
-
-    # Enumerate entries, and turn them into a dictionary where keys
-    # are directories, and values are lists of directory contents.
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-        # We create all dictonary entries up to root ("").  We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree.
-        key = dirname
-        while key != "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
-        # For now, simply store the entry in the list.
-        contents[dirname].append(entry)
-
-    # Get keys (= directories) and sort them by length, descending.
-    # This means that we'll always encounter a given path before its
-    # parent, which is all we need, since for each directory D we'll
-    # need to modify its parent P to add D's tree.
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
-
-    # This variable will store the current tree's SHA-1.  After we're
-    # done iterating over our dict, it will contain the hash for the
-    # root tree.
-    sha = None
-
-    # We ge through the sorted list of paths (dict keys)
-    for path in sorted_paths:
-        # Prepare a new, empty tree object
-        tree = gitSubObject.GitTree()
-        # Add each entry to our new tree, in turn
-        for entry in contents[path]:
-            # An entry can be a normal GitIndexEntry read from the
-            # index, or a tree we've created.
-            if isinstance(entry, gitSubObject.GitIndexEntry): # Regular entry (a file)
-                # We transcode the mode: the entry stores it as integers,
-                # we need an octal ASCII representation for the tree.
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = gitSubObject.GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: # Tree.  We've stored it as a pair: (basename, SHA)
-                leaf = gitSubObject.GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
-            tree.items.append(leaf)
-        # Write the new tree object to the store.
-        sha = object_write(tree, repo)
-        # Add the new tree hash to the current dictionary's parent, as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # The name without the path, eg main.go for src/main.go
-        contents[parent].append((base, sha))
-
-    return sha
+    if index.cache_tree is None:
+        index.cache_tree = gitSubObject.GitCacheTree()
+    if index.cache_tree.valid():
+        return index.cache_tree.sha
+    tree_from_index_update(repo, index.cache_tree, index.entries, 0, "")
+    return index.cache_tree.sha
+
+#Build the tree of the directory prefix, whose entries start at position start, and store it
+#in node. Returns the position of the first entry past the directory.
+def tree_from_index_update(repo, node, entries, start, prefix):
+    tree = gitSubObject.GitTree()
+    subtrees = dict()
+    i = start
+    while i < len(entries) and entries[i].name.startswith(prefix):
+        entry = entries[i]
+        name = entry.name[len(prefix):]
+        if "/" in name:
+            # A subdirectory: reuse its tree if we can, build it otherwise.
+            base = name.split("/", 1)[0]
+            sub = node.subtrees.get(base) or gitSubObject.GitCacheTree()
+            if sub.valid():
+                i += sub.entry_count
+            else:
+                i = tree_from_index_update(repo, sub, entries, i, prefix + base + "/")
+            subtrees[base] = sub
+            leaf = gitSubObject.GitTreeLeaf(mode = b"040000", path=base, sha=sub.sha)
+        else:
+            # A file. We transcode the mode: the entry stores it as integers, we need
+            # an octal ASCII representation for the tree.
+            leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
+            leaf = gitSubObject.GitTreeLeaf(mode = leaf_mode, path=name, sha=entry.sha)
+            i += 1
+        tree.items.append(leaf)
+
+    # Subdirectories that disappeared from the index are dropped from the cache.
+    node.subtrees = subtrees
+    node.sha = object_write(tree, repo)
+    node.entry_count = i - start
+    return i
 
 #The function to create a commit object takes in the hash of the tree, the hash of the parent commit, 
 #the author identity (a string), the timestamp and timezone delta, and the message and return a commit object.
@@ -1018,3 +1837,326 @@ def commit_create(repo, tree, parent, author, timestamp, message):
 
     return object_write(commit, repo)
 
+"""Commit-graph section"""
+
+#Collect (tree, parents, commit time) for every commit reachable from HEAD and the refs. Commits
+#already in the current commit-graph are taken from it, so writing it again after a few new
+#commits only reads these new commits.
+def commits_reachable(repo):
+    import gitCommitGraph
+    graph = gitCommitGraph.commit_graph_open(repo)
+    commits = dict()
+    todo = list(reversed(ref_tips(repo)))
+    while todo:
+        sha = todo.pop()
+        if sha in commits:
+            continue
+        info = graph.lookup(sha) if graph is not None else None
+        if info is not None:
+            tree, parents, _, time = info
+        else:
+            obj = object_read(repo, sha)
+            if obj is None:
+                raise Exception("Missing object {0}".format(sha))
+            if obj.fmt == b'tag':
+                todo.append(obj.kvlm[b'object'].decode("ascii"))
+                continue
+            if obj.fmt != b'commit':
+                continue
+            tree = obj.kvlm[b'tree'].decode("ascii")
+            parents = commit_parents(repo, sha, obj)
+            time = commit_time(obj)
+        commits[sha] = (tree, parents, time)
+        todo.extend(reversed(parents))
+    return commits
+
+def commit_graph_write(repo):
+    import gitCommitGraph
+    commits = commits_reachable(repo)
+    if not commits:
+        return None, 0
+    return gitCommitGraph.commit_graph_write(repo, commits), len(commits)
+
+"""End of commit-graph section"""
+
+"""Packing objects section"""
+
+#The SHAs HEAD and every ref point to: where walks over everything reachable start.
+def ref_tips(repo):
+    tips = list()
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+
+    tips.extend(sha for _, sha in ref_list(repo))
+    return tips
+
+#To pack a repository, we first need to know which objects it holds that are still in use.
+#An object is reachable if we can get to it starting from a ref (or HEAD): a commit reaches
+#its tree and its parents, a tree reaches its entries and a tag reaches the tagged object.
+#Blobs staged in the index are kept as well, since the next commit will need them.
+#This function returns (sha, path) pairs, path being the name an object was reached by.
+def objects_reachable(repo):
+    tips = ref_tips(repo)
+
+    ret = list()
+    seen = set()
+    todo = [ (sha, None) for sha in reversed(tips) ]
+    while todo:
+        sha, path = todo.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        obj = object_read(repo, sha)
+        if obj is None:
+            raise Exception("Missing object {0}".format(sha))
+        ret.append((sha, path))
+
+        if obj.fmt == b'commit':
+            parents = obj.kvlm.get(b'parent', [])
+            if type(parents) != list:
+                parents = [ parents ]
+            for p in reversed(parents):
+                todo.append((p.decode("ascii"), None))
+            todo.append((obj.kvlm[b'tree'].decode("ascii"), ""))
+        elif obj.fmt == b'tag':
+            todo.append((obj.kvlm[b'object'].decode("ascii"), None))
+        elif obj.fmt == b'tree':
+            for leaf in reversed(obj.items):
+                # Submodules point to commits of another repository.
+                if tree_leaf_type(leaf) == b'commit':
+                    continue
+                todo.append((leaf.sha, os.path.join(path or "", leaf.path)))
+
+    for entry in index_read(repo).entries:
+        if not entry.sha in seen:
+            seen.add(entry.sha)
+            ret.append((entry.sha, entry.name))
+
+    return ret
+
+#Repacking writes every reachable object into a single new pack, then deletes what
+#became redundant: the older packs, and the loose copies of packed objects.
+#Unreachable loose objects are left alone.
+#The new pack holds everything reachable, so it can get reachability bitmaps (see below).
+def repack(repo, window_memory, window=10, depth=50, write_bitmaps=True):
+    objects = objects_reachable(repo)
+    if not objects:
+        return None, 0
+
+    old_packs = [ p.path for p in gitPack.pack_list(repo) ]
+    name = gitPack.pack_write(repo, objects, lambda sha: object_read_raw(repo, sha),
+                              window_memory, window, depth)
+    gitPack.pack_close_all(repo)
+
+    for path in old_packs:
+        if os.path.basename(path) != name:
+            os.unlink(path + ".pack")
+            os.unlink(path + ".idx")
+            if os.path.exists(path + ".bitmap"):
+                os.unlink(path + ".bitmap")
+
+    if write_bitmaps:
+        pack = next(p for p in gitPack.pack_list(repo) if p.name == name)
+        bitmap_write(repo, pack)
+
+    for sha, _ in objects:
+        path = gitRepo.repo_path(repo, "objects", sha[0:2], sha[2:])
+        if os.path.isfile(path):
+            os.unlink(path)
+            parent = os.path.dirname(path)
+            if not os.listdir(parent):
+                os.rmdir(parent)
+
+    return name, len(objects)
+
+"""End of packing objects section"""
+
+"""Reachability bitmaps section"""
+
+#The bitmap index of the first pack that has one, or None. Only packs written by repack get one:
+#bitmaps need a pack holding everything their commits reach.
+def bitmap_index(repo):
+    import gitBitmap
+    for pack in gitPack.pack_list(repo):
+        index = gitBitmap.bitmap_open(pack)
+        if index is not None:
+            return index
+    return None
+
+#Everything reachable from tips, as (bits, extra). bits has a bit set for each reachable object
+#of pack, at its pack order position, and extra maps each reachable object outside of pack to
+#its type. lookup gives the bitmap of a commit, or None when it has none.
+#Commits are walked first, most recent first, and the walk stops at commits with a bitmap: their
+#bitmap already has everything below them. Then the trees of the commits walked are walked in
+#turn, skipping objects already in a bitmap, so new commits only cost the trees they changed.
+def reachable_bitmap(repo, tips, pack=None, lookup=None):
+    import gitCommitGraph
+    import gitEwah
+    rank = pack.pack_order()[1] if pack is not None else None
+    union = 0
+    union_bytes = b''
+    walked = set()
+    extra = dict()
+
+    #Mark an object as reached. Returns False if it already was.
+    def mark(sha, fmt):
+        i = pack.position(bytes.fromhex(sha)) if pack is not None else None
+        if i is None:
+            if sha in extra:
+                return False
+            extra[sha] = fmt
+            return True
+        pos = rank[i]
+        if pos in walked or (pos >> 3 < len(union_bytes) and union_bytes[pos >> 3] >> (pos & 7) & 1):
+            return False
+        walked.add(pos)
+        return True
+
+    commits = list()
+    objects = list()
+    seen = set()
+    counter = itertools.count()
+
+    def push(sha):
+        if sha in seen:
+            return
+        seen.add(sha)
+        info = gitCommitGraph.commit_graph_lookup(repo, sha)
+        if info is not None:
+            tree, parents, _, time = info
+        else:
+            commit = object_read(repo, sha)
+            if commit is None:
+                raise Exception("Missing object {0}".format(sha))
+            tree = commit.kvlm[b'tree'].decode("ascii")
+            parents = commit_parents(repo, sha, commit)
+            time = commit_time(commit)
+        heapq.heappush(commits, (-time, next(counter), sha, tree, parents))
+
+    # Tips can be anything: peel tags, and keep trees and blobs for after the commits.
+    for sha in tips:
+        fmt = b'commit' if gitCommitGraph.commit_graph_lookup(repo, sha) else None
+        while fmt != b'commit':
+            obj = object_read(repo, sha)
+            if obj is None:
+                raise Exception("Missing object {0}".format(sha))
+            fmt = obj.fmt
+            if fmt != b'tag':
+                break
+            mark(sha, fmt)
+            sha = obj.kvlm[b'object'].decode("ascii")
+        if fmt == b'commit':
+            push(sha)
+        else:
+            objects.append((sha, fmt))
+
+    while commits:
+        _, _, sha, tree, parents = heapq.heappop(commits)
+        bits = lookup(sha) if lookup is not None else None
+        if bits is not None:
+            union |= bits
+            union_bytes = union.to_bytes((union.bit_length() + 7) // 8, "little")
+            continue
+        if not mark(sha, b'commit'):
+            continue
+        objects.append((tree, b'tree'))
+        for p in parents:
+            push(p)
+
+    objects.reverse()
+    while objects:
+        sha, fmt = objects.pop()
+        if not mark(sha, fmt) or fmt != b'tree':
+            continue
+        tree = object_read(repo, sha)
+        if tree is None:
+            raise Exception("Missing object {0}".format(sha))
+        for leaf in reversed(tree.items):
+            fmt = tree_leaf_type(leaf)
+            # Submodules point to commits of another repository.
+            if fmt != b'commit':
+                objects.append((leaf.sha, fmt))
+
+    return union | gitEwah.bits_from_positions(walked), extra
+
+#The commits that get a bitmap: the tips of the refs, and one commit in gitBitmap.SPACING along
+#the history. Returned oldest first, so each bitmap can be built from the ones before it.
+def bitmap_select(repo):
+    import gitBitmap
+    tips = list()
+    for sha in ref_tips(repo):
+        obj = object_read(repo, sha)
+        while obj is not None and obj.fmt == b'tag':
+            sha = obj.kvlm[b'object'].decode("ascii")
+            obj = object_read(repo, sha)
+        if obj is not None and obj.fmt == b'commit' and sha not in tips:
+            tips.append(sha)
+
+    selected = list()
+    for k, (sha, _) in enumerate(rev_walk_date(repo, tips)):
+        if sha in tips or k % gitBitmap.SPACING == 0:
+            selected.append(sha)
+    selected.reverse()
+    return selected
+
+#Write the bitmaps of a pack holding everything reachable.
+def bitmap_write(repo, pack):
+    import gitBitmap
+    order, _ = pack.pack_order()
+    types = { fmt: list() for fmt in gitBitmap.TYPES }
+    for r, i in enumerate(order):
+        types[pack.type_at(pack.offset_at(i))].append(r)
+
+    computed = dict()
+    bitmaps = list()
+    for sha in bitmap_select(repo):
+        bits, extra = reachable_bitmap(repo, [ sha ], pack, computed.get)
+        # A commit that reaches objects outside of the pack can't have a bitmap.
+        if extra:
+            continue
+        computed[sha] = bits
+        bitmaps.append((pack.position(bytes.fromhex(sha)), bits))
+    return gitBitmap.bitmap_write(pack, types, bitmaps)
+
+#The objects (or only the commits) reachable from include but not from exclude: (pack, bits,
+#extra) as in reachable_bitmap, the bits being positions in pack order.
+def rev_list_bitmap(repo, include, exclude, commits_only=False):
+    index = bitmap_index(repo)
+    pack, lookup = (index.pack, index.get) if index is not None else (None, None)
+    bits, extra = reachable_bitmap(repo, include, pack, lookup)
+    if exclude:
+        bits_exclude, extra_exclude = reachable_bitmap(repo, exclude, pack, lookup)
+        bits &= ~bits_exclude
+        extra = { sha: fmt for sha, fmt in extra.items() if sha not in extra_exclude }
+    if commits_only:
+        bits &= index.types[b'commit'] if index is not None else 0
+        extra = { sha: fmt for sha, fmt in extra.items() if fmt == b'commit' }
+    return pack, bits, extra
+
+#The set of commits reachable from revs.
+def rev_list_commits(repo, revs):
+    import gitEwah
+    pack, bits, extra = rev_list_bitmap(repo, revs, [], commits_only=True)
+    ret = set(extra)
+    if pack is not None:
+        order, _ = pack.pack_order()
+        ret.update(pack.sha_at(order[pos]).hex() for pos in gitEwah.bits_positions(bits))
+    return ret
+
+#rev-list --count
+def rev_list_count(repo, include, exclude, objects=False):
+    _, bits, extra = rev_list_bitmap(repo, include, exclude, not objects)
+    return bits.bit_count() + len(extra)
+
+#rev-list --objects: the SHAs of the objects, packed ones in pack order first.
+def rev_list_objects(repo, include, exclude):
+    import gitEwah
+    pack, bits, extra = rev_list_bitmap(repo, include, exclude)
+    if pack is not None:
+        order, _ = pack.pack_order()
+        for pos in gitEwah.bits_positions(bits):
+            yield pack.sha_at(order[pos]).hex()
+    yield from extra
+
+"""End of reachability bitmaps section"""
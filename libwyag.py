@@ -1,44 +1,66 @@
-import argparse
-import collections
-import configparser
-from datetime import datetime
 #import grp, pwd
-from fnmatch import fnmatch
-import hashlib
-from math import ceil
+import itertools
 import os
-import re
 import sys
-import zlib
 import gitRepo
 import gitUtil
 import gitConfig
 
+#Modules only some commands need (the filesystem monitor, the server and its client, dates)
+#are imported by these commands: every run of wyag pays for what is imported here.
 
 def main(argv=sys.argv[1:]):
-    args = gitConfig.argparser.parse_args(argv)
+    args = gitConfig.args_parse(argv)
     if   args.command == "add"          : cmd_add(args)
     elif args.command == "cat-file"     : cmd_cat_file(args)
     elif args.command == "check-ignore" : cmd_check_ignore(args)
     elif args.command == "checkout"     : cmd_checkout(args)
     elif args.command == "commit"       : cmd_commit(args)
+    elif args.command == "commit-graph" : cmd_commit_graph(args)
+    elif args.command == "fsmonitor"    : cmd_fsmonitor(args)
     elif args.command == "hash-object"  : cmd_hash_object(args)
     elif args.command == "init"         : cmd_init(args)
     elif args.command == "log"          : cmd_log(args)
     elif args.command == "ls-files"     : cmd_ls_files(args)
     elif args.command == "ls-tree"      : cmd_ls_tree(args)
+    elif args.command == "pack-refs"    : cmd_pack_refs(args)
+    elif args.command in ["repack", "gc"]: cmd_repack(args)
+    elif args.command == "rev-list"     : cmd_rev_list(args)
     elif args.command == "rev-parse"    : cmd_rev_parse(args)
     elif args.command == "rm"           : cmd_rm(args)
+    elif args.command == "serve"        : cmd_serve(args)
     elif args.command == "show-ref"     : cmd_show_ref(args)
     elif args.command == "status"       : cmd_status(args)
     elif args.command == "tag"          : cmd_tag(args)
+    elif args.command == "update-index" : cmd_update_index(args)
     else                                : print("Bad command.")
+
+    # Set WYAG_TRACE_CACHE to see how well the object cache did.
+    if os.environ.get("WYAG_TRACE_CACHE"):
+        cache = gitUtil.object_cache
+        print("object cache: {0} hits, {1} misses, {2} objects, {3} bytes".format(
+            cache.hits, cache.misses, len(cache.items), cache.size), file=sys.stderr)
             
 def cmd_init(args):
     gitRepo.repo_create(args.path)
 
 def cmd_cat_file(args):
     repo = gitRepo.repo_find()
+    if args.batch or args.batch_check:
+        gitUtil.cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer,
+                               contents=args.batch, flush=args.flush)
+        return
+    if args.show_type or args.show_size:
+        # The only argument is the object, which argparse took for the type.
+        name = args.object or args.type
+        if name is None:
+            raise Exception("cat-file -t and -s need an object")
+        gitUtil.cat_file_info(repo, name, size=args.show_size)
+        return
+    if args.object is None:
+        raise Exception("cat-file needs a type and an object, or --batch")
+    if args.type not in ("blob", "commit", "tag", "tree"):
+        raise Exception("Invalid object type {0}".format(args.type))
     gitUtil.cat_file(repo, args.object, fmt=args.type.encode())
 
 def cmd_hash_object(args):
@@ -53,14 +75,20 @@ def cmd_hash_object(args):
 
 def cmd_log(args):
     repo = gitRepo.repo_find()
-    print("digraph wyaglog{")
-    print("  node[shape=rect]")
-    gitUtil.log_graphviz(repo, gitUtil.object_find(repo, args.commit), set())
-    print("}")
+    since = gitUtil.date_parse(args.since) if args.since else None
+    start = gitUtil.object_find(repo, args.commit, fmt=b"commit")
+    commits = gitUtil.rev_walk(repo, [ start ], since=since, topo_order=args.topo_order)
+    if args.max_count is not None:
+        commits = itertools.islice(commits, args.max_count)
+
+    if args.oneline:
+        gitUtil.log_oneline(repo, commits, args.abbrev)
+    else:
+        gitUtil.log_graphviz(repo, commits, args.abbrev)
 
 def cmd_ls_tree(args):
     repo = gitRepo.repo_find()
-    gitUtil.ls_tree(repo, args.tree, args.recursive)
+    gitUtil.ls_tree(repo, args.tree, args.recursive, abbrev=args.abbrev, long=args.long)
 
 
     #This is a oversimplified version of the actual "git checkout" command.
@@ -89,24 +117,96 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    gitUtil.tree_checkout(repo, obj, os.path.realpath(args.path))
+    jobs = args.jobs if args.jobs is not None else os.cpu_count() or 1
+    if jobs > 1:
+        gitUtil.tree_checkout_parallel(repo, obj, os.path.realpath(args.path), jobs)
+    else:
+        gitUtil.tree_checkout(repo, obj, os.path.realpath(args.path))
 
 def cmd_show_ref(args):
-    repo = gitUtil.repo_find()
-    refs = gitRepo.ref_list(repo)
-    gitUtil.show_ref(repo, refs, prefix="refs")
+    repo = gitRepo.repo_find()
+    refs = gitUtil.ref_list(repo)
+    gitUtil.show_ref(repo, refs, dereference=args.dereference)
 
 def cmd_tag(args):
-    repo = gitUtil.repo_find()
+    repo = gitRepo.repo_find()
 
     if args.name:
         gitUtil.tag_create(repo,
                    args.name,
                    args.object,
-                   type="object" if args.create_tag_object else "ref")
+                   create_tag_object=args.create_tag_object)
+    else:
+        refs = gitUtil.ref_list(repo, "refs/tags/")
+        gitUtil.show_ref(repo, refs, with_hash=False, strip="refs/tags/")
+
+#pack-refs moves loose refs into .git/packed-refs, so that listing and reading refs doesn't
+#need a file per ref.
+def cmd_pack_refs(args):
+    repo = gitRepo.repo_find()
+    gitUtil.pack_refs(repo, all=args.all)
+
+#The repack command (or gc) moves every reachable object into one pack, so the object
+#database doesn't end up as hundreds of thousands of tiny files.
+def cmd_repack(args):
+    repo = gitRepo.repo_find()
+
+    window_memory = args.window_memory
+    if window_memory is None:
+        window_memory = repo.config.get("pack", "windowMemory", fallback="256m")
+
+    window = args.window
+    if window is None:
+        window = repo.config.getint("pack", "window", fallback=10)
+
+    depth = args.depth
+    if depth is None:
+        depth = repo.config.getint("pack", "depth", fallback=50)
+
+    write_bitmaps = repo.config.getboolean("repack", "writeBitmaps", fallback=True)
+    name, count = gitUtil.repack(repo, gitUtil.config_size(window_memory), window, depth,
+                                 write_bitmaps)
+    if name:
+        print("Packed {0} objects into {1}.".format(count, name))
     else:
-        refs = gitUtil.ref_list(repo)
-        gitUtil.show_ref(repo, refs["tags"], with_hash=False)
+        print("Nothing to pack.")
+
+    #Like git, gc also refreshes the commit-graph.
+    if args.command == "gc" and repo.config.getboolean("gc", "writeCommitGraph", fallback=True):
+        gitUtil.commit_graph_write(repo)
+
+#commit-graph write stores the parents, tree and date of every reachable commit in
+#.git/objects/info/commit-graph, so history walks don't have to read the commits.
+def cmd_commit_graph(args):
+    repo = gitRepo.repo_find()
+    path, count = gitUtil.commit_graph_write(repo)
+    if path:
+        print("Wrote {0} commits to {1}.".format(count, path))
+    else:
+        print("No commits to write.")
+
+#rev-list answers its questions with the reachability bitmaps of the pack when there are any:
+#only the commits since the last bitmapped ones are walked.
+def cmd_rev_list(args):
+    repo = gitRepo.repo_find()
+    include = list()
+    exclude = list()
+    for rev in args.revs:
+        if rev.startswith("^"):
+            exclude.append(gitUtil.object_find(repo, rev[1:]))
+        else:
+            include.append(gitUtil.object_find(repo, rev))
+
+    if args.count:
+        print(gitUtil.rev_list_count(repo, include, exclude, args.objects))
+    elif args.objects:
+        for sha in gitUtil.rev_list_objects(repo, include, exclude):
+            print(sha)
+    else:
+        hidden = gitUtil.rev_list_commits(repo, exclude) if exclude else set()
+        include = [ gitUtil.object_find(repo, sha, fmt=b"commit") for sha in include ]
+        for sha in gitUtil.rev_walk(repo, include, exclude=hidden):
+            print(sha)
 
 def cmd_rev_parse(args):
     if args.type:
@@ -120,34 +220,40 @@ def cmd_rev_parse(args):
 #will be much simpler and added a --verbose option that doesn't exist in git in order to 
 #display every single bit of info in the index file for testing and educational purpose.
 def cmd_ls_files(args):
+    from datetime import datetime
     repo = gitRepo.repo_find()
-    index = gitUtil.index_read(repo)
-    if args.verbose:
-        print("Index file format v{}, containing {} entries.".format(index.version, len(index.entries)))
-    
-    for entry in index.entries:
-        print(entry.name)
+    index = gitUtil.index_open(repo)
+    if index is None:
+        return
+    with index:
         if args.verbose:
-            print("  {} with perms: {:o}".format(
-                { 0b1000: "regular file",
-                0b1010: "symlink",
-                0b1110: "git link" }[entry.mode_type],
-                entry.mode_perms))
-            print("  on blob: {}".format(entry.sha))
-            print("  created: {}.{}, modified: {}.{}".format(
-                datetime.fromtimestamp(entry.ctime[0])
-                , entry.ctime[1]
-                , datetime.fromtimestamp(entry.mtime[0])
-                , entry.mtime[1]))
-            print("  device: {}, inode: {}".format(entry.dev, entry.ino))
-            #print("  user: {} ({})  group: {} ({})".format(
-            #    pwd.getpwuid(entry.uid).pw_name,
-            #    entry.uid,
-            #    grp.getgrgid(entry.gid).gr_name,
-            #    entry.gid))
-            print("  flags: stage={} assume_valid={}".format(
-                entry.flag_stage,
-                entry.flag_assume_valid))
+            print("Index file format v{}, containing {} entries.".format(index.version, len(index)))
+
+        #Without --verbose, only the names are decoded.
+        for i, name in enumerate(index.names()):
+            print(name)
+            if args.verbose:
+                entry = index[i]
+                print("  {} with perms: {:o}".format(
+                    { 0b1000: "regular file",
+                    0b1010: "symlink",
+                    0b1110: "git link" }[entry.mode_type],
+                    entry.mode_perms))
+                print("  on blob: {}".format(entry.sha))
+                print("  created: {}.{}, modified: {}.{}".format(
+                    datetime.fromtimestamp(entry.ctime[0])
+                    , entry.ctime[1]
+                    , datetime.fromtimestamp(entry.mtime[0])
+                    , entry.mtime[1]))
+                print("  device: {}, inode: {}".format(entry.dev, entry.ino))
+                #print("  user: {} ({})  group: {} ({})".format(
+                #    pwd.getpwuid(entry.uid).pw_name,
+                #    entry.uid,
+                #    grp.getgrgid(entry.gid).gr_name,
+                #    entry.gid))
+                print("  flags: stage={} assume_valid={}".format(
+                    entry.flag_stage,
+                    entry.flag_assume_valid))
 
 #The check-ignore command takes a list of paths and output back those paths that should be ignored.
 def cmd_check_ignore(args):
@@ -168,14 +274,53 @@ def cmd_check_ignore(args):
 #   _The difference between the index and the working tree ("Changes not stage for commit")
 #   _The difference betweeen HEAD and the index ("Changes to be committed" and "Untracked files")
 
-def cmd_status(_):
+#status may write the index back (see status_index_worktree), so it takes the index lock before
+#reading it: nobody can change the index in between. When someone else holds the lock, status
+#still runs, but doesn't write.
+def cmd_status(args):
     repo = gitRepo.repo_find()
-    index = gitUtil.index_read(repo)
-
-    gitUtil.status_branch(repo)
-    gitUtil.status_head_index(repo, index)
-    print()
-    gitUtil.status_index_worktree(repo, index)
+    refresh = args.refresh or repo.config.getboolean("status", "refresh", fallback=False)
+    lock = gitUtil.index_try_lock(repo)
+    try:
+        index = gitUtil.index_read(repo, columns=True)
+        gitUtil.status_branch(repo)
+        gitUtil.status_head_index(repo, index)
+        print()
+    except:
+        if lock is not None:
+            gitUtil.index_unlock(repo, lock)
+        raise
+    gitUtil.status_index_worktree(repo, index, refresh, lock)
+
+#update-index --refresh records the new stat data of files that were touched but not changed,
+#so that status doesn't hash them again every time.
+def cmd_update_index(args):
+    repo = gitRepo.repo_find()
+    if args.refresh:
+        changed = gitUtil.update_index_refresh(repo, quiet=args.quiet)
+        if changed:
+            sys.exit(1)
+
+#The filesystem monitor watches the worktree so status only has to look at what changed.
+#It runs in the foreground until stopped; status uses it when core.fsmonitor is true.
+def cmd_fsmonitor(args):
+    import gitFsmonitor
+    repo = gitRepo.repo_find()
+    if args.action == "run":
+        gitFsmonitor.GitFsmonitor(repo).serve()
+    elif not gitFsmonitor.fsmonitor_stop(repo):
+        print("No filesystem monitor running.")
+
+#The server keeps the repository, its packs and the object cache warm between commands. While it
+#runs, wyag.py hands commands over to it.
+def cmd_serve(args):
+    import gitServer
+    import gitClient
+    repo = gitRepo.repo_find()
+    if args.action == "run":
+        gitServer.GitServer(repo, main).serve()
+    elif not gitClient.server_stop(repo.worktree):
+        print("No server running.")
 
 #Now to commit, we need three last thing to create the actual commit:
 #   _Commands to modify the index, so our commits arent's just a copy of their parent.
@@ -196,7 +341,7 @@ def cmd_rm(args):
 #   _Finally write the modified index back
 def cmd_add(args):
     repo = gitRepo.repo_find()
-    gitUtil.add(repo, args.path)
+    gitUtil.add(repo, args.path, jobs=args.jobs)
 
 #After we've modified the index, so actually staged changes, the 'commit' command will turn
 #those changes into a commit. 
@@ -204,14 +349,23 @@ def cmd_add(args):
 #To do so, we first need to convert the index into a tree object, generate and store the corresponding 
 #commit object, and update the HEAD branch to the new commit
 def cmd_commit(args):
+    from datetime import datetime
     repo = gitRepo.repo_find()
-    index = gitUtil.index_read(repo)
-
-    #Create trees, grab back SHA for the root tree.
-    tree = gitUtil.tree_from_index(repo, index)
+    #The index is read under its lock, so that what we commit is what we write back.
+    lock = gitUtil.index_lock(repo)
+    try:
+        index = gitUtil.index_read(repo)
+        #Create trees, grab back SHA for the root tree.
+        tree = gitUtil.tree_from_index(repo, index)
+    except:
+        gitUtil.index_unlock(repo, lock)
+        raise
+    #Save the cache tree, so the next commit only rebuilds the directories that changed.
+    gitUtil.index_write(repo, index, lock)
 
     #Create commit object itself.
-    commit = gitUtil.commit_create(repo, tree, gitUtil.object_find(repo, "HEAD"), 
+    #The parent is None for the first commit of a branch.
+    commit = gitUtil.commit_create(repo, tree, gitUtil.ref_resolve(repo, "HEAD"), 
                                    gitUtil.gitconfig_user_get(gitUtil.gitconfig_read()), 
                                    datetime.now(), args.message)
 
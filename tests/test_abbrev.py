@@ -0,0 +1,31 @@
+import unittest
+from wyagtest import WyagTestCase
+
+class TestAbbrev(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("a", "a\n")
+        self.write("d/b", "b\n")
+        self.wyag("add", "a", "d/b")
+        self.wyag("commit", "-m", "first")
+
+    #The bare --abbrev must not take the tree for its value.
+    def test_ls_tree_bare_abbrev(self):
+        full = self.wyag("ls-tree", "HEAD").stdout.splitlines()
+        short = self.wyag("ls-tree", "--abbrev", "HEAD").stdout.splitlines()
+        self.assertEqual(len(short), len(full))
+        for f, s in zip(full, short):
+            mode, type, sha = f.split("\t")[0].split()
+            self.assertEqual(s, "{0} {1} {2}\t{3}".format(mode, type, sha[0:7], f.split("\t")[1]))
+
+    def test_ls_tree_abbrev_length(self):
+        sha = self.wyag("ls-tree", "--abbrev=5", "HEAD").stdout.split()[2]
+        self.assertEqual(len(sha), 5)
+
+    def test_log_bare_abbrev(self):
+        head = self.wyag("rev-parse", "HEAD").stdout.strip()
+        self.assertEqual(self.wyag("log", "--oneline", "--abbrev", "HEAD").stdout,
+                         "{0} first\n".format(head[0:7]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import concurrent.futures
+import os
+import shutil
+import unittest
+import unittest.mock
+from wyagtest import WyagTestCase
+import gitRepo
+import gitUtil
+
+class TestParallelAdd(WyagTestCase):
+    #In a fresh repository, none of the objects/xx directories exist yet: the threads of add -j
+    #create them at the same time. The race doesn't show every time, so we try a few times.
+    def test_add_jobs_fresh_repository(self):
+        names = [ "f{0}".format(i) for i in range(2000) ]
+        for name in names:
+            self.write(name, "{0}\n".format(name))
+        gitdir = os.path.join(self.worktree, ".git")
+        for attempt in range(8):
+            shutil.rmtree(os.path.join(gitdir, "objects"))
+            os.mkdir(os.path.join(gitdir, "objects"))
+            if os.path.exists(os.path.join(gitdir, "index")):
+                os.unlink(os.path.join(gitdir, "index"))
+            self.wyag("add", "-j", "16", *names)
+
+        listed = self.wyag("ls-files").stdout.split()
+        self.assertEqual(sorted(listed), sorted(names))
+        # Every object the index points to was written.
+        for name in ("f0", "f1999"):
+            sha = self.wyag("hash-object", name).stdout.strip()
+            self.assertEqual(self.wyag("cat-file", "blob", sha).stdout, "{0}\n".format(name))
+
+    #A few small files are hashed without a pool of threads, which takes longer to start than
+    #they take to hash, however many CPUs there are.
+    def test_add_small_is_serial(self):
+        path = self.write("a", "a\n")
+        repo = gitRepo.repo_find(self.worktree)
+        with unittest.mock.patch("os.cpu_count", return_value=8), \
+             unittest.mock.patch.object(concurrent.futures, "ThreadPoolExecutor", side_effect=AssertionError):
+            gitUtil.add(repo, [ path ], jobs=None)
+        self.assertEqual(self.wyag("ls-files").stdout.split(), [ "a" ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from wyagtest import WyagTestCase
+import gitCommitGraph
+import gitRepo
+
+class TestCommitGraph(WyagTestCase):
+    #Commits are written with made-up SHAs: the graph never reads their objects.
+    def test_read_back(self):
+        repo = gitRepo.repo_find(self.worktree)
+        def sha(n):
+            return "{0:02x}{1:038x}".format(n * 37 % 256, n)
+        def tree(n):
+            return "{0:040x}".format(1000 + n)
+
+        # A line of commits, a merge, and an octopus merge of 4 parents.
+        commits = dict()
+        for n in range(10):
+            commits[sha(n)] = (tree(n), [ sha(n - 1) ] if n else [], 1600000000 + n)
+        commits[sha(10)] = (tree(10), [ sha(9), sha(5) ], 1600000010)
+        commits[sha(11)] = (tree(11), [ sha(10), sha(2), sha(3), sha(4) ], 1600000011)
+        # Commit times beyond 32 bits.
+        commits[sha(12)] = (tree(12), [ sha(11) ], (1 << 33) + 5)
+
+        gitCommitGraph.commit_graph_write(repo, commits)
+        graph = gitCommitGraph.GitCommitGraph(gitCommitGraph.commit_graph_path(repo))
+        self.addCleanup(graph.close)
+        self.assertEqual(graph.count, len(commits))
+        generations = { sha(n): n + 1 for n in range(10) }
+        generations.update({ sha(10): 11, sha(11): 12, sha(12): 13 })
+        for c, (t, parents, time) in commits.items():
+            self.assertEqual(graph.lookup(c), (t, parents, generations[c], time))
+        self.assertIsNone(graph.lookup("f" * 40))
+
+if __name__ == "__main__":
+    unittest.main()
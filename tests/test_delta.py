@@ -0,0 +1,54 @@
+import random
+import unittest
+import wyagtest # Puts wyag's modules on the path.
+import gitDelta
+
+class TestDelta(unittest.TestCase):
+    def round_trip(self, source, target):
+        delta = gitDelta.delta_create(source, target)
+        self.assertEqual(gitDelta.delta_apply(source, delta), target)
+        return delta
+
+    def test_varint(self):
+        for n in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 1 << 40):
+            encoded = gitDelta.varint_encode(n)
+            self.assertEqual(gitDelta.varint_decode(b'x' + encoded + b'y', 1), (1 + len(encoded), n))
+
+    def test_identical(self):
+        source = bytes(range(256)) * 20
+        delta = self.round_trip(source, source)
+        # The sizes, then a single copy.
+        self.assertLess(len(delta), 16)
+
+    def test_empty(self):
+        self.round_trip(b'', b'')
+        self.round_trip(b'some source', b'')
+        self.round_trip(b'', b'x' * 300)
+
+    #Inserts are at most 127 bytes, and copies at most 0x10000 bytes (encoded as a size of 0).
+    def test_long_insert_and_copy(self):
+        rand = random.Random(3)
+        source = bytes(rand.getrandbits(8) for _ in range(3 * gitDelta.MAX_COPY))
+        insert = bytes(rand.getrandbits(8) for _ in range(1000))
+        self.round_trip(source, insert + source + insert)
+
+    def test_edits(self):
+        rand = random.Random(7)
+        source = bytearray(b''.join(b"line %d of the file\n" % i for i in range(2000)))
+        target = bytearray(source)
+        for _ in range(50):
+            i = rand.randrange(len(target))
+            if rand.random() < 0.5:
+                del target[i: i + rand.randrange(1, 100)]
+            else:
+                target[i:i] = b"inserted %d\n" % rand.randrange(1 << 30)
+        delta = self.round_trip(bytes(source), bytes(target))
+        self.assertLess(len(delta), len(target) // 10)
+
+    def test_wrong_base(self):
+        delta = gitDelta.delta_create(b'a' * 100, b'a' * 50)
+        with self.assertRaises(Exception):
+            gitDelta.delta_apply(b'a' * 99, delta)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import random
+import unittest
+import wyagtest # Puts wyag's modules on the path.
+import gitEwah
+
+class TestEwah(unittest.TestCase):
+    def round_trip(self, bits, bit_size):
+        data = gitEwah.ewah_encode(bits, bit_size)
+        self.assertEqual(gitEwah.ewah_decode(b'xx' + data + b'yy', 2), (bits, bit_size, 2 + len(data)))
+        return data
+
+    #Bits 0 and 2 of 3: a running length word announcing no run and one literal word, the
+    #literal, then the position of that RLW.
+    def test_format(self):
+        self.assertEqual(gitEwah.ewah_encode(0b101, 3),
+                         (3).to_bytes(4, "big") + (2).to_bytes(4, "big") +
+                         (1 << 33).to_bytes(8, "big") + (5).to_bytes(8, "big") +
+                         (0).to_bytes(4, "big"))
+
+    def test_empty(self):
+        self.round_trip(0, 0)
+        self.round_trip(0, 1000)
+
+    #Runs of ones become a single RLW, and the last one may cover bits past the end.
+    def test_runs(self):
+        data = self.round_trip((1 << 640) - 1, 640)
+        self.assertEqual(len(data), 4 + 4 + 8 + 4)
+        self.round_trip((1 << 1000) - 1, 1000)
+        self.round_trip(((1 << 500) - 1) << 500, 1000)
+
+    def test_random(self):
+        rand = random.Random(5)
+        for bit_size in (1, 63, 64, 65, 1000, 5000):
+            positions = sorted(rand.sample(range(bit_size), rand.randrange(bit_size + 1)))
+            bits = gitEwah.bits_from_positions(positions)
+            self.assertEqual(gitEwah.bits_positions(bits), positions)
+            self.round_trip(bits, bit_size)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import ctypes
+import errno
+import os
+import unittest
+import unittest.mock
+from wyagtest import WyagTestCase
+import gitFsmonitor
+import gitRepo
+
+class TestFsmonitor(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("d/f", "f\n")
+        try:
+            self.monitor = gitFsmonitor.GitFsmonitor(gitRepo.repo_find(self.worktree))
+        except Exception as e:
+            self.skipTest(str(e))
+        self.addCleanup(os.close, self.monitor.fd)
+
+    #Make inotify_add_watch fail as it does when the limit of watches is reached.
+    def watches_full(self):
+        def add_watch(fd, path, mask):
+            ctypes.set_errno(errno.ENOSPC)
+            return -1
+        return unittest.mock.patch.object(self.monitor, "libc", unittest.mock.Mock(inotify_add_watch=add_watch))
+
+    def test_changes(self):
+        token, paths = self.monitor.query("")
+        self.assertIsNone(paths)
+        self.write("d/f", "g\n")
+        token, paths = self.monitor.query(token)
+        self.assertEqual(paths, [ "d/f" ])
+
+    #A directory we couldn't watch makes every answer "look at everything", until it is watched.
+    def test_unwatched_directory(self):
+        token, _ = self.monitor.query("")
+        with self.watches_full():
+            os.mkdir(os.path.join(self.worktree, "new"))
+            self.monitor.read_events()
+            self.write("new/g", "g\n")
+            token, paths = self.monitor.query(token)
+            self.assertIsNone(paths)
+
+        # Once it's watched, changes made before can't be vouched for, but new ones are seen.
+        token, paths = self.monitor.query(token)
+        self.assertIsNone(paths)
+        self.write("new/g", "h\n")
+        self.assertEqual(self.monitor.query(token)[1], [ "new/g" ])
+
+    #When the cookie isn't seen in time, some events may still be unread.
+    def test_sync_timeout(self):
+        token, _ = self.monitor.query("")
+        self.write("d/f", "g\n")
+        with unittest.mock.patch.object(self.monitor, "read_events", lambda: None), \
+             unittest.mock.patch.object(gitFsmonitor, "SYNC_TIMEOUT", 0.01):
+            self.assertIsNone(self.monitor.query(token)[1])
+        self.assertEqual(self.monitor.query(token)[1], [ "d/f" ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import unittest
+from wyagtest import WyagTestCase
+import gitIndexFile
+import gitRepo
+import gitSubObject
+import gitUtil
+
+FIELDS = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms", "uid", "gid", "fsize", "sha",
+          "flag_assume_valid", "flag_stage", "flag_skip_worktree", "flag_intent_to_add", "name")
+
+class TestIndexFormat(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repo = gitRepo.repo_find(self.worktree)
+
+    #Entries whose names share long prefixes, as in deep trees, and one name longer than the
+    #12 bits of length the flags have room for. Their mtime is long past, so none is smudged.
+    def entries(self, count=50, **flags):
+        names = [ "a/b/c/file{0:04}".format(i) for i in range(count) ]
+        names += [ "a/b/d", "a/long/" + "x" * 5000, "b" ]
+        entries = list()
+        for i, name in enumerate(sorted(names)):
+            entries.append(gitSubObject.GitIndexEntry(
+                ctime=(1000000000 + i, 7), mtime=(1000000000 + i, 9), dev=1, ino=100 + i,
+                mode_type=0b1000, mode_perms=0o644 if i % 2 else 0o755, uid=1000, gid=1000,
+                fsize=i, sha="{0:040x}".format(i), flag_assume_valid=(i % 5 == 0), flag_stage=0,
+                name=name, **flags))
+        return entries
+
+    def round_trip(self, version, entries):
+        lock = gitUtil.index_lock(self.repo)
+        gitUtil.index_write(self.repo, gitSubObject.GitIndex(version=version, entries=entries), lock)
+        with gitUtil.index_open(self.repo) as f:
+            self.assertEqual(list(f.names()), [ e.name for e in entries ])
+            self.assertEqual(f.name(len(entries) - 1), entries[-1].name)
+            self.assertIn(entries[len(entries) // 2].name, f)
+        index = gitUtil.index_read(self.repo)
+        self.assertEqual([ tuple(getattr(e, k) for k in FIELDS) for e in index.entries ],
+                         [ tuple(getattr(e, k) for k in FIELDS) for e in entries ])
+        return index
+
+    def test_version_2(self):
+        index = self.round_trip(2, self.entries())
+        self.assertEqual(index.version, 2)
+
+    #Version 3 is only written when an entry has extended flags.
+    def test_version_3(self):
+        entries = self.entries()
+        entries[3].flag_skip_worktree = True
+        entries[4].flag_intent_to_add = True
+        index = self.round_trip(2, entries)
+        self.assertEqual(index.version, 3)
+
+        index = self.round_trip(3, self.entries())
+        self.assertEqual(index.version, 2)
+
+    def test_version_4(self):
+        entries = self.entries()
+        entries[3].flag_skip_worktree = True
+        index = self.round_trip(4, entries)
+        self.assertEqual(index.version, 4)
+        size_4 = os.path.getsize(gitRepo.repo_path(self.repo, "index"))
+        self.round_trip(2, self.entries())
+        size_2 = os.path.getsize(gitRepo.repo_path(self.repo, "index"))
+        self.assertLess(size_4, size_2)
+
+    #Big indexes carry the offsets of their entries, which are read instead of walking them.
+    def test_offsets_table(self):
+        self.round_trip(2, self.entries(gitIndexFile.OFFSETS_MIN))
+        with gitUtil.index_open(self.repo) as f:
+            self.assertTrue(f.read_offsets())
+            table, end = list(f.offsets), f.end
+            f.offsets = None
+            f.read_offsets = lambda: False
+            f.scan()
+            self.assertEqual(table, list(f.offsets))
+            self.assertEqual(end, f.end)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import unittest
+from wyagtest import WyagTestCase
+import gitOidIndex
+import gitRepo
+import gitSubObject
+import gitUtil
+
+class TestOidIndex(WyagTestCase):
+    #Two blobs whose SHAs start with the same byte, so they go in the same objects/xx directory.
+    def same_bucket_blobs(self):
+        seen = dict()
+        i = 0
+        while True:
+            blob = gitSubObject.GitBlob(b"blob %d" % i)
+            sha = gitUtil.object_write(blob, None)
+            if sha[0:2] in seen:
+                return seen[sha[0:2]], blob
+            seen[sha[0:2]] = blob
+            i += 1
+
+    #On a filesystem with coarse timestamps, an object written in the same tick the directory
+    #was listed in leaves its mtime unchanged: the listing must not be trusted yet.
+    def test_object_added_in_listing_tick(self):
+        repo = gitRepo.repo_find(self.worktree)
+        index = gitOidIndex.GitOidIndex(repo)
+        first, second = self.same_bucket_blobs()
+
+        sha1 = gitUtil.object_write(first, repo)
+        directory = gitRepo.repo_path(repo, "objects", sha1[0:2])
+        st = os.stat(directory)
+        self.assertEqual(index.matches(sha1[0:6]), [ sha1 ])
+
+        sha2 = gitUtil.object_write(second, repo)
+        os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(index.matches(sha2[0:6]), [ sha2 ])
+        self.assertEqual(index.matches(sha2[0:2]), sorted([ sha1, sha2 ]))
+
+if __name__ == "__main__":
+    unittest.main()
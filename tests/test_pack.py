@@ -0,0 +1,96 @@
+import hashlib
+import os
+import unittest
+from wyagtest import WyagTestCase
+import gitBitmap
+import gitEwah
+import gitPack
+import gitRepo
+import gitSubObject
+import gitUtil
+
+class TestPackList(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repo = gitRepo.repo_find(self.worktree)
+        self.addCleanup(gitPack.pack_close_all, self.repo)
+
+    #Write a pack holding a single blob, without looking at the packs already there. Returns
+    #the SHA of the blob.
+    def pack_blob(self, data):
+        sha = gitUtil.object_write(gitSubObject.GitBlob(data), None)
+        gitPack.pack_write(self.repo, [ (sha, None) ], lambda sha: (b"blob", data), 1 << 20)
+        return sha
+
+    #On a filesystem with coarse timestamps, a pack added in the same tick the pack directory
+    #was listed in leaves its mtime unchanged: the listing must not be trusted yet.
+    def test_pack_added_in_listing_tick(self):
+        first = self.pack_blob(b"first\n")
+        self.assertEqual(len(gitPack.pack_list(self.repo)), 1)
+        directory = gitRepo.repo_path(self.repo, "objects", "pack")
+        st = os.stat(directory)
+
+        second = self.pack_blob(b"second\n")
+        os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(len(gitPack.pack_list(self.repo)), 2)
+        self.assertTrue(gitPack.pack_contains(self.repo, first))
+        self.assertTrue(gitPack.pack_contains(self.repo, second))
+
+#The SHA of an object, without writing it.
+def object_sha(fmt, data):
+    return hashlib.sha1(fmt + b" " + str(len(data)).encode() + b"\x00" + data).hexdigest()
+
+class TestPackWrite(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repo = gitRepo.repo_find(self.worktree)
+        # Versions of the same file, which get deltified against each other, and unrelated
+        # objects of every type.
+        lines = [ b"line %d\n" % i for i in range(500) ]
+        self.objects = dict()
+        for k in range(5):
+            self.objects[object_sha(b"blob", b''.join(lines))] = (b"blob", b''.join(lines))
+            lines[k * 50] = b"changed %d\n" % k
+            lines.append(b"appended %d\n" % k)
+        for fmt, data in ((b"blob", b""), (b"tree", b"100644 f\x00" + bytes(20)),
+                          (b"commit", b"tree " + b"0" * 40 + b"\n\nmessage\n"),
+                          (b"tag", b"object " + b"0" * 40 + b"\ntype commit\n")):
+            self.objects[object_sha(fmt, data)] = (fmt, data)
+
+        name = gitPack.pack_write(self.repo, [ (sha, "f") for sha in self.objects ],
+                                  self.objects.__getitem__, 1 << 20)
+        self.pack = gitPack.GitPack(gitRepo.repo_path(self.repo, "objects", "pack", name))
+        self.addCleanup(self.pack.close)
+
+    def test_read_back(self):
+        self.assertEqual(self.pack.count, len(self.objects))
+        self.assertEqual(sorted(self.pack.sha_at(i).hex() for i in range(self.pack.count)),
+                         sorted(self.objects))
+        deltas = 0
+        for sha, (fmt, data) in self.objects.items():
+            offset = self.pack.find_offset(bytes.fromhex(sha))
+            self.assertEqual(self.pack.read_at(offset), (fmt, data))
+            self.assertEqual(self.pack.type_at(offset), fmt)
+            self.assertEqual(self.pack.header_at(offset), (fmt, len(data)))
+            if self.pack.entry_header(offset)[0] in (gitPack.OBJ_OFS_DELTA, gitPack.OBJ_REF_DELTA):
+                deltas += 1
+        self.assertGreater(deltas, 0)
+        self.assertIsNone(self.pack.find_offset(bytes(20)))
+
+    def test_bitmap_read_back(self):
+        order, rank = self.pack.pack_order()
+        types = { fmt: list() for fmt in gitBitmap.TYPES }
+        for i in range(self.pack.count):
+            types[self.pack.type_at(self.pack.offset_at(i))].append(rank[i])
+        bitmaps = [ (0, 0b1), (3, gitEwah.bits_from_positions(range(self.pack.count))) ]
+        gitBitmap.bitmap_write(self.pack, types, bitmaps)
+
+        index = gitBitmap.GitBitmapIndex(self.pack)
+        for fmt in gitBitmap.TYPES:
+            self.assertEqual(index.types[fmt], gitEwah.bits_from_positions(types[fmt]))
+        self.assertEqual(index.get(self.pack.sha_at(0).hex()), 0b1)
+        self.assertEqual(index.get(self.pack.sha_at(3).hex()), (1 << self.pack.count) - 1)
+        self.assertIsNone(index.get(self.pack.sha_at(1).hex()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import unittest
+from wyagtest import WyagTestCase
+import gitRefs
+import gitRepo
+
+A = "a" * 40
+B = "b" * 40
+C = "c" * 40
+D = "d" * 40
+
+class TestPackedRefs(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repo = gitRepo.repo_find(self.worktree)
+        self.path = gitRefs.packed_refs_path(self.repo)
+
+    def read(self, content):
+        with open(self.path, "w") as f:
+            f.write(content)
+        return gitRefs.GitPackedRefs(self.path)
+
+    #The peeled line of an annotated tag follows it, and belongs to it only.
+    def test_peeled(self):
+        refs = self.read(gitRefs.HEADER +
+                         "{0} refs/heads/master\n".format(A) +
+                         "{0} refs/tags/v1\n^{1}\n".format(B, A) +
+                         "{0} refs/tags/v2\n".format(C))
+        self.assertTrue(refs.fully_peeled)
+        self.assertEqual(len(refs), 3)
+        self.assertEqual(refs.get("refs/tags/v1"), B)
+        self.assertEqual(refs.peeled, { "refs/tags/v1": A })
+        self.assertEqual(refs.prefix("refs/tags/"), [ ("refs/tags/v1", B), ("refs/tags/v2", C) ])
+        self.assertIsNone(refs.get("refs/tags/v3"))
+
+    #Without the sorted trait, refs are sorted when read. Without fully-peeled, a tag without a
+    #peeled line may still be an annotated tag.
+    def test_traits(self):
+        refs = self.read("# pack-refs with: peeled \n" +
+                         "{0} refs/tags/z\n^{1}\n".format(B, A) +
+                         "{0} refs/heads/master\n".format(C))
+        self.assertFalse(refs.fully_peeled)
+        self.assertEqual(refs.names, [ "refs/heads/master", "refs/tags/z" ])
+        self.assertEqual(refs.get("refs/tags/z"), B)
+        self.assertEqual(refs.peeled, { "refs/tags/z": A })
+
+        refs = self.read("{0} refs/heads/master\n".format(C))
+        self.assertFalse(refs.fully_peeled)
+        self.assertEqual(refs.get("refs/heads/master"), C)
+
+    def test_malformed(self):
+        with self.assertRaises(Exception):
+            self.read(gitRefs.HEADER + "^{0}\n".format(A))
+        with self.assertRaises(Exception):
+            self.read(gitRefs.HEADER + "{0} refs/heads/master\n".format(A[1:]))
+
+    def test_write_read(self):
+        refs = [ ("refs/heads/master", A, None), ("refs/tags/v1", B, A), ("refs/tags/v2", D, C) ]
+        gitRefs.packed_refs_write(self.repo, gitRefs.packed_refs_lock(self.repo), refs)
+        self.assertFalse(os.path.exists(self.path + ".lock"))
+        read = gitRefs.packed_refs_read(self.repo)
+        self.assertEqual(list(zip(read.names, read.shas)), [ (n, s) for n, s, _ in refs ])
+        self.assertEqual(read.peeled, { "refs/tags/v1": A, "refs/tags/v2": C })
+        self.assertTrue(read.fully_peeled)
+
+if __name__ == "__main__":
+    unittest.main()
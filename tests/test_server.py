@@ -0,0 +1,91 @@
+import io
+import os
+import subprocess
+import time
+import unittest
+from wyagtest import WyagTestCase
+import gitClient
+import gitServer
+
+class TestServer(WyagTestCase):
+    #A repository with a commit holding a blob bigger than a chunk of output, and a server for
+    #it, whose home isn't the clients'.
+    def setUp(self):
+        super().setUp()
+        self.home = self.config_home("client", "Client")
+        self.big = "".join("line {0}\n".format(i) for i in range(3 * gitServer.CHUNK // 8))
+        self.write("big", self.big)
+        self.wyag("add", "big")
+        self.wyag("commit", "-m", "first", env={ "HOME": self.home })
+        self.sha = self.wyag("hash-object", "big").stdout.strip()
+
+        env = self.environment({ "HOME": self.config_home("server", "Server") })
+        self.server = subprocess.Popen(self.command("serve", "run"), cwd=self.worktree, env=env)
+        self.addCleanup(self.stop)
+        self.socket = os.path.join(self.worktree, ".git", gitClient.SOCKET)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.socket):
+            if self.server.poll() is not None or time.monotonic() > deadline:
+                self.fail("The server didn't start")
+            time.sleep(0.05)
+
+    def stop(self):
+        if not gitClient.server_stop(self.worktree):
+            self.server.kill()
+        self.server.wait(10)
+
+    #A home directory whose .gitconfig names its user.
+    def config_home(self, name, user):
+        home = os.path.join(self.tmp.name, name)
+        os.makedirs(home)
+        with open(os.path.join(home, ".gitconfig"), "w") as f:
+            f.write("[user]\n\tname = {0}\n\temail = {1}@example.com\n".format(user, name))
+        return home
+
+    def served(self, *argv):
+        return self.wyag(*argv, env={ "WYAG_SERVER": "1", "HOME": self.home })
+
+    #The output of a command comes in chunks, as it's printed, and then its exit code.
+    def test_output_chunks(self):
+        with gitClient.GitClient(self.socket) as client:
+            client.send("run", argv=[ "cat-file", "blob", self.sha ])
+            answers = list()
+            while not answers or "exit" not in answers[-1]:
+                answers.append(client.answer())
+        self.assertGreater(len(answers), 2)
+        self.assertEqual(answers[-1]["exit"], 0)
+
+        with gitClient.GitClient(self.socket) as client:
+            out, err = io.BytesIO(), io.BytesIO()
+            self.assertEqual(client.run([ "cat-file", "blob", self.sha ], out, err), 0)
+            self.assertEqual(out.getvalue().decode(), self.big)
+            self.assertEqual(client.run([ "cat-file", "blob", "f" * 40 ], out, err), 1)
+            self.assertTrue(err.getvalue())
+
+    def test_same_output(self):
+        for argv in ([ "log" ], [ "ls-files" ], [ "show-ref" ], [ "tag" ]):
+            self.assertEqual(self.served(*argv).stdout, self.wyag(*argv).stdout)
+
+    #Commands writing to the repository run in the client, with its environment: the author
+    #of a commit is the client's user, not the server's.
+    def test_writes_are_local(self):
+        self.write("big", "changed\n")
+        self.served("add", "big")
+        self.served("commit", "-m", "second")
+        self.assertIn("Client", self.wyag("cat-file", "commit", "HEAD").stdout)
+        with gitClient.GitClient(self.socket) as client:
+            with self.assertRaises(Exception):
+                client.request("run", argv=[ "commit", "-m", "third" ])
+            # The server still answers after refusing.
+            self.assertEqual(client.resolve("HEAD"), self.wyag("rev-parse", "HEAD").stdout.strip())
+
+    def test_served(self):
+        self.assertTrue(gitClient.served([ "log" ]))
+        self.assertTrue(gitClient.served([ "tag" ]))
+        self.assertFalse(gitClient.served([ "tag", "v1" ]))
+        self.assertFalse(gitClient.served([ "cat-file", "--batch" ]))
+        self.assertFalse(gitClient.served([ "status" ]))
+        self.assertFalse(gitClient.served([]))
+
+if __name__ == "__main__":
+    unittest.main()
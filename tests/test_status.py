@@ -0,0 +1,91 @@
+import contextlib
+import io
+import os
+import unittest
+import unittest.mock
+from wyagtest import WyagTestCase
+import gitIndexColumns
+import gitRepo
+import gitUtil
+
+class TestRacyGit(WyagTestCase):
+    #A file edited in the same timestamp tick its stat data was recorded in, without changing
+    #its size, can keep the exact stat data that was recorded. Once the index is written again
+    #at a later tick, only the smudged size tells status to look at its content.
+    def test_same_tick_edit(self):
+        path = self.write("f", "aaa\n")
+        self.wyag("add", "f")
+
+        # The edit happens in some tick, and its stat data is recorded in that same tick
+        # (as a refresh would do): it matches the file, but the SHA is the one of "aaa".
+        self.write("f", "bbb\n")
+        tick = int(os.stat(path).st_mtime) - 100
+        os.utime(path, (tick, tick))
+        repo = gitRepo.repo_find(self.worktree)
+        lock = gitUtil.index_lock(repo)
+        index = gitUtil.index_read(repo)
+        gitUtil.index_entry_stat_update(index.entries[0], os.stat(path))
+        with unittest.mock.patch("time.time", return_value=tick + 0.5):
+            gitUtil.index_write(repo, index, lock)
+
+        # The index file itself is dated now, long after the tick: the entry isn't racy anymore.
+        self.assertIn("modified: f", self.wyag("status").stdout)
+        # Rewriting the index later keeps the entry smudged, since its content differs.
+        self.wyag("status", "--refresh")
+        self.assertIn("modified: f", self.wyag("status").stdout)
+        result = self.wyag("update-index", "--refresh", check=False)
+        self.assertIn("f: needs update", result.stdout)
+
+class TestColumnarStatus(WyagTestCase):
+    def setUp(self):
+        super().setUp()
+        if not gitIndexColumns.available():
+            self.skipTest("NumPy isn't installed")
+        names = [ "d{0}/f{1}".format(i % 3, i) for i in range(20) ]
+        for i, name in enumerate(names):
+            self.write(name, "file {0}\n".format(i))
+        self.wyag("add", *names)
+        # Date the files back, so that none of them is racy.
+        for name in names:
+            os.utime(os.path.join(self.worktree, name), ns=(10**18, 10**18))
+        self.wyag("update-index", "--refresh")
+        self.repo = gitRepo.repo_find(self.worktree)
+
+    def status(self, columns):
+        with unittest.mock.patch.object(gitIndexColumns, "COLUMNS_MIN", 0 if columns else 10**9):
+            index = gitUtil.index_read(self.repo, columns=True)
+            self.assertEqual(index.columns is not None, columns)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                gitUtil.status_index_worktree_entries(self.repo, index, False)
+        return index, out.getvalue()
+
+    def test_flagged(self):
+        self.write("d1/f1", "changed\n")
+        os.unlink(os.path.join(self.worktree, "d2/f2"))
+        index, _ = self.status(True)
+        names = [ e.name for e in index.entries ]
+        flagged = index.columns.flagged(self.worktree, index.mtime)
+        self.assertEqual([ names[i] for i in flagged ], [ "d1/f1", "d2/f2" ])
+        # Entries changed after the index was written are racy.
+        self.assertEqual(index.columns.flagged(self.worktree, 0), list(range(len(names))))
+
+    def test_same_output(self):
+        self.write("d1/f1", "changed\n")
+        self.write("d0/f3", "file 0\n")
+        os.unlink(os.path.join(self.worktree, "d2/f2"))
+        _, columns = self.status(True)
+        _, python = self.status(False)
+        self.assertEqual(columns, python)
+        self.assertIn("modified: d1/f1", columns)
+        self.assertIn("modified: d0/f3", columns)
+        self.assertIn("deleted:    d2/f2", columns)
+
+    #Changing the entries makes the columns stale.
+    def test_changed_entries(self):
+        index, _ = self.status(True)
+        index.remove("d1/f1")
+        self.assertIsNone(index.columns)
+
+if __name__ == "__main__":
+    unittest.main()
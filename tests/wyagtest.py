@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+"""
+Helpers for the tests: each test gets a fresh repository, made by wyag init in a temporary
+directory, and runs wyag in it as a separate process, the way it's used. The server isn't used
+(WYAG_SERVER=0) unless a test asks for it, so that tests don't depend on each other.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tests reading the repository from inside the process import wyag's modules from the root.
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+class WyagTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.worktree = os.path.join(self.tmp.name, "repo")
+        self.wyag("init", self.worktree, cwd=self.tmp.name)
+
+    #Run a wyag command in the repository, and return what it printed. Fails the test when the
+    #command fails, unless check is False. env adds to (or overrides) the environment.
+    def wyag(self, *argv, cwd=None, check=True, env=None):
+        result = subprocess.run(self.command(*argv), cwd=cwd or self.worktree,
+                                env=self.environment(env), capture_output=True, text=True)
+        if check and result.returncode != 0:
+            self.fail("wyag {0} failed:\n{1}".format(" ".join(argv), result.stderr))
+        return result
+
+    def command(self, *argv):
+        return [ sys.executable, os.path.join(ROOT, "wyag.py"), *argv ]
+
+    def environment(self, env=None):
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(p for p in (ROOT, environment.get("PYTHONPATH")) if p)
+        environment["WYAG_SERVER"] = "0"
+        environment.update(env or {})
+        return environment
+
+    def write(self, name, content):
+        path = os.path.join(self.worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
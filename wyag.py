@@ -1,4 +1,12 @@
 #!/usr/bin/env python3
 
+import sys
+import gitClient
+
+# Hand the command over to a running server when there's one (see gitServer).
+code = gitClient.client_main(sys.argv[1:])
+if code is not None:
+    sys.exit(code)
+
 import libwyag
 libwyag.main()